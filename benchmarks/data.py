@@ -0,0 +1,107 @@
+import datetime
+import random
+from django.contrib.auth.models import User
+from blog.models import Post, Comment, Category as BlogCategory
+from expenses import rollup
+from expenses.models import Record, MonthlyRollup, Category, Payment
+
+# 乱数の種と基準日を固定して、何度実行しても同じデータを作る
+BASE_DATE = datetime.date(2026, 1, 1)
+BASE_TIME = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+BATCH_SIZE = 10000
+
+
+def _bulk_create(model, objects):
+    batch = []
+    for obj in objects:
+        batch.append(obj)
+        if len(batch) >= BATCH_SIZE:
+            model.objects.bulk_create(batch)
+            batch = []
+    model.objects.bulk_create(batch)
+
+
+# 家計簿のカテゴリ・支払い方法と、years年分に散らばったレコードをcount件作る
+def generate_records(count, categories=10, payments=5, years=5, seed=0):
+    rng = random.Random(seed)
+    category_ids = [Category.objects.create(name='category %d' % i).pk for i in range(categories)]
+    payment_ids = [Payment.objects.create(name='payment %d' % i).pk for i in range(payments)]
+    days = 365 * years
+
+    def records():
+        for i in range(count):
+            day = rng.randrange(days)
+            yield Record(
+                created_date=BASE_TIME - datetime.timedelta(days=day, seconds=rng.randrange(86400)),
+                expense_date=BASE_DATE - datetime.timedelta(days=day),
+                amount=rng.randrange(100, 50000),
+                category_id=rng.choice(category_ids),
+                payment_id=rng.choice(payment_ids),
+                note='note %d %s' % (i, rng.choice(['lunch', 'dinner', 'rent', 'train', 'book'])),
+            )
+
+    _bulk_create(Record, records())
+    # bulk_create では月次集計が更新されないので最後に作り直す
+    rollup.rebuild(Record, MonthlyRollup)
+
+
+# ブログのカテゴリと、count件の投稿(1割は下書き)・投稿ごとにcomments件のコメントを作る
+def generate_posts(count, comments=2, categories=10, seed=0):
+    rng = random.Random(seed)
+    author, _ = User.objects.get_or_create(username='benchmark')
+    category_ids = [BlogCategory.objects.create(name='category %d' % i, text='text').pk for i in range(categories)]
+
+    def posts():
+        for i in range(count):
+            created = BASE_TIME - datetime.timedelta(minutes=i)
+            post = Post(
+                author=author,
+                title='post %d' % i,
+                text='body of post %d\n' % i * rng.randrange(1, 20),
+                created_date=created,
+                published_date=None if i % 10 == 0 else created + datetime.timedelta(hours=1),
+                category_id=rng.choice(category_ids),
+            )
+            # bulk_create では save() を通らないので表示用のHTMLをここで作る
+            post.render_text()
+            yield post
+
+    _bulk_create(Post, posts())
+    post_ids = list(Post.objects.values_list('pk', flat=True))
+
+    def post_comments():
+        for post_id in post_ids:
+            for j in range(comments):
+                yield Comment(
+                    post_id=post_id,
+                    author='reader %d' % j,
+                    text='comment %d' % j,
+                    created_date=BASE_TIME,
+                    approved_comment=j % 2 == 0,
+                )
+
+    _bulk_create(Comment, post_comments())
+
+
+# 家計簿の取り込み用CSV(新規のレコードをrows件)。カテゴリ・支払い方法は generate_records() で作った名前
+def records_csv(rows, categories=10, payments=5, years=5, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(rows):
+        day = rng.randrange(365 * years)
+        lines.append(',%s,%s,%d,category %d,payment %d,imported %d\n' % (
+            (BASE_TIME - datetime.timedelta(days=day)).strftime('%Y-%m-%d %H:%M:%S %z'),
+            (BASE_DATE - datetime.timedelta(days=day)).strftime('%Y-%m-%d'),
+            rng.randrange(100, 50000), rng.randrange(categories), rng.randrange(payments), i))
+    return ''.join(lines).encode()
+
+
+# ブログの取り込み用CSV(新規の投稿をrows件)。投稿者・カテゴリは generate_posts() で作ったもの
+def posts_csv(rows, categories=10, seed=0):
+    rng = random.Random(seed)
+    lines = []
+    for i in range(rows):
+        created = (BASE_TIME + datetime.timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S %z')
+        lines.append(',benchmark,imported %d,body of imported post %d,%s,%s,category %d\n' % (
+            i, i, created, created, rng.randrange(categories)))
+    return ''.join(lines).encode()
@@ -0,0 +1,286 @@
+import asyncio
+import datetime
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import django
+from django.core.cache import cache
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from benchmarks import data
+from blog.models import Post
+from mysite.testing import isolated_cache
+from .bench_views import git_revision
+
+# 遅いダウンロード(CSVエクスポート)のURL
+DOWNLOAD_URL = '/expenses/export/'
+# 遅いクライアントが1回に受け取るバイト数(この大きさごとに受信速度の分だけ待つ)
+WINDOW = 64 * 1024
+
+
+# received バイト受け取ったクライアントが、さらに size バイト受け取るときに待つ秒数
+def receive_delay(received, size, rate):
+    if not rate:
+        return 0
+    windows = (received + size) // WINDOW - received // WINDOW
+    return windows * WINDOW / rate
+
+
+def summarize(latencies, seconds):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / seconds, 1),
+        'median_ms': round(statistics.median(latencies) * 1000, 3),
+        'p95_ms': round(latencies[max(int(len(latencies) * 0.95) - 1, 0)] * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+
+class ThreadCounter:
+    """計測中のプロセスのスレッド数の最大値を数える"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count())
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+class Command(BaseCommand):
+    help = ('テスト用のデータベースに決まった乱数で作ったデータを入れ、遅いクライアントのCSVエクスポートを'
+            '同時に何本も流しながら投稿詳細を閲覧させて、WSGI(スレッド数が決まったワーカー)とASGIの'
+            '閲覧の待ち時間・スループットを比べた結果をJSONで出力します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', choices=['wsgi', 'asgi'], default=['wsgi', 'asgi'],
+                            help='計測するサーバーの種類')
+        parser.add_argument('--threads', type=int, default=4, help='WSGIのワーカースレッド数')
+        parser.add_argument('--downloads', type=int, default=8, help='同時に流す遅いダウンロードの数')
+        parser.add_argument('--download-rate', type=int, default=256,
+                            help='ダウンロードするクライアントの受信速度(KB/秒、0なら待たない)')
+        parser.add_argument('--requests', type=int, default=200, help='ダウンロード中に送る閲覧のリクエスト数')
+        parser.add_argument('--concurrency', type=int, default=8, help='閲覧するクライアントの数')
+        parser.add_argument('--posts', type=int, default=100, help='投稿の件数')
+        parser.add_argument('--records', type=int, default=10000, help='家計簿レコードの件数(エクスポートの行数)')
+        parser.add_argument('--seed', type=int, default=0, help='データを作る乱数の種')
+        parser.add_argument('--output', help='結果のJSONを書き込むファイル(省略時は標準出力)')
+
+    def handle(self, *args, **options):
+        if options['threads'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--threads と --concurrency は1以上にしてください。')
+        # ASGIではリクエストごとに別のスレッドからDBを読むので、SQLiteはメモリ上ではなく一時ファイルに作る
+        test_settings = connection.settings_dict['TEST']
+        old_test_name = test_settings['NAME']
+        if connection.vendor == 'sqlite':
+            test_settings['NAME'] = os.path.join(tempfile.mkdtemp(), 'bench_asgi.sqlite3')
+        # キャッシュはテスト用のもの(プロセス内)に替え、実サイトのキャッシュを読み書き・消去しない
+        with isolated_cache():
+            setup_test_environment()
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                data.generate_posts(options['posts'], categories=3, seed=options['seed'])
+                data.generate_records(options['records'], seed=options['seed'])
+                post_id = (Post.objects.filter(published_date__isnull=False)
+                           .order_by('pk').values_list('pk', flat=True)[0])
+                page_url = '/blog/post/%d/' % post_id
+                results = {}
+                # 閲覧のたびにDBを読んで描画させる
+                with override_settings(BLOG_CACHE_PAGES=False):
+                    for server in options['servers']:
+                        cache.clear()
+                        results[server] = getattr(self, 'measure_' + server)(options, page_url)
+                        self.stderr.write(
+                            '%-5s pages: median %8.1f ms  p95 %8.1f ms  %7.1f req/s  downloads: %6.2f s' % (
+                                server, results[server]['pages']['median_ms'], results[server]['pages']['p95_ms'],
+                                results[server]['pages']['requests_per_second'],
+                                results[server]['downloads']['median_seconds']))
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+                test_settings['NAME'] = old_test_name
+
+        report = {
+            'revision': git_revision(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {key: options[key] for key in (
+                'threads', 'downloads', 'download_rate', 'requests', 'concurrency', 'posts', 'records', 'seed')},
+            'page_url': page_url,
+            'download_url': DOWNLOAD_URL,
+            'results': results,
+        }
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    # 閲覧のリクエスト数を、閲覧するクライアントに振り分ける
+    @staticmethod
+    def split_requests(options):
+        requests, concurrency = options['requests'], options['concurrency']
+        return [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+
+    def report(self, page_latencies, pages_seconds, downloads, threads):
+        return {
+            'pages': summarize(page_latencies, pages_seconds),
+            'downloads': {
+                'count': len(downloads),
+                'bytes': downloads[0][1] if downloads else 0,
+                'median_seconds': round(statistics.median(seconds for seconds, size in downloads), 3),
+                'max_seconds': round(max(seconds for seconds, size in downloads), 3),
+            },
+            'peak_threads': threads.peak,
+        }
+
+    # WSGI: ワーカースレッド --threads 本のスレッドプールがリクエストを順に処理する(gunicorn の gthread にあたる)
+    # 遅いクライアントへの送信中も、そのワーカーはふさがったままになる
+    def measure_wsgi(self, options, page_url):
+        handler = WSGIHandler()
+        rate = options['download_rate'] * 1024
+
+        def call(url, rate):
+            path, _, query = url.partition('?')
+            environ = {
+                'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': query, 'SCRIPT_NAME': '',
+                'SERVER_NAME': 'testserver', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+                'REMOTE_ADDR': '127.0.0.1', 'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+                'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+            }
+            status = []
+            result = handler(environ, lambda status_line, headers, exc_info=None: status.append(status_line))
+            received = 0
+            try:
+                for chunk in result:
+                    delay = receive_delay(received, len(chunk), rate)
+                    received += len(chunk)
+                    if delay:
+                        time.sleep(delay)
+            finally:
+                result.close()
+            if int(status[0].split()[0]) >= 400:
+                raise CommandError('GET %s returned %s' % (url, status[0]))
+            return received
+
+        with ThreadPoolExecutor(max_workers=options['threads']) as server, \
+                ThreadPoolExecutor(max_workers=options['downloads'] + options['concurrency']) as clients, \
+                ThreadCounter() as threads:
+            def request(url, rate=0):
+                start = time.perf_counter()
+                size = server.submit(call, url, rate).result()
+                return time.perf_counter() - start, size
+
+            def browse(count):
+                return [request(page_url)[0] for _ in range(count)]
+
+            started = time.perf_counter()
+            downloads = [clients.submit(request, DOWNLOAD_URL, rate) for _ in range(options['downloads'])]
+            pages = [clients.submit(browse, count) for count in self.split_requests(options)]
+            page_latencies = [latency for future in pages for latency in future.result()]
+            pages_seconds = time.perf_counter() - started
+            downloads = [future.result() for future in downloads]
+        return self.report(page_latencies, pages_seconds, downloads, threads)
+
+    # ASGI: 1つのイベントループがすべてのリクエストを扱う(uvicorn などにあたる)
+    # 遅いクライアントへの送信は await で待つので、その間にほかのリクエストが進む
+    # 本番と同じ mysite.asgi のアプリケーションを使う。設定はこのコマンドの起動時に読み込み済みで
+    # mysite/asgi.py の DATABASE_CONN_MAX_AGE の上書きが効かないので、計測の間だけ接続の設定に当てる
+    def measure_asgi(self, options, page_url):
+        from mysite import asgi
+
+        handler = asgi.application
+        conn_max_age = {alias: connections[alias].settings_dict['CONN_MAX_AGE'] for alias in connections}
+        for alias in connections:
+            connections[alias].settings_dict['CONN_MAX_AGE'] = asgi.CONN_MAX_AGE
+        try:
+            return self.run_asgi(handler, options, page_url)
+        finally:
+            for alias, value in conn_max_age.items():
+                connections[alias].settings_dict['CONN_MAX_AGE'] = value
+
+    def run_asgi(self, handler, options, page_url):
+        rate = options['download_rate'] * 1024
+
+        async def call(url, rate):
+            path, _, query = url.partition('?')
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+                'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+                'root_path': '', 'headers': [(b'host', b'testserver')],
+                'server': ('testserver', 80), 'client': ('127.0.0.1', 0),
+            }
+            finished = asyncio.Event()
+            request_sent = False
+            status = None
+            received = 0
+
+            async def receive():
+                nonlocal request_sent
+                if not request_sent:
+                    request_sent = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                # レスポンスを受け取り終えるまで切断しない
+                await finished.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                nonlocal status, received
+                if message['type'] == 'http.response.start':
+                    status = message['status']
+                elif message['type'] == 'http.response.body':
+                    size = len(message.get('body', b''))
+                    delay = receive_delay(received, size, rate)
+                    received += size
+                    if delay:
+                        await asyncio.sleep(delay)
+
+            try:
+                await handler(scope, receive, send)
+            finally:
+                finished.set()
+            if status >= 400:
+                raise CommandError('GET %s returned %d' % (url, status))
+            return received
+
+        async def request(url, rate=0):
+            start = time.perf_counter()
+            size = await call(url, rate)
+            return time.perf_counter() - start, size
+
+        async def browse(count):
+            return [(await request(page_url))[0] for _ in range(count)]
+
+        async def run():
+            started = time.perf_counter()
+            downloads = [asyncio.create_task(request(DOWNLOAD_URL, rate)) for _ in range(options['downloads'])]
+            pages = await asyncio.gather(*(browse(count) for count in self.split_requests(options)))
+            pages_seconds = time.perf_counter() - started
+            return [latency for latencies in pages for latency in latencies], pages_seconds, await asyncio.gather(*downloads)
+
+        with ThreadCounter() as threads:
+            page_latencies, pages_seconds, downloads = asyncio.run(run())
+        return self.report(page_latencies, pages_seconds, downloads, threads)
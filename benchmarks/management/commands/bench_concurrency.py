@@ -0,0 +1,117 @@
+import datetime
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from expenses.models import Record, Category, Payment
+from mysite.testing import isolated_cache
+from .bench_views import git_revision
+
+
+class Command(BaseCommand):
+    help = ('テスト用のデータベースに、複数のワーカー(スレッド)から同時にレコードを登録し、'
+            '書き込みのスループット・待ち時間・ロックで失敗した件数をJSONで出力します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8], help='同時に書き込むワーカー数')
+        parser.add_argument('--writes', type=int, default=200, help='ワーカーごとの登録件数')
+        parser.add_argument('--untuned', action='store_true',
+                            help='SQLITE_PRAGMAS を使わない(SQLiteの既定の)設定でも計測して比べる')
+        parser.add_argument('--output', help='結果のJSONを書き込むファイル(省略時は標準出力)')
+
+    def handle(self, *args, **options):
+        profiles = [('tuned', settings.SQLITE_PRAGMAS)]
+        if options['untuned'] and connection.vendor == 'sqlite':
+            profiles.append(('untuned', {}))
+        results = {}
+        # キャッシュはテスト用のもの(プロセス内)に替え、実サイトのキャッシュに書き込まない
+        for name, pragmas in profiles:
+            with override_settings(SQLITE_PRAGMAS=pragmas), isolated_cache():
+                results[name] = self.measure_profile(name, options)
+
+        report = {
+            'revision': git_revision(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'database': connection.vendor,
+            'conn_max_age': connection.settings_dict['CONN_MAX_AGE'],
+            'options': {key: options[key] for key in ('workers', 'writes')},
+            'results': results,
+        }
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    # 設定ごとに新しいテスト用データベースを作って計測する
+    # SQLiteはスレッド間で共有できるよう、メモリ上ではなく一時ファイルに作る
+    def measure_profile(self, name, options):
+        test_settings = connection.settings_dict['TEST']
+        old_test_name = test_settings['NAME']
+        if connection.vendor == 'sqlite':
+            test_settings['NAME'] = os.path.join(tempfile.mkdtemp(), 'bench_concurrency.sqlite3')
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            category = Category.objects.create(name='category')
+            payment = Payment.objects.create(name='payment')
+            results = {}
+            for workers in options['workers']:
+                results[workers] = self.measure(workers, options['writes'], category.pk, payment.pk)
+                self.stderr.write('%-8s %2d workers %10.1f writes/s %6d errors' % (
+                    name, workers, results[workers]['writes_per_second'], results[workers]['errors']))
+            return results
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            test_settings['NAME'] = old_test_name
+
+    # workers 個のスレッドが、それぞれ自分の接続で writes 件ずつ登録する
+    # 登録は画面と同じく Record.save()(月次集計の更新を含むトランザクション)で行う
+    def measure(self, workers, writes, category_id, payment_id):
+        barrier = threading.Barrier(workers + 1)
+
+        def work(worker):
+            latencies, errors = [], 0
+            try:
+                barrier.wait()
+                for i in range(writes):
+                    start = time.perf_counter()
+                    try:
+                        Record.objects.create(
+                            expense_date=datetime.date(2020, (worker + i) % 12 + 1, 1), amount=i,
+                            category_id=category_id, payment_id=payment_id, note='worker %d' % worker)
+                    except OperationalError:
+                        # database is locked など
+                        errors += 1
+                        continue
+                    latencies.append((time.perf_counter() - start) * 1000)
+            finally:
+                connection.close()
+            return latencies, errors
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(work, worker) for worker in range(workers)]
+            barrier.wait()
+            started = time.perf_counter()
+            outcomes = [future.result() for future in futures]
+            seconds = time.perf_counter() - started
+        latencies = sorted(latency for worker_latencies, errors in outcomes for latency in worker_latencies)
+        errors = sum(errors for worker_latencies, errors in outcomes)
+        return {
+            'seconds': round(seconds, 3),
+            'writes': len(latencies),
+            'errors': errors,
+            'writes_per_second': round(len(latencies) / seconds, 1),
+            'median_ms': round(statistics.median(latencies), 3) if latencies else None,
+            'p95_ms': round(latencies[int(len(latencies) * 0.95) - 1], 3) if latencies else None,
+            'max_ms': round(latencies[-1], 3) if latencies else None,
+        }
@@ -0,0 +1,88 @@
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from benchmarks import data
+from blog.models import Post, Comment
+from blog.views import published_posts
+from expenses.models import Record
+from mysite.testing import isolated_cache
+
+# 比べるインデックス(モデル, Meta.indexes の名前)
+# マイグレーションを戻すとほかの列もなくなって今のモデルで読めないので、インデックスだけを消して付け直す
+INDEXES = [
+    (Record, 'record_date_idx'),
+    (Post, 'post_published_idx'),
+    (Post, 'post_draft_idx'),
+    (Comment, 'comment_post_approved_idx'),
+]
+
+
+# モデルの Meta.indexes から名前でインデックスを探す
+def index_named(model, name):
+    return next(index for index in model._meta.indexes if index.name == name)
+
+
+# よく使われるクエリ(各画面と同じ絞り込み・並び順)
+def hot_queries():
+    post_id = Post.objects.order_by('pk').values_list('pk', flat=True)[Post.objects.count() // 2]
+    return {
+        'RecordList (page 1)': Record.objects.order_by('-expense_date', '-created_date')[:10],
+        'RecordList (page 1000)': Record.objects.order_by('-expense_date', '-created_date')[9990:10000],
+        'post_list': published_posts()[:10],
+        'post_draft_list': Post.objects.filter(published_date__isnull=True).order_by('created_date')[:10],
+        'approved_comments': Comment.objects.filter(post_id=post_id, approved_comment=True),
+    }
+
+
+class Command(BaseCommand):
+    help = ('テスト用のデータベースに大量のデータを作り、よく使われるクエリの実行計画と実行時間を'
+            'インデックスを消したときと付けたときで比較します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=1000000, help='家計簿レコードの件数')
+        parser.add_argument('--posts', type=int, default=None, help='投稿の件数(省略時は --rows と同じ)')
+        parser.add_argument('--repeat', type=int, default=5, help='1つのクエリを実行する回数')
+
+    def handle(self, *args, **options):
+        # 本番のデータベースには触らず、テスト用のデータベースとキャッシュを使う
+        with isolated_cache():
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                self.stdout.write('Generating %d records and %d posts...' % (
+                    options['rows'], options['posts'] or options['rows']))
+                data.generate_records(options['rows'])
+                data.generate_posts(options['posts'] or options['rows'])
+
+                indexes = [(model, index_named(model, name)) for model, name in INDEXES]
+                with connection.schema_editor() as editor:
+                    for model, index in indexes:
+                        editor.remove_index(model, index)
+                before = self.measure(options['repeat'])
+                with connection.schema_editor() as editor:
+                    for model, index in indexes:
+                        editor.add_index(model, index)
+                after = self.measure(options['repeat'])
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        for name in before:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for label, result in (('before', before[name]), ('after', after[name])):
+                self.stdout.write('  %s: %.2f ms' % (label, result['ms']))
+                for line in result['plan'].splitlines():
+                    self.stdout.write('    ' + line)
+
+    # 各クエリの実行計画と、実行時間の中央値(ミリ秒)
+    def measure(self, repeat):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        results = {}
+        for name, queryset in hot_queries().items():
+            timings = []
+            for i in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                timings.append((time.perf_counter() - start) * 1000)
+            results[name] = {'ms': statistics.median(timings), 'plan': queryset.explain()}
+        return results
@@ -0,0 +1,144 @@
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import time
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings, setup_test_environment, teardown_test_environment
+from benchmarks import data
+from blog.models import Post
+from expenses.models import Record
+from mysite.performance import stats
+from mysite.testing import isolated_cache, streaming_body
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = ('テスト用のデータベースに決まった乱数で作ったデータを入れ、主な画面(一覧・詳細・集計・取り込み・'
+            'エクスポート)をテストクライアントで計測して、結果をJSONで出力します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=10000, help='投稿の件数')
+        parser.add_argument('--comments', type=int, default=2, help='投稿ごとのコメントの件数')
+        parser.add_argument('--records', type=int, default=100000, help='家計簿レコードの件数')
+        parser.add_argument('--years', type=int, default=5, help='家計簿レコードを散らばらせる年数')
+        parser.add_argument('--categories', type=int, default=10, help='カテゴリの数(ブログ・家計簿それぞれ)')
+        parser.add_argument('--payments', type=int, default=5, help='支払い方法の数')
+        parser.add_argument('--import-rows', type=int, default=1000, help='取り込みで1回に読み込む行数')
+        parser.add_argument('--repeat', type=int, default=5, help='1つの画面を計測する回数')
+        parser.add_argument('--seed', type=int, default=0, help='データを作る乱数の種')
+        parser.add_argument('--output', help='結果のJSONを書き込むファイル(省略時は標準出力)')
+
+    def handle(self, *args, **options):
+        # 本番のデータベースには触らず、テスト用のデータベースを作って使う
+        # キャッシュもテスト用のもの(プロセス内)に替え、実サイトのキャッシュを読み書き・消去しない
+        with isolated_cache():
+            setup_test_environment()
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                self.stderr.write('Generating %(posts)d posts and %(records)d records...' % options)
+                started = time.perf_counter()
+                data.generate_posts(options['posts'], comments=options['comments'],
+                                    categories=options['categories'], seed=options['seed'])
+                data.generate_records(options['records'], categories=options['categories'],
+                                      payments=options['payments'], years=options['years'], seed=options['seed'])
+                generate_seconds = time.perf_counter() - started
+                # 取り込みはリクエスト内で行い、ページのキャッシュは使わずに毎回描画させる
+                with override_settings(CSV_IMPORT_IN_BACKGROUND=False, BLOG_CACHE_PAGES=False):
+                    results = self.measure(options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+                teardown_test_environment()
+
+        report = {
+            'revision': git_revision(),
+            'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {key: options[key] for key in (
+                'posts', 'comments', 'records', 'years', 'categories', 'payments', 'import_rows', 'repeat', 'seed')},
+            'generate_seconds': round(generate_seconds, 3),
+            'results': results,
+        }
+        output = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        else:
+            self.stdout.write(output)
+
+    def entry_points(self, options):
+        published = Post.objects.filter(published_date__isnull=False)
+        post_id = published.order_by('pk').values_list('pk', flat=True)[0]
+        # 一覧はOFFSETが大きくなる途中のページも計測する
+        post_page = max(published.count() // settings.BLOG_POSTS_PER_PAGE // 2, 1)
+        record_page = max(Record.objects.count() // 10 // 2, 1)
+        records_csv = data.records_csv(options['import_rows'], categories=options['categories'],
+                                       payments=options['payments'], years=options['years'], seed=options['seed'])
+        posts_csv = data.posts_csv(options['import_rows'], categories=options['categories'], seed=options['seed'])
+        return [
+            ('post_list', 'get', '/blog/', None),
+            ('post_list (middle page)', 'get', '/blog/?page=%d' % post_page, None),
+            ('post_detail', 'get', '/blog/post/%d/' % post_id, None),
+            ('RecordList', 'get', '/expenses/', None),
+            ('RecordList (middle page)', 'get', '/expenses/?page=%d' % record_page, None),
+            ('record_aggregate', 'get', '/expenses/record/aggregate/', None),
+            ('record_export', 'get', '/expenses/export/', None),
+            ('post_export', 'get', '/blog/export/', None),
+            # 取り込みは計測のたびに新しい行が増える
+            ('record_import', 'post', '/expenses/import/', lambda: {
+                'file': SimpleUploadedFile('records.csv', records_csv)}),
+            ('post_import', 'post', '/blog/import/', lambda: {
+                'file': SimpleUploadedFile('posts.csv', posts_csv)}),
+        ]
+
+    # 各画面の時間(ミリ秒)の中央値・最小・最大と、クエリ数・レスポンスの大きさ
+    # SQL・テンプレートの時間は PerformanceMiddleware の計測値の中央値
+    def measure(self, options):
+        client = Client()
+        results = {}
+        for name, method, url, payload in self.entry_points(options):
+            stats.clear()
+            timings = []
+            for i in range(options['repeat']):
+                cache.clear()
+                with CaptureQueriesContext(connection) as queries:
+                    start = time.perf_counter()
+                    response = getattr(client, method)(url, payload() if payload else {})
+                    if response.streaming:
+                        size = len(streaming_body(response))
+                    else:
+                        size = len(response.content)
+                    timings.append((time.perf_counter() - start) * 1000)
+                if response.status_code >= 400:
+                    raise CommandError('%s %s returned %d' % (method.upper(), url, response.status_code))
+            middleware = next(iter(stats.summary().values()), None)
+            results[name] = {
+                'url': url,
+                'status': response.status_code,
+                'median_ms': round(statistics.median(timings), 3),
+                'min_ms': round(min(timings), 3),
+                'max_ms': round(max(timings), 3),
+                'sql_ms': round(middleware['sql_ms']['p50'], 3) if middleware else None,
+                'template_ms': round(middleware['template_ms']['p50'], 3) if middleware else None,
+                'queries': len(queries),
+                'bytes': size,
+            }
+            self.stderr.write('%-24s %10.2f ms %6d queries' % (name, results[name]['median_ms'], len(queries)))
+        return results
@@ -1,5 +1,17 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+# migrate の後、テーブルの作り直しで消えた全文検索のトリガーを作り直す
+def ensure_search_index(sender, using, **kwargs):
+    from .search import post_index
+    post_index.ensure(connections[using])
 
 
 class BlogConfig(AppConfig):
     name = 'blog'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        post_migrate.connect(ensure_search_index, sender=self)
@@ -0,0 +1,142 @@
+import hashlib
+import time
+from functools import wraps
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Q
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+
+CATEGORY_COUNTS_KEY = 'blog:category_counts'
+
+
+# カテゴリごとの公開済み・下書きの投稿数(1回のクエリで集計する)
+def category_counts():
+    from .models import Category
+
+    return list(
+        Category.objects
+        .annotate(
+            published_count=Count('posts', filter=Q(posts__published_date__isnull=False)),
+            draft_count=Count('posts', filter=Q(posts__published_date__isnull=True)),
+        )
+        .order_by('pk')
+    )
+
+
+# キャッシュ版。投稿やカテゴリが保存・削除されると invalidate_category_counts() で消える
+def cached_category_counts():
+    return cache.get_or_set(CATEGORY_COUNTS_KEY, category_counts, settings.BLOG_CACHE_TIMEOUT)
+
+
+def invalidate_category_counts():
+    cache.delete(CATEGORY_COUNTS_KEY)
+
+
+# ページキャッシュの鍵となる更新時刻(スタンプ)
+# 投稿一覧・カテゴリ・投稿ごとに、最後に変更(公開・編集・削除・コメント)された時刻をキャッシュに持つ
+LIST_STAMP_KEY = 'blog:stamp:list'
+CATEGORY_STAMP_KEY = 'blog:stamp:category'
+
+
+def post_stamp_key(pk):
+    return 'blog:stamp:post:%s' % pk
+
+
+# 投稿一覧と、指定した投稿(categories=True ならカテゴリ)のスタンプを今の時刻にして、
+# それらを使うページのキャッシュを古いものにする
+def touch(posts=(), categories=False):
+    now = time.time()
+    keys = [LIST_STAMP_KEY] + [post_stamp_key(pk) for pk in posts]
+    if categories:
+        keys.append(CATEGORY_STAMP_KEY)
+    cache.set_many(dict.fromkeys(keys, now), settings.BLOG_CACHE_TIMEOUT)
+
+
+# スタンプのうち最も新しいもの。キャッシュから消えていたら今の時刻で作り直す
+# (スタンプにも保持期限があるので、公開日時が未来の投稿もその期限内には一覧に出る)
+def latest_stamp(keys):
+    stamps = cache.get_many(keys)
+    missing = [key for key in keys if key not in stamps]
+    if missing:
+        now = time.time()
+        for key in missing:
+            cache.add(key, now, settings.BLOG_CACHE_TIMEOUT)
+        stamps.update(cache.get_many(missing))
+    return max(stamps.values())
+
+
+# ページキャッシュを使うリクエストか(未ログインのGET・HEAD)
+def use_page_cache(request):
+    return (settings.BLOG_CACHE_PAGES and request.method in ('GET', 'HEAD')
+            and not request.user.is_authenticated)
+
+
+class StampedPage:
+    """スタンプから作った ETag と、キャッシュされたページ
+
+    条件付きGETで変わっていなければ not_modified に304を、キャッシュがあれば response にそのページを持つ。
+    """
+
+    def __init__(self, request, keys):
+        self.stamp = latest_stamp(keys)
+        self.etag = '"%s"' % hashlib.md5(('%s:%r' % (request.get_full_path(), self.stamp)).encode()).hexdigest()
+        self.key = 'blog:page:%s' % self.etag.strip('"')
+        self.not_modified = get_conditional_response(request, etag=self.etag, last_modified=int(self.stamp))
+        self.response = None
+        if self.not_modified is None:
+            cached = cache.get(self.key)
+            if cached is not None:
+                content, content_type = cached
+                self.response = HttpResponse(content, content_type=content_type)
+
+    # ビューが作ったページをキャッシュする
+    def store(self, response):
+        if response.status_code == 200 and not response.streaming:
+            cache.set(self.key, (response.content, response['Content-Type']), settings.BLOG_CACHE_TIMEOUT)
+
+    def finish(self, response):
+        if response.status_code == 200:
+            response['ETag'] = self.etag
+            response['Last-Modified'] = http_date(self.stamp)
+        # ログイン中はキャッシュしていないページを返すので、共有キャッシュはCookieで分ける
+        patch_vary_headers(response, ['Cookie'])
+        return response
+
+
+# 未ログインのGETに対して、ページ全体をキャッシュし、ETag/Last-Modifiedで条件付きGETに答えるデコレータ
+# stamp_keys(**kwargs) はページの内容が依存するスタンプのキーのリストを返す
+# キャッシュされたページもスタンプもキャッシュから読むので、304を返すときやキャッシュがあるときはクエリを発行しない
+# 非同期のビューにも使える(キャッシュ・request.user の読み込みはスレッドで行う)
+def cache_page_by_stamp(stamp_keys):
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if not await sync_to_async(use_page_cache)(request):
+                    return await view(request, *args, **kwargs)
+                page = await sync_to_async(StampedPage)(request, stamp_keys(**kwargs))
+                if page.not_modified is not None:
+                    return page.not_modified
+                response = page.response
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                    await sync_to_async(page.store)(response)
+                return page.finish(response)
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if not use_page_cache(request):
+                    return view(request, *args, **kwargs)
+                page = StampedPage(request, stamp_keys(**kwargs))
+                if page.not_modified is not None:
+                    return page.not_modified
+                response = page.response
+                if response is None:
+                    response = view(request, *args, **kwargs)
+                    page.store(response)
+                return page.finish(response)
+        return wrapper
+    return decorator
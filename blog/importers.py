@@ -0,0 +1,50 @@
+import datetime
+from django.contrib.auth.models import User
+from django.utils import timezone
+from mysite.csv_import import CSVImporter, RowError
+from . import caching
+from .models import RENDERED_FIELDS, Post, Category
+
+
+# 日時の列を変換する(空なら下書きとしてNone)
+def parse_datetime(value):
+    if not value:
+        return None
+    return datetime.datetime.strptime(value, '%Y-%m-%d %H:%M:%S %z')
+
+
+# 投稿のCSV取り込み
+# 列: pk(新規は空), 投稿者のユーザー名, タイトル, 本文, 作成日時, 公開日時, カテゴリ名
+class PostImporter(CSVImporter):
+    model = Post
+    update_fields = ['title', 'text', 'created_date', 'published_date', 'category'] + RENDERED_FIELDS
+
+    def load_lookups(self):
+        # 行ごとに問い合わせないよう、名前->pkの辞書を最初に一度だけ作る
+        self.users = dict(User.objects.values_list('username', 'pk'))
+        self.categories = dict(Category.objects.order_by('-pk').values_list('name', 'pk'))
+
+    def build(self, row):
+        author_id = self.users.get(row[1])
+        if author_id is None:
+            raise RowError('ユーザー「%s」が見つかりません。' % row[1])
+        category_id = self.categories.get(row[6])
+        if category_id is None:
+            raise RowError('カテゴリ「%s」が見つかりません。' % row[6])
+        post = Post(
+            pk=int(row[0]) if row[0] else None,
+            author_id=author_id,
+            title=row[2],
+            text=row[3],
+            created_date=parse_datetime(row[4]) or timezone.now(),
+            published_date=parse_datetime(row[5]),
+            category_id=category_id,
+        )
+        # bulk_create/bulk_update では save() を通らないので、表示用のHTMLはここで作る
+        post.render_text()
+        return post
+
+    # bulk_create/bulk_update ではシグナルが飛ばないので、キャッシュはここで消す
+    def after_write(self, created, updated, existing):
+        caching.invalidate_category_counts()
+        caching.touch(posts=[post.pk for post in updated])
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from blog import caching, rendering
+from blog.models import RENDERED_FIELDS, Post
+
+
+class Command(BaseCommand):
+    help = ('投稿の表示用HTML・抜粋を、本文またはHTMLの作り方(rendering.RENDER_VERSION)が'
+            '変わったものだけ作り直します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='ハッシュが合っている投稿も作り直す')
+        parser.add_argument('--batch-size', type=int, default=500, help='1回に読み込む投稿の件数')
+
+    def handle(self, *args, **options):
+        last_pk = 0
+        rendered = 0
+        while True:
+            rows = list(
+                Post.objects.filter(pk__gt=last_pk).order_by('pk')
+                .values_list('pk', 'text', 'text_hash')[:options['batch_size']])
+            if not rows:
+                break
+            posts = [
+                Post(pk=pk, **rendering.render(text))
+                for pk, text, text_hash in rows
+                if options['all'] or text_hash != rendering.text_hash(text)
+            ]
+            if posts:
+                Post.objects.bulk_update(posts, RENDERED_FIELDS)
+                # bulk_update ではシグナルが飛ばないので、ページのキャッシュはここで古いものにする
+                caching.touch(posts=[post.pk for post in posts])
+                rendered += len(posts)
+            last_pk = rows[-1][0]
+        self.stdout.write(self.style.SUCCESS('Rendered %d posts.' % rendered))
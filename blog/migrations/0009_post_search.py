@@ -0,0 +1,21 @@
+from django.db import migrations
+from blog.search import post_index
+
+
+def install(apps, schema_editor):
+    post_index.install(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    post_index.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0008_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
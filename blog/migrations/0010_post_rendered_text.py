@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:52
+
+from django.db import migrations, models
+from blog import rendering
+
+
+# 既存の投稿の表示用HTML・抜粋を作る(本文はpk順に一定件数ずつ読む)
+def render_posts(apps, schema_editor):
+    Post = apps.get_model('blog', 'Post')
+    last_pk = 0
+    while True:
+        rows = list(Post.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'text')[:500])
+        if not rows:
+            break
+        Post.objects.bulk_update(
+            [Post(pk=pk, **rendering.render(text)) for pk, text in rows], ['text_html', 'excerpt', 'text_hash'])
+        last_pk = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0009_post_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='excerpt',
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='text_hash',
+            field=models.CharField(blank=True, editable=False, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='text_html',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.RunPython(render_posts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blog', '0010_post_rendered_text'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='comment',
+            index=models.Index(condition=models.Q(approved_comment=False), fields=['created_date'], name='comment_pending_idx'),
+        ),
+    ]
@@ -2,6 +2,10 @@ from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.db import models
 from django.utils import timezone
+from . import rendering
+
+# Post.render_text() が書き換えるフィールド
+RENDERED_FIELDS = ['text_html', 'excerpt', 'text_hash']
 
 class Post(models.Model):
     author = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -10,6 +14,32 @@ class Post(models.Model):
     created_date = models.DateTimeField(default=timezone.now)
     published_date = models.DateTimeField(blank=True, null=True)
     category = models.ForeignKey('blog.Category', on_delete=models.CASCADE, related_name='posts')
+    # 本文から保存時(取り込みを含む)に作る表示用のHTML・抜粋と、その元になった本文のハッシュ
+    text_html = models.TextField(blank=True, editable=False)
+    excerpt = models.CharField(max_length=rendering.EXCERPT_LENGTH, blank=True, editable=False)
+    text_hash = models.CharField(max_length=40, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # 公開済み一覧(公開日時で絞り込み・並び替え)。下書きは含めない部分インデックス
+            models.Index(fields=['published_date'], name='post_published_idx', condition=models.Q(published_date__isnull=False)),
+            # 下書き一覧(公開日時がないものを作成日時順に)だけを対象にした部分インデックス
+            models.Index(fields=['created_date'], name='post_draft_idx', condition=models.Q(published_date__isnull=True)),
+        ]
+
+    # 本文が変わった(またはHTMLの作り方が変わった)ときだけ、表示用のHTMLと抜粋を作り直す
+    def render_text(self):
+        if self.text_hash == rendering.text_hash(self.text):
+            return False
+        for name, value in rendering.render(self.text).items():
+            setattr(self, name, value)
+        return True
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self.render_text() and update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | set(RENDERED_FIELDS)
+        super().save(*args, **kwargs)
 
     def publish(self):
         self.published_date = timezone.now()
@@ -28,6 +58,14 @@ class Comment(models.Model):
     created_date = models.DateTimeField(default=timezone.now)
     approved_comment = models.BooleanField(default=False)
 
+    class Meta:
+        indexes = [
+            # 投稿ごとの承認済みコメント
+            models.Index(fields=['post', 'approved_comment'], name='comment_post_approved_idx'),
+            # 承認待ちの一覧(未承認のものだけを投稿日時順に)だけを対象にした部分インデックス
+            models.Index(fields=['created_date'], name='comment_pending_idx', condition=models.Q(approved_comment=False)),
+        ]
+
     def approve(self):
         self.approved_comment = True
         self.save()
@@ -0,0 +1,31 @@
+from django.db import transaction
+from mysite.deletion import raw_delete
+from . import caching
+from .models import Comment
+
+
+# 承認待ちのコメント(古い順)
+def pending_comments():
+    return Comment.objects.filter(approved_comment=False).select_related('post').order_by('created_date')
+
+
+# 選んだ承認待ちのコメントを UPDATE 1回でまとめて承認し、承認した件数を返す
+# ページのキャッシュは、コメントの付いている投稿の分だけ(コミットの後に)古いものにする
+def approve_comments(pks):
+    comments = Comment.objects.filter(pk__in=pks, approved_comment=False)
+    post_ids = set(comments.values_list('post_id', flat=True))
+    count = comments.update(approved_comment=True)
+    if count:
+        transaction.on_commit(lambda: caching.touch(posts=post_ids))
+    return count
+
+
+# 選んだ承認待ちのコメントを DELETE 1回でまとめて削除し、削除した件数を返す
+# (コメントを1件ずつ読み込んで signals を送らない代わりに、キャッシュはここで更新する)
+def remove_comments(pks):
+    comments = Comment.objects.filter(pk__in=pks, approved_comment=False)
+    post_ids = set(comments.values_list('post_id', flat=True))
+    count = raw_delete(comments)
+    if count:
+        transaction.on_commit(lambda: caching.touch(posts=post_ids))
+    return count
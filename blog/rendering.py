@@ -0,0 +1,23 @@
+import hashlib
+from django.template.defaultfilters import linebreaksbr
+from django.utils.text import Truncator
+
+# 表示用HTMLの作り方を変えたら上げる(保存済みの text_hash と合わなくなり、render_posts で作り直される)
+RENDER_VERSION = 1
+# 一覧に表示する抜粋の文字数
+EXCERPT_LENGTH = 200
+
+
+# 本文と作り方のバージョンから作るハッシュ。保存済みの値と同じなら作り直さなくてよい
+def text_hash(text):
+    return hashlib.sha1(('%d:%s' % (RENDER_VERSION, text)).encode()).hexdigest()
+
+
+# 本文から、詳細画面に出すHTML・一覧に出す抜粋・ハッシュを作る
+# HTMLはテンプレートで使っていた linebreaksbr と同じ(エスケープしてから改行を<br>にする)
+def render(text):
+    return {
+        'text_html': linebreaksbr(text, autoescape=True),
+        'excerpt': Truncator(text).chars(EXCERPT_LENGTH),
+        'text_hash': text_hash(text),
+    }
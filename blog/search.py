@@ -0,0 +1,4 @@
+from mysite.search import FullTextIndex
+
+# 投稿のタイトル・本文の全文検索インデックス(タイトルに含まれる投稿を上位にする)
+post_index = FullTextIndex('blog_post', ['title', 'text'], weights=[10, 1])
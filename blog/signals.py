@@ -0,0 +1,40 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from . import caching
+from .models import Post, Comment, Category
+
+
+# キャッシュの更新はコミットの後に行う(コミット前に別のリクエストが古い内容を読み、
+# 新しいスタンプで保存してしまわないように)
+
+# 投稿の保存(公開を含む)・削除、カテゴリの変更でカテゴリ別の投稿数キャッシュを消す
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_counts(sender, **kwargs):
+    transaction.on_commit(caching.invalidate_category_counts)
+
+
+# 投稿の公開・編集・削除で、その投稿と一覧のページキャッシュを古いものにする
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def touch_post(sender, instance, **kwargs):
+    post_id = instance.pk
+    transaction.on_commit(lambda: caching.touch(posts=[post_id]))
+
+
+# コメントの追加・承認・削除(一覧にはコメント数を表示している)
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def touch_comment(sender, instance, **kwargs):
+    post_id = instance.post_id
+    transaction.on_commit(lambda: caching.touch(posts=[post_id]))
+
+
+# カテゴリ名は一覧・詳細のどちらにも表示している
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def touch_category(sender, instance, **kwargs):
+    transaction.on_commit(lambda: caching.touch(categories=True))
@@ -1,3 +1,313 @@
-from django.test import TestCase
+import time
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from mysite.testing import CleanCacheTestCase, QueryBudgetTestCase
+from . import caching, moderation, rendering
+from .models import Post, Comment, Category
 
-# Create your tests here.
+
+class ViewQueryBudgetTests(QueryBudgetTestCase):
+    """ブログの各画面のクエリ数が query_budget 以内か"""
+    urlconf = 'blog.urls'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('tester', password='password')
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i, text='説明') for i in range(3)]
+        for i in range(12):
+            post = Post.objects.create(
+                author=cls.user, title='タイトル%d' % i, text='本文%d' % i, category=cls.categories[i % 3],
+                published_date=timezone.now() if i < 10 else None)
+            for j in range(3):
+                Comment.objects.create(post=post, author='読者', text='コメント', approved_comment=j > 0)
+        cls.post = Post.objects.filter(published_date__isnull=False).first()
+        cls.draft = Post.objects.filter(published_date__isnull=True).first()
+
+    def login(self):
+        self.client.login(username='tester', password='password')
+
+    def post_data(self):
+        return {'title': 'タイトル', 'text': '本文', 'category': self.categories[0].pk}
+
+    def test_public_pages(self):
+        pk = self.post.pk
+        self.assertWithinBudget('/blog/', status_code=200)
+        self.assertWithinBudget('/blog/?page=2', status_code=200)
+        self.assertWithinBudget('/blog/?q=タイトル', status_code=200)
+        self.assertWithinBudget('/blog/post/%d/' % pk, status_code=200)
+        self.assertWithinBudget('/blog/post/%d/comment/' % pk, status_code=200)
+        self.assertWithinBudget('/blog/post/%d/comment/' % pk, 'post', {'author': '読者', 'text': 'コメント'},
+                                status_code=302)
+        self.assertWithinBudget('/blog/export/', status_code=200)
+
+    def test_cached_pages_run_no_queries(self):
+        url = '/blog/post/%d/' % self.post.pk
+        response = self.client.get(url)
+        with self.assertNumQueries(0):
+            self.client.get(url)
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_logged_in_pages(self):
+        self.login()
+        pk = self.post.pk
+        self.assertWithinBudget('/blog/', status_code=200)
+        self.assertWithinBudget('/blog/post/%d/' % pk, status_code=200)
+        self.assertWithinBudget('/blog/post/new/', status_code=200)
+        self.assertWithinBudget('/blog/post/new/', 'post', self.post_data(), status_code=302)
+        self.assertWithinBudget('/blog/post/%d/edit/' % pk, status_code=200)
+        self.assertWithinBudget('/blog/post/%d/edit/' % pk, 'post', self.post_data(), status_code=302)
+        self.assertWithinBudget('/blog/drafts/', status_code=200)
+        self.assertWithinBudget('/blog/post/%d/publish/' % self.draft.pk, 'post', status_code=302)
+        self.assertWithinBudget('/blog/import/', status_code=200)
+
+    def test_comment_moderation(self):
+        self.login()
+        comment = Comment.objects.filter(approved_comment=False).first()
+        self.assertWithinBudget('/blog/comment/%d/approve/' % comment.pk, 'post', status_code=302)
+        self.assertWithinBudget('/blog/comment/%d/remove/' % comment.pk, 'post', status_code=302)
+        self.assertWithinBudget('/blog/post/%d/remove/' % self.post.pk, 'post', status_code=302)
+
+    def test_comment_moderation_queue(self):
+        self.login()
+        pending = list(Comment.objects.filter(approved_comment=False).values_list('pk', flat=True))
+        self.assertWithinBudget('/blog/comment/pending/', status_code=200)
+        self.assertWithinBudget('/blog/comment/pending/', 'post', {'pks': pending[:5], 'action': 'approve'},
+                                status_code=302)
+        self.assertWithinBudget('/blog/comment/pending/', 'post', {'pks': pending[5:], 'action': 'remove'},
+                                status_code=302)
+        self.assertFalse(Comment.objects.filter(approved_comment=False).exists())
+        self.assertEqual(Comment.objects.filter(pk__in=pending).count(), 5)
+
+    def test_state_changes_require_post(self):
+        self.login()
+        comment = Comment.objects.filter(approved_comment=False).first()
+        for url in ('/blog/post/%d/publish/' % self.draft.pk, '/blog/post/%d/remove/' % self.post.pk,
+                    '/blog/comment/%d/approve/' % comment.pk, '/blog/comment/%d/remove/' % comment.pk):
+            self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertTrue(Post.objects.filter(pk=self.post.pk).exists())
+        self.assertIsNone(Post.objects.get(pk=self.draft.pk).published_date)
+
+    def test_bulk_remove(self):
+        self.login()
+        drafts = list(Post.objects.filter(published_date__isnull=True).values_list('pk', flat=True))
+        self.assertWithinBudget('/blog/post/remove/', 'post', {'pks': drafts}, status_code=302)
+        self.assertFalse(Post.objects.filter(pk__in=drafts).exists())
+        self.assertFalse(Comment.objects.filter(post__in=drafts).exists())
+
+    def test_categories(self):
+        self.login()
+        category = self.categories[0]
+        self.assertWithinBudget('/blog/category/list/', status_code=200)
+        self.assertWithinBudget('/blog/category/new/', status_code=200)
+        self.assertWithinBudget('/blog/category/new/', 'post', {'name': '新規', 'text': '説明'}, status_code=302)
+        self.assertWithinBudget('/blog/category/%d/edit/' % category.pk, status_code=200)
+        self.assertWithinBudget('/blog/category/%d/edit/' % category.pk, 'post', {'name': '変更', 'text': '説明'},
+                                status_code=302)
+
+    def test_import(self):
+        self.login()
+        csv = ',tester,タイトル,本文,,,カテゴリ0\n'.encode()
+        self.assertWithinBudget('/blog/import/', 'post', {'file': SimpleUploadedFile('posts.csv', csv)},
+                                status_code=302)
+
+    @override_settings(CSV_IMPORT_IN_BACKGROUND=False)
+    def test_import_in_request(self):
+        self.login()
+        csv = ''.join(',tester,タイトル%d,本文,,,カテゴリ%d\n' % (i, i % 3) for i in range(1000)).encode()
+        self.assertWithinBudget('/blog/import/', 'post', {'file': SimpleUploadedFile('posts.csv', csv)},
+                                status_code=302)
+        self.assertEqual(Post.objects.count(), 1012)
+
+
+class RenderedTextTests(TestCase):
+    """保存時に作る本文のHTML・抜粋"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('tester', password='password')
+        cls.category = Category.objects.create(name='カテゴリ', text='説明')
+
+    def create_post(self, text):
+        return Post.objects.create(author=self.user, title='タイトル', text=text, category=self.category,
+                                   published_date=timezone.now())
+
+    def test_rendered_on_save(self):
+        post = self.create_post('<b>太字</b>\n2行目' + 'あ' * 300)
+        post.refresh_from_db()
+        self.assertTrue(post.text_html.startswith('&lt;b&gt;太字&lt;/b&gt;<br>2行目'))
+        self.assertEqual(len(post.excerpt), rendering.EXCERPT_LENGTH)
+        self.assertEqual(post.text_hash, rendering.text_hash(post.text))
+        post.text = '変更'
+        post.save(update_fields=['text'])
+        post.refresh_from_db()
+        self.assertEqual((post.text_html, post.excerpt), ('変更', '変更'))
+
+    def test_pages_show_rendered_text(self):
+        post = self.create_post('1行目\n' + 'い' * 300)
+        response = self.client.get('/blog/')
+        self.assertContains(response, '1行目<br>' + 'い' * 100)
+        self.assertNotContains(response, 'い' * 250)
+        self.assertContains(self.client.get('/blog/post/%d/' % post.pk), post.text_html)
+
+    def test_import_renders_text(self):
+        csv = ',tester,タイトル,"本文<i>\n2行目",,,カテゴリ\n'.encode()
+        self.client.login(username='tester', password='password')
+        with self.settings(CSV_IMPORT_IN_BACKGROUND=False):
+            self.client.post('/blog/import/', {'file': SimpleUploadedFile('posts.csv', csv)})
+        post = Post.objects.get()
+        self.assertEqual(post.text_html, '本文&lt;i&gt;<br>2行目')
+
+    def test_render_posts_command_updates_stale_posts(self):
+        post = self.create_post('本文')
+        Post.objects.filter(pk=post.pk).update(text='書き換えた本文')
+        call_command('render_posts', stdout=open('/dev/null', 'w'))
+        post.refresh_from_db()
+        self.assertEqual(post.text_html, '書き換えた本文')
+        self.assertEqual(post.text_hash, rendering.text_hash('書き換えた本文'))
+
+
+class CategoryCountTests(CleanCacheTestCase):
+    """カテゴリ一覧の公開済み・下書きの投稿数と、そのキャッシュの削除"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('tester', password='password')
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i, text='説明') for i in range(2)]
+        for i in range(3):
+            Post.objects.create(author=cls.user, title='タイトル%d' % i, text='本文', category=cls.categories[0],
+                                published_date=timezone.now() if i < 2 else None)
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='tester', password='password')
+
+    def counts(self):
+        response = self.client.get('/blog/category/list/')
+        return {category.name: (category.published_count, category.draft_count)
+                for category in response.context['categories']}
+
+    def assertCountsFollowChanges(self):
+        self.assertEqual(self.counts(), {'カテゴリ0': (2, 1), 'カテゴリ1': (0, 0)})
+        draft = Post.objects.get(published_date__isnull=True)
+        with self.captureOnCommitCallbacks(execute=True):
+            draft.publish()
+        self.assertEqual(self.counts(), {'カテゴリ0': (3, 0), 'カテゴリ1': (0, 0)})
+        with self.captureOnCommitCallbacks(execute=True):
+            draft.category = self.categories[1]
+            draft.save()
+        self.assertEqual(self.counts(), {'カテゴリ0': (2, 0), 'カテゴリ1': (1, 0)})
+        with self.captureOnCommitCallbacks(execute=True):
+            Post.objects.filter(category=self.categories[0]).first().delete()
+        self.assertEqual(self.counts(), {'カテゴリ0': (1, 0), 'カテゴリ1': (1, 0)})
+
+    @override_settings(BLOG_CACHE_CATEGORY_COUNTS=True)
+    def test_cached_counts(self):
+        self.assertCountsFollowChanges()
+        # キャッシュは投稿の変更のコミットまで残る
+        with self.captureOnCommitCallbacks():
+            Post.objects.create(author=self.user, title='下書き', text='本文', category=self.categories[1])
+            self.assertEqual(self.counts(), {'カテゴリ0': (1, 0), 'カテゴリ1': (1, 0)})
+
+    @override_settings(BLOG_CACHE_CATEGORY_COUNTS=False)
+    def test_uncached_counts(self):
+        self.assertCountsFollowChanges()
+        Post.objects.create(author=self.user, title='下書き', text='本文', category=self.categories[1])
+        self.assertEqual(self.counts(), {'カテゴリ0': (1, 0), 'カテゴリ1': (1, 1)})
+
+
+class CommentModerationTests(CleanCacheTestCase):
+    """承認待ちコメントのまとめて承認・削除と、コメントの表示"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('tester', password='password')
+        category = Category.objects.create(name='カテゴリ', text='説明')
+        cls.posts = [
+            Post.objects.create(author=cls.user, title='タイトル%d' % i, text='本文', category=category,
+                                published_date=timezone.now())
+            for i in range(3)]
+        for post in cls.posts:
+            Comment.objects.create(post=post, author='読者', text='承認済み', approved_comment=True)
+            Comment.objects.create(post=post, author='読者', text='承認待ち')
+
+    def test_only_affected_posts_are_invalidated(self):
+        stamps = {post.pk: caching.latest_stamp([caching.post_stamp_key(post.pk)]) for post in self.posts}
+        time.sleep(0.01)
+        comment = Comment.objects.get(post=self.posts[0], approved_comment=False)
+        # スタンプはコミットされてから新しくする
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(moderation.approve_comments([comment.pk]), 1)
+            self.assertEqual(caching.latest_stamp([caching.post_stamp_key(self.posts[0].pk)]), stamps[self.posts[0].pk])
+        self.assertGreater(caching.latest_stamp([caching.post_stamp_key(self.posts[0].pk)]), stamps[self.posts[0].pk])
+        for post in self.posts[1:]:
+            self.assertEqual(caching.latest_stamp([caching.post_stamp_key(post.pk)]), stamps[post.pk])
+        comment = Comment.objects.get(post=self.posts[1], approved_comment=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(moderation.remove_comments([comment.pk]), 1)
+        self.assertGreater(caching.latest_stamp([caching.post_stamp_key(self.posts[1].pk)]), stamps[self.posts[1].pk])
+        self.assertEqual(caching.latest_stamp([caching.post_stamp_key(self.posts[2].pk)]), stamps[self.posts[2].pk])
+
+    def test_saving_touches_stamps_after_commit(self):
+        key = caching.post_stamp_key(self.posts[0].pk)
+        stamp = caching.latest_stamp([key])
+        time.sleep(0.01)
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(post=self.posts[0], author='読者', text='追加')
+            self.posts[0].save()
+            self.assertEqual(caching.latest_stamp([key]), stamp)
+        self.assertGreater(caching.latest_stamp([key]), stamp)
+
+    def test_approved_comments_are_not_removed(self):
+        comment = Comment.objects.filter(approved_comment=True).first()
+        self.assertEqual(moderation.remove_comments([comment.pk]), 0)
+        self.assertTrue(Comment.objects.filter(pk=comment.pk).exists())
+
+    def test_post_detail_shows_only_visible_comments(self):
+        url = '/blog/post/%d/' % self.posts[0].pk
+        response = self.client.get(url)
+        self.assertContains(response, '承認済み')
+        self.assertNotContains(response, '承認待ち')
+        self.client.login(username='tester', password='password')
+        response = self.client.get(url)
+        self.assertContains(response, '承認待ち')
+
+
+class AsyncViewTests(CleanCacheTestCase):
+    """ASGI(非同期のクライアント)で呼んだ投稿一覧・詳細"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('tester', password='password')
+        category = Category.objects.create(name='カテゴリ', text='説明')
+        cls.posts = [
+            Post.objects.create(author=cls.user, title='タイトル%d' % i, text='本文%d' % i, category=category,
+                                published_date=timezone.now())
+            for i in range(12)]
+        Comment.objects.create(post=cls.posts[0], author='読者', text='承認待ち')
+
+    async def test_post_list_pages(self):
+        response = await self.async_client.get('/blog/', {'page': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['page_obj'].paginator.count, 12)
+        self.assertEqual(len(response.context['posts']), 2)
+
+    async def test_post_detail_is_cached_for_anonymous(self):
+        url = '/blog/post/%d/' % self.posts[0].pk
+        response = await self.async_client.get(url)
+        self.assertContains(response, 'タイトル0')
+        self.assertNotContains(response, '承認待ち')
+        response = await self.async_client.get(url, headers={'If-None-Match': response['ETag']})
+        self.assertEqual(response.status_code, 304)
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(url)
+        self.assertContains(response, '承認待ち')
+        self.assertFalse(response.has_header('ETag'))
+
+    async def test_missing_post(self):
+        response = await self.async_client.get('/blog/post/0/')
+        self.assertEqual(response.status_code, 404)
@@ -1,22 +1,75 @@
-import csv
 import datetime
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponse
-from django.shortcuts import render, get_object_or_404, redirect
+from django.core.paginator import Paginator
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+from django.shortcuts import aget_object_or_404, render, get_object_or_404, redirect
 from django.urls import reverse_lazy
 from django.utils import timezone
 from django.views import generic
+from django.views.decorators.http import require_POST
+from mysite import asynchronous
+from mysite.deletion import bulk_delete
+from mysite.performance import query_budget
+from mysite.streaming import EXPORT_CHUNK_SIZE, csv_streaming_response
+from .caching import (
+    CATEGORY_STAMP_KEY, LIST_STAMP_KEY, cache_page_by_stamp, category_counts, cached_category_counts, post_stamp_key,
+)
 from .models import Post, Comment, Category
+from .moderation import approve_comments, pending_comments, remove_comments
+from .search import post_index
 from .forms import PostForm, CommentForm, CategoryForm, CSVUploadForm
 
-def post_list(request):
-    posts = Post.objects.filter(published_date__lte=timezone.now()).order_by('published_date').reverse()
-    return render(request, 'blog/post_list.html', {'posts': posts})
+# 公開済みの投稿一覧のクエリ
+# カテゴリ・投稿者は同じクエリで取得し、承認済みコメント数も集計しておく(投稿ごとにクエリを発行しない)
+# コメント数はGROUP BYではなく相関サブクエリにして、公開日時のインデックス順に必要な件数だけ読ませる
+# 一覧には抜粋だけを表示するので、本文と本文のHTMLは読まない
+def published_posts():
+    approved_comment_count = (
+        Comment.objects
+        .filter(post=OuterRef('pk'), approved_comment=True)
+        .order_by()
+        .values('post')
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    return (
+        Post.objects
+        .filter(published_date__lte=timezone.now())
+        .select_related('category', 'author')
+        .defer('text', 'text_html')
+        .annotate(approved_comment_count=Coalesce(Subquery(approved_comment_count, output_field=IntegerField()), 0))
+        .order_by('-published_date')
+    )
 
-def post_detail(request, pk):
-    post = get_object_or_404(Post, pk=pk)
-    return render(request, 'blog/post_detail.html', {'post': post})
+# 未ログインの閲覧はページごとキャッシュする(投稿・コメント・カテゴリが変わると作り直す)
+# 非同期のビュー。ASGIでは、クエリ・描画の間もスレッドを占有しない
+@query_budget(4)
+@cache_page_by_stamp(lambda: [LIST_STAMP_KEY, CATEGORY_STAMP_KEY])
+async def post_list(request):
+    posts = published_posts()
+    query = request.GET.get('q', '')
+    if query:
+        # タイトル・本文の全文検索。関連度の高い順に並べる
+        posts = post_index.search(posts, query, ranked=True)
+    page_obj = await asynchronous.get_page(posts, settings.BLOG_POSTS_PER_PAGE, request.GET.get('page'))
+    return await asynchronous.render(
+        request, 'blog/post_list.html', {'posts': page_obj, 'page_obj': page_obj, 'query': query})
+
+@query_budget(5)
+@cache_page_by_stamp(lambda pk: [post_stamp_key(pk), CATEGORY_STAMP_KEY])
+async def post_detail(request, pk):
+    # 本文は保存時に作ったHTMLを表示するので、元の本文は読まない
+    post = await aget_object_or_404(Post.objects.defer('text').select_related('category'), pk=pk)
+    # 表示してよいコメント(未ログインなら承認済みだけ)を1回のクエリで読む
+    comments = post.comments.order_by('created_date')
+    if not await asynchronous.is_authenticated(request):
+        comments = comments.filter(approved_comment=True)
+    comments = [comment async for comment in comments]
+    return await asynchronous.render(request, 'blog/post_detail.html', {'post': post, 'comments': comments})
 
+@query_budget(5)
 @login_required
 def post_new(request):
     if request.method == "POST":
@@ -30,6 +83,7 @@ def post_new(request):
         form = PostForm()
     return render(request, 'blog/post_edit.html', {'form': form})
 
+@query_budget(6)
 @login_required
 def post_edit(request, pk):
     post = get_object_or_404(Post, pk=pk)
@@ -44,23 +98,39 @@ def post_edit(request, pk):
         form = PostForm(instance=post)
     return render(request, 'blog/post_edit.html', {'form': form})
 
+@query_budget(3)
 @login_required
 def post_draft_list(request):
     posts = Post.objects.filter(published_date__isnull=True).order_by('created_date')
     return render(request, 'blog/post_draft_list.html', {'posts': posts})
 
+@query_budget(4)
 @login_required
+@require_POST
 def post_publish(request, pk):
     post = get_object_or_404(Post, pk=pk)
     post.publish()
     return redirect('blog:post_detail', pk=pk)
 
+@query_budget(7)
 @login_required
+@require_POST
 def post_remove(request, pk):
     post = get_object_or_404(Post, pk=pk)
     post.delete()
     return redirect('blog:post_list')
 
+# 下書き一覧で選んだ投稿をまとめて削除(POSTのみ)
+# 投稿・コメントには signals がつながっているので、一定件数ずつ読み込んで削除する
+@query_budget(12)
+@login_required
+@require_POST
+def post_bulk_remove(request):
+    pks = [int(pk) for pk in request.POST.getlist('pks') if pk.isdigit()]
+    bulk_delete(Post.objects.filter(pk__in=pks))
+    return redirect('blog:post_draft_list')
+
+@query_budget(3)
 def add_comment_to_post(request, pk):
     post = get_object_or_404(Post, pk=pk)
     if request.method == "POST":
@@ -74,23 +144,47 @@ def add_comment_to_post(request, pk):
         form = CommentForm()
     return render(request, 'blog/add_comment_to_post.html', {'form': form})
 
+@query_budget(4)
 @login_required
+@require_POST
 def comment_approve(request, pk):
     comment = get_object_or_404(Comment, pk=pk)
     comment.approve()
-    return redirect('blog:post_detail', pk=comment.post.pk)
+    return redirect('blog:post_detail', pk=comment.post_id)
 
+@query_budget(5)
 @login_required
+@require_POST
 def comment_remove(request, pk):
     comment = get_object_or_404(Comment, pk=pk)
     comment.delete()
-    return redirect('blog:post_detail', pk=comment.post.pk)
+    return redirect('blog:post_detail', pk=comment.post_id)
 
+# 承認待ちコメントの一覧(全投稿分)。選んだコメントをまとめて承認・削除する
+@query_budget(6)
+@login_required
+def comment_moderation(request):
+    if request.method == "POST":
+        pks = [int(pk) for pk in request.POST.getlist('pks') if pk.isdigit()]
+        if request.POST.get('action') == 'approve':
+            approve_comments(pks)
+        elif request.POST.get('action') == 'remove':
+            remove_comments(pks)
+        return redirect('blog:comment_moderation')
+    paginator = Paginator(pending_comments(), settings.BLOG_COMMENTS_PER_PAGE)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    return render(request, 'blog/comment_moderation.html', {'comments': page_obj, 'page_obj': page_obj})
+
+@query_budget(3)
 @login_required
 def category_list(request):
-    categories = Category.objects.all
+    if settings.BLOG_CACHE_CATEGORY_COUNTS:
+        categories = cached_category_counts()
+    else:
+        categories = category_counts()
     return render(request, 'blog/category_list.html', {'categories': categories})
 
+@query_budget(4)
 @login_required
 def category_new(request):
     if request.method == "POST":
@@ -103,6 +197,7 @@ def category_new(request):
         form = CategoryForm()
     return render(request, 'blog/category_edit.html', {'form': form})
 
+@query_budget(4)
 @login_required
 def category_edit(request, pk):
     post = get_object_or_404(Category, pk=pk)
@@ -120,25 +215,40 @@ class PostImport(generic.FormView):
     template_name = 'blog/import.html'
     success_url = reverse_lazy('post_list')
     form_class = CSVUploadForm
+    # リクエスト内で取り込むとき(CSV_IMPORT_IN_BACKGROUND = False)の、1バッチ(1000行)分
+    query_budget = 25
 
     def form_valid(self, form):
-        form.save()
+        if settings.CSV_IMPORT_IN_BACKGROUND:
+            # 取り込みはバックグラウンドで行い、すぐにジョブの進捗画面へ移る
+            job = form.enqueue()
+            return redirect('imports:job_detail', pk=job.pk)
+        result = form.save()
+        if result is None:
+            return self.form_invalid(form)
+        if result.errors:
+            # 取り込めなかった行があれば、その一覧を表示する
+            return self.render_to_response(self.get_context_data(form=form, result=result))
         return redirect('blog:post_list')
 
+@query_budget(1)
 def post_export(request):
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="posts.csv"'
-    # HttpResponseオブジェクトはファイルっぽいオブジェクトなので、csv.writerにそのまま渡せる
-    writer = csv.writer(response)
-    for post in Post.objects.filter(published_date__lte=timezone.now()):
-        writer.writerow(
-            [post.pk,
-             post.author,
-             post.title,
-             post.text,
-             post.created_date.strftime('%Y-%m-%d %H:%M:%S %z'),
-             post.published_date.strftime('%Y-%m-%d %H:%M:%S %z'),
-             post.category
-             ]
-        )
-    return response
+    posts = (
+        Post.objects
+        .filter(published_date__lte=timezone.now())
+        .order_by('pk')
+        .values_list('pk', 'author__username', 'title', 'text', 'created_date', 'published_date', 'category__name')
+        .iterator(chunk_size=EXPORT_CHUNK_SIZE)
+    )
+    rows = (
+        [pk,
+         author,
+         title,
+         text,
+         created_date.strftime('%Y-%m-%d %H:%M:%S %z'),
+         published_date.strftime('%Y-%m-%d %H:%M:%S %z'),
+         category,
+         ]
+        for pk, author, title, text, created_date, published_date, category in posts
+    )
+    return csv_streaming_response(rows, 'posts.csv')
@@ -1,6 +1,23 @@
 from django.contrib import admin
-from .models import Record, Category, Payment
+from django.db import transaction
+from . import rollup
+from .models import Record, Category, Payment, Budget, RecurringRecord
 
-admin.site.register(Record)
+
+class RecordAdmin(admin.ModelAdmin):
+
+    # 一覧の「選択したレコードの削除」は Record.delete() を通らないので、
+    # 月次集計・予算の増減(とアーカイブのキャッシュの削除)をここで同じトランザクションに反映する
+    def delete_queryset(self, request, queryset):
+        with transaction.atomic():
+            removed = [rollup.entry(*row) for row in queryset.select_for_update().values_list(
+                'expense_date', 'category_id', 'payment_id', 'amount')]
+            queryset.delete()
+            rollup.apply_changes(removed=removed)
+
+
+admin.site.register(Record, RecordAdmin)
 admin.site.register(Category)
 admin.site.register(Payment)
+admin.site.register(Budget)
+admin.site.register(RecurringRecord)
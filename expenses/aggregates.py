@@ -0,0 +1,102 @@
+import calendar
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek, TruncYear
+
+# 集計の単位: (期間の先頭日に切り捨てる関数, 見出しの書式, 画面の見出し)
+GRANULARITIES = {
+    'day': (TruncDay, '%Y-%m-%d', '日'),
+    'week': (TruncWeek, '%Y-%m-%d〜', '週'),
+    'month': (TruncMonth, '%Y-%m', '月'),
+    'year': (TruncYear, '%Y', '年'),
+}
+
+
+# 「月、カテゴリ、支払い方法」で金額と件数を合計するクエリ(集計はDB側で行う)
+def monthly_amounts(records):
+    return (
+        records
+        .filter(expense_date__isnull=False)
+        .annotate(month=TruncMonth('expense_date'))
+        .values('month', 'category', 'payment')
+        .annotate(total=Sum('amount'), count=Count('pk'))
+        .order_by()
+    )
+
+
+# 期間の範囲が月単位(開始が月初、終了が月末)か
+def month_aligned(date_from, date_to):
+    if date_from is not None and date_from.day != 1:
+        return False
+    if date_to is not None and date_to.day != calendar.monthrange(date_to.year, date_to.month)[1]:
+        return False
+    return True
+
+
+# 期間・カテゴリ・支払い方法で絞り込み、granularity の単位・カテゴリ・支払い方法ごとに金額を合計するクエリ
+# 絞り込みも集計もSQLで行うので、かかる時間は保存されている全期間ではなく指定した範囲の件数で決まる
+# 月・年単位で範囲が月単位なら月次集計テーブルから、それ以外はレコードから集計する
+def period_amounts(date_from=None, date_to=None, categories=None, payments=None, granularity='month'):
+    from .models import Record, MonthlyRollup
+
+    trunc = GRANULARITIES[granularity][0]
+    if granularity in ('month', 'year') and month_aligned(date_from, date_to):
+        rows, date_field, amount_field = MonthlyRollup.objects.all(), 'month', 'total'
+        period = F('month') if granularity == 'month' else trunc('month')
+    else:
+        rows, date_field, amount_field = Record.objects.filter(expense_date__isnull=False), 'expense_date', 'amount'
+        period = trunc('expense_date')
+    if date_from is not None:
+        rows = rows.filter(**{date_field + '__gte': date_from})
+    if date_to is not None:
+        rows = rows.filter(**{date_field + '__lte': date_to})
+    if categories:
+        rows = rows.filter(category_id__in=categories)
+    if payments:
+        rows = rows.filter(payment_id__in=payments)
+    return (
+        rows
+        .values('category', 'payment', period=period)
+        .annotate(total=Sum(amount_field))
+        .order_by()
+    )
+
+
+# 集計結果を1回だけ走査して、期間・期間×カテゴリ・期間×支払い方法の表を作る
+# rows の各行は period(期間の先頭日)・category・payment・total を持つ
+# 各行の金額リストは categories・payments の並び順に揃えてあるので、テンプレートはそのまま並べるだけでよい
+def build_pivots(rows, categories, payments, granularity='month'):
+    label_format = GRANULARITIES[granularity][1]
+    category_index = {category.pk: i for i, category in enumerate(categories)}
+    payment_index = {payment.pk: i for i, payment in enumerate(payments)}
+
+    per_period = {}
+    for row in rows:
+        period = row['period']
+        entry = per_period.get(period)
+        if entry is None:
+            entry = per_period[period] = {
+                'amount': 0,
+                'categories': [0] * len(category_index),
+                'payments': [0] * len(payment_index),
+            }
+        total = row['total']
+        entry['amount'] += total
+        entry['categories'][category_index[row['category']]] += total
+        entry['payments'][payment_index[row['payment']]] += total
+
+    # 新しい期間が上に来るように並べる
+    periods = sorted(per_period, reverse=True)
+    amounts_per_m = []
+    amounts_per_m_c = []
+    amounts_per_m_p = []
+    for period in periods:
+        entry = per_period[period]
+        label = period.strftime(label_format)
+        amounts_per_m.append({'period': label, 'amount': entry['amount']})
+        amounts_per_m_c.append({'period': label, 'amounts': entry['categories']})
+        amounts_per_m_p.append({'period': label, 'amounts': entry['payments']})
+    return {
+        'amounts_per_m': amounts_per_m,
+        'amounts_per_m_c': amounts_per_m_c,
+        'amounts_per_m_p': amounts_per_m_p,
+    }
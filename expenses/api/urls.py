@@ -0,0 +1,8 @@
+from django.urls import path
+from . import views
+
+app_name = 'api'
+urlpatterns = [
+    path('records/', views.records, name='records'),
+    path('aggregates/', views.aggregates, name='aggregates'),
+]
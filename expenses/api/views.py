@@ -0,0 +1,196 @@
+import calendar
+import datetime
+from django.conf import settings
+from django.http import JsonResponse
+from django.utils.dateparse import parse_date
+from mysite.performance import query_budget
+from .. import lookups
+from ..aggregates import GRANULARITIES, build_pivots, period_amounts
+from ..models import Record
+from ..pagination import CursorPaginator, InvalidCursor
+from ..search import record_index
+
+# 選べる項目と、values() で読むカラム(カテゴリ名・支払い方法名はキャッシュした一覧から引く)
+FIELDS = {
+    'id': 'pk',
+    'created_date': 'created_date',
+    'expense_date': 'expense_date',
+    'amount': 'amount',
+    'category': 'category_id',
+    'category_name': 'category_id',
+    'payment': 'payment_id',
+    'payment_name': 'payment_id',
+    'note': 'note',
+}
+DEFAULT_FIELDS = ['id', 'expense_date', 'amount', 'category', 'payment', 'note']
+# カーソルを作るのに必ず読むカラム
+KEY_COLUMNS = ['pk', 'expense_date', 'created_date']
+
+
+class BadRequest(Exception):
+    """リクエストのパラメータが正しくない(400を返す)"""
+
+
+def error_response(message):
+    return JsonResponse({'error': message}, status=400)
+
+
+def parse_fields(value):
+    if not value:
+        return DEFAULT_FIELDS
+    fields = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise BadRequest('unknown fields: %s' % ', '.join(unknown))
+    return fields
+
+
+def parse_ids(value, name):
+    try:
+        return [int(pk) for pk in value.split(',') if pk]
+    except ValueError:
+        raise BadRequest('%s must be a comma separated list of ids' % name)
+
+
+def parse_date_param(value, name):
+    try:
+        date = parse_date(value)
+    except ValueError:
+        date = None
+    if date is None:
+        raise BadRequest('%s must be a date (YYYY-MM-DD)' % name)
+    return date
+
+
+def parse_month(value, name):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m').date()
+    except ValueError:
+        raise BadRequest('%s must be a month (YYYY-MM)' % name)
+
+
+def parse_limit(value):
+    max_limit = settings.EXPENSES_API_MAX_LIMIT
+    if not value:
+        return settings.EXPENSES_API_DEFAULT_LIMIT
+    try:
+        limit = int(value)
+    except ValueError:
+        raise BadRequest('limit must be an integer')
+    if not 1 <= limit <= max_limit:
+        raise BadRequest('limit must be between 1 and %d' % max_limit)
+    return limit
+
+
+# 日付の範囲・カテゴリ・支払い方法・用途で絞り込んだレコード
+def filter_records(params):
+    records = Record.objects.all()
+    if params.get('date_from'):
+        records = records.filter(expense_date__gte=parse_date_param(params['date_from'], 'date_from'))
+    if params.get('date_to'):
+        records = records.filter(expense_date__lte=parse_date_param(params['date_to'], 'date_to'))
+    if params.get('category'):
+        records = records.filter(category_id__in=parse_ids(params['category'], 'category'))
+    if params.get('payment'):
+        records = records.filter(payment_id__in=parse_ids(params['payment'], 'payment'))
+    if params.get('q'):
+        records = record_index.search(records, params['q'])
+    return records
+
+
+# values() の1行を、選ばれた項目だけの辞書にする関数を作る
+def row_serializer(fields):
+    categories, payments = lookups.categories, lookups.payments
+
+    def name(table, pk):
+        obj = table.get(pk)
+        return obj.name if obj is not None else None
+
+    getters = {
+        'category_name': lambda row: name(categories, row['category_id']),
+        'payment_name': lambda row: name(payments, row['payment_id']),
+    }
+
+    def serialize(row):
+        return {
+            field: getters[field](row) if field in getters else row[FIELDS[field]]
+            for field in fields
+        }
+    return serialize
+
+
+def page_url(request, cursor):
+    if cursor is None:
+        return None
+    params = request.GET.copy()
+    params['cursor'] = cursor
+    return request.build_absolute_uri('?' + params.urlencode())
+
+
+# レコードの一覧(JSON)
+# ?fields=id,amount,... で項目を選び、?limit= 件ずつ next/previous のURLでページを送る
+# モデルのインスタンスは作らず、values() の結果をそのまま返す
+@query_budget(5)
+def records(request):
+    try:
+        fields = parse_fields(request.GET.get('fields'))
+        limit = parse_limit(request.GET.get('limit'))
+        queryset = filter_records(request.GET)
+    except BadRequest as e:
+        return error_response(str(e))
+    columns = sorted(set(KEY_COLUMNS) | {FIELDS[field] for field in fields})
+    count = request.GET.get('count', 'none')
+    if count not in ('exact', 'estimate', 'none'):
+        return error_response('count must be one of exact, estimate, none')
+    paginator = CursorPaginator(queryset.values(*columns), limit, count=count)
+    try:
+        page = paginator.page(request.GET.get('cursor'))
+    except InvalidCursor:
+        return error_response('invalid cursor')
+    serialize = row_serializer(fields)
+    return JsonResponse({
+        'count': page.count,
+        'next': page_url(request, page.next_cursor),
+        'previous': page_url(request, page.previous_cursor),
+        'results': [serialize(row) for row in page.object_list],
+    })
+
+
+# 集計(JSON)。期間・期間×カテゴリ・期間×支払い方法の表
+# ?date_from=&date_to= (または ?month_from=YYYY-MM&month_to=YYYY-MM)で期間を、?category=&payment= で列を絞り込み、
+# ?granularity=day|week|month|year で集計の単位を選ぶ(省略時は month)
+@query_budget(3)
+def aggregates(request):
+    params = request.GET
+    categories = lookups.categories.all()
+    payments = lookups.payments.all()
+    filters = {'granularity': params.get('granularity') or 'month'}
+    try:
+        if filters['granularity'] not in GRANULARITIES:
+            raise BadRequest('granularity must be one of %s' % ', '.join(GRANULARITIES))
+        if params.get('date_from'):
+            filters['date_from'] = parse_date_param(params['date_from'], 'date_from')
+        elif params.get('month_from'):
+            filters['date_from'] = parse_month(params['month_from'], 'month_from')
+        if params.get('date_to'):
+            filters['date_to'] = parse_date_param(params['date_to'], 'date_to')
+        elif params.get('month_to'):
+            month = parse_month(params['month_to'], 'month_to')
+            filters['date_to'] = month.replace(day=calendar.monthrange(month.year, month.month)[1])
+        if params.get('category'):
+            filters['categories'] = set(parse_ids(params['category'], 'category'))
+            categories = [category for category in categories if category.pk in filters['categories']]
+        if params.get('payment'):
+            filters['payments'] = set(parse_ids(params['payment'], 'payment'))
+            payments = [payment for payment in payments if payment.pk in filters['payments']]
+    except BadRequest as e:
+        return error_response(str(e))
+    pivots = build_pivots(period_amounts(**filters), categories, payments, filters['granularity'])
+    return JsonResponse({
+        'granularity': filters['granularity'],
+        'categories': [{'id': category.pk, 'name': category.name} for category in categories],
+        'payments': [{'id': payment.pk, 'name': payment.name} for payment in payments],
+        'periods': pivots['amounts_per_m'],
+        'by_category': pivots['amounts_per_m_c'],
+        'by_payment': pivots['amounts_per_m_p'],
+    })
@@ -0,0 +1,85 @@
+import calendar
+import datetime
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from .aggregates import period_amounts
+
+# 年・月のアーカイブの合計のキャッシュ
+# 鍵にはバージョンを含める。カテゴリ・支払い方法の削除などで全部が変わったときはバージョンを変える
+VERSION_KEY = 'expenses:archive:version'
+
+
+# 期間の最初の日と最後の日(month が None なら年)
+def period_range(year, month=None):
+    if month is None:
+        return datetime.date(year, 1, 1), datetime.date(year, 12, 31)
+    return datetime.date(year, month, 1), datetime.date(year, month, calendar.monthrange(year, month)[1])
+
+
+# 終わった期間か(今日の属する月より前に終わっているか)。終わった期間の合計はめったに変わらない
+def is_closed(year, month=None):
+    return period_range(year, month)[1] < timezone.localdate().replace(day=1)
+
+
+def _version():
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(VERSION_KEY)
+    return version
+
+
+def _period_key(version, year, month=None):
+    if month is None:
+        return 'expenses:archive:%s:%04d' % (version, year)
+    return 'expenses:archive:%s:%04d-%02d' % (version, year, month)
+
+
+def _months_key(version):
+    return 'expenses:archive:%s:months' % version
+
+
+# 期間の「年なら月、月なら日」・カテゴリ・支払い方法ごとの合計(period_amounts の行のリスト)
+# 1回の集計クエリで作り、期間ごとにキャッシュする。終わった期間は EXPENSES_ARCHIVE_CLOSED_TIMEOUT の間持つ
+def period_totals(year, month=None):
+    key = _period_key(_version(), year, month)
+    rows = cache.get(key)
+    if rows is None:
+        date_from, date_to = period_range(year, month)
+        # 年は月次集計から、月はレコードの expense_date の範囲(インデックスの範囲検索)から集計する
+        rows = list(period_amounts(date_from, date_to, granularity='day' if month else 'month'))
+        if is_closed(year, month):
+            timeout = settings.EXPENSES_ARCHIVE_CLOSED_TIMEOUT
+        else:
+            timeout = settings.EXPENSES_ARCHIVE_TIMEOUT
+        cache.set(key, rows, timeout)
+    return rows
+
+
+# レコードのある月(月初日)の一覧(古い順)。前後の期間へのリンクに使う
+def months():
+    from .models import MonthlyRollup
+
+    key = _months_key(_version())
+    result = cache.get(key)
+    if result is None:
+        result = list(MonthlyRollup.objects.order_by('month').values_list('month', flat=True).distinct())
+        cache.set(key, result, settings.EXPENSES_ARCHIVE_TIMEOUT)
+    return result
+
+
+# 合計の変わった月(月初日)の、月・年の合計とレコードのある月の一覧をキャッシュから消す
+def invalidate(changed_months):
+    version = _version()
+    keys = [_months_key(version)]
+    for month in changed_months:
+        keys.append(_period_key(version, month.year, month.month))
+        keys.append(_period_key(version, month.year))
+    cache.delete_many(keys)
+
+
+# すべての期間のキャッシュを使わないようにする(カテゴリ・支払い方法の削除、月次集計の作り直しのあと)
+def invalidate_all():
+    cache.set(VERSION_KEY, uuid.uuid4().hex, None)
@@ -0,0 +1,90 @@
+from collections import defaultdict
+from django.db.models import F, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.db.models.lookups import GreaterThan
+from .rollup import BULK_THRESHOLD
+
+# 月・カテゴリごとの予算の「使った額」(Budget.spent)と超過(Budget.overspent)の更新
+# 使った額は月次集計と同じ増減から、同じトランザクション内で加算する。表示のときは合計し直さない
+
+
+# 月次集計の増減(キー: (月, カテゴリpk, 支払い方法pk))を、(月, カテゴリpk) ごとの金額の増減にまとめる
+def category_deltas(deltas):
+    totals = defaultdict(int)
+    for (month, category_id, payment_id), (total, count) in deltas.items():
+        totals[month, category_id] += total
+    return {key: total for key, total in totals.items() if total}
+
+
+# 予算の使った額に total を足す式と、足したあとに予算を超えているかの式
+def _spent_values(total):
+    spent = F('spent') + total
+    return {'spent': spent, 'overspent': GreaterThan(spent, F('amount'))}
+
+
+# 増減を予算に反映する。rollup.apply() から呼ばれる(呼び出し側のトランザクション内で実行すること)
+# 予算のない月・カテゴリは何もしない。超過したかどうかはここで決めて保存しておく
+def apply(deltas):
+    from .models import Budget
+
+    totals = category_deltas(deltas)
+    if len(totals) <= BULK_THRESHOLD:
+        for (month, category_id), total in totals.items():
+            Budget.objects.filter(month=month, category_id=category_id).update(**_spent_values(total))
+        return
+    # 取り込みなどでキーが多いときは、対象の予算を1回で読んでまとめて更新する
+    existing = Budget.objects.filter(
+        month__in={month for month, category_id in totals},
+        category_id__in={category_id for month, category_id in totals},
+    ).values_list('pk', 'month', 'category_id')
+    updates = [
+        Budget(pk=pk, **_spent_values(totals[month, category_id]))
+        for pk, month, category_id in existing
+        if (month, category_id) in totals
+    ]
+    if updates:
+        Budget.objects.bulk_update(updates, fields=['spent', 'overspent'])
+
+
+# 月・カテゴリの使った額を月次集計から合計する(予算を作る・変えるとき)
+def spent(month, category_id):
+    from .models import MonthlyRollup
+
+    return MonthlyRollup.objects.filter(month=month, category_id=category_id).aggregate(
+        total=Coalesce(Sum('total'), 0))['total']
+
+
+# 予算ごとの、月次集計から合計し直した使った額のサブクエリ
+def _rollup_spent():
+    from .models import MonthlyRollup
+
+    return Coalesce(Subquery(
+        MonthlyRollup.objects.filter(month=OuterRef('month'), category=OuterRef('category'))
+        .order_by().values('category').annotate(total=Sum('total')).values('total')), 0)
+
+
+# すべての予算の使った額と超過を月次集計から作り直し、予算の件数を返す
+# (月次集計の作り直しのあと、支払い方法の削除で月次集計がまとめて消えたあと)
+def rebuild():
+    from .models import Budget
+
+    spent = _rollup_spent()
+    return Budget.objects.update(spent=spent, overspent=GreaterThan(spent, F('amount')))
+
+
+# 使った額が月次集計と合わない予算(pk -> (予算の値, 月次集計の値))
+def compare():
+    from .models import Budget
+
+    return {
+        pk: (actual, expected)
+        for pk, actual, expected in Budget.objects.annotate(expected=_rollup_spent())
+        .filter(~Q(spent=F('expected'))).values_list('pk', 'spent', 'expected')
+    }
+
+
+# 月の予算の一覧(カテゴリ順)。(月, カテゴリ) の一意インデックスを引く1回のクエリで済む
+def for_month(month):
+    from .models import Budget
+
+    return list(Budget.objects.filter(month=month).select_related('category').order_by('category_id'))
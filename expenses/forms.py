@@ -1,10 +1,13 @@
-import io
-import csv
-import datetime
 from django import forms
+from django.db import transaction
 from django.core.validators import FileExtensionValidator
 from django.contrib.auth.forms import AuthenticationForm
-from .models import Record, Category, Payment
+from django.utils.choices import BaseChoiceIterator
+from imports.models import ImportJob
+from mysite.csv_import import CSVImportError
+from . import lookups, rollup
+from .importers import RecordImporter
+from .models import Record, Category, Payment, Budget, RecurringRecord
 
 class LoginForm(AuthenticationForm):
     """ログインフォーム"""
@@ -15,11 +18,113 @@ class LoginForm(AuthenticationForm):
             field.widget.attrs['class'] = 'form-control'
             field.widget.attrs['placeholder'] = field.label  # placeholderにフィールドのラベルを入れる
 
+class LookupChoiceIterator(BaseChoiceIterator):
+    """選択肢をDBではなくキャッシュした一覧(lookups)から作る"""
+
+    def __init__(self, field):
+        self.field = field
+
+    def __iter__(self):
+        if self.field.empty_label is not None:
+            yield ('', self.field.empty_label)
+        for obj in self.field.table.all():
+            yield (obj.pk, self.field.label_from_instance(obj))
+
+    def __len__(self):
+        return len(self.field.table.all()) + (self.field.empty_label is not None)
+
+    def __bool__(self):
+        return self.field.empty_label is not None or bool(self.field.table.all())
+
+
+class LookupChoiceField(forms.ModelChoiceField):
+    """カテゴリ・支払い方法の選択欄。表示も入力のチェックもキャッシュした一覧で行う"""
+    iterator = LookupChoiceIterator
+    tables = {Category: lookups.categories, Payment: lookups.payments}
+
+    @property
+    def table(self):
+        return self.tables[self.queryset.model]
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        try:
+            obj = self.table.get(int(value))
+        except (TypeError, ValueError):
+            obj = None
+        if obj is None:
+            raise forms.ValidationError(self.error_messages['invalid_choice'], code='invalid_choice')
+        return obj
+
 class RecordForm(forms.ModelForm):
 
     class Meta:
         model = Record
         fields = ('expense_date', 'amount', 'category', 'payment', 'note')
+        field_classes = {'category': LookupChoiceField, 'payment': LookupChoiceField}
+
+    def _get_validation_exclusions(self):
+        # カテゴリ・支払い方法はキャッシュした一覧で確かめたので、モデルの検証で1件ずつDBを引かない
+        return super()._get_validation_exclusions() | {'category', 'payment'}
+
+class BaseRecordBatchFormSet(forms.BaseModelFormSet):
+    """レコードのまとめて入力。入力のある行をすべて検証してから、1回の bulk_create で保存する"""
+
+    def __init__(self, *args, **kwargs):
+        # 既存のレコードは編集しないので、一覧を読みに行かない
+        kwargs.setdefault('queryset', Record.objects.none())
+        super().__init__(*args, **kwargs)
+
+    def save(self, commit=True):
+        # 初期値から変えていない行(空行)は保存しない
+        records = [form.save(commit=False) for form in self.extra_forms if form.has_changed()]
+        with transaction.atomic():
+            Record.objects.bulk_create(records)
+            rollup.apply_changes(added=[rollup.record_entry(record) for record in records])
+        return records
+
+RecordBatchFormSet = forms.modelformset_factory(
+    Record, form=RecordForm, formset=BaseRecordBatchFormSet, extra=10, max_num=100, validate_max=True)
+
+class RecordBulkForm(forms.Form):
+    """一覧で選んだレコードのまとめて編集・削除。編集では入力した項目だけを書き換える"""
+    # 検証ではpkだけを読む(保存するときにトランザクション内で読み直す)
+    records = forms.ModelMultipleChoiceField(queryset=Record.objects.only('pk'), widget=forms.MultipleHiddenInput)
+    action = forms.ChoiceField(label='操作', choices=[('edit', '編集'), ('delete', '削除')])
+    expense_date = forms.DateField(label='日付', required=False)
+    category = LookupChoiceField(label='カテゴリ', queryset=Category.objects.all(), required=False)
+    payment = LookupChoiceField(label='支払い方法', queryset=Payment.objects.all(), required=False)
+
+    fields_to_edit = ('expense_date', 'category', 'payment')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if cleaned_data.get('action') == 'edit' and not self.changed_fields():
+            raise forms.ValidationError('変更する項目を入力してください。')
+        return cleaned_data
+
+    def changed_fields(self):
+        return [name for name in self.fields_to_edit if self.cleaned_data.get(name) is not None]
+
+    # 選んだレコードを1回の bulk_update または delete で更新し、月次集計にも増減を反映する
+    # 増減はトランザクション内で読み直した行から作る(検証のあとに別のリクエストが変えた値で集計がずれないように)
+    def save(self):
+        pks = [record.pk for record in self.cleaned_data['records']]
+        with transaction.atomic():
+            records = list(Record.objects.select_for_update().filter(pk__in=pks).order_by('pk'))
+            removed = [rollup.record_entry(record) for record in records]
+            if self.cleaned_data['action'] == 'delete':
+                Record.objects.filter(pk__in=[record.pk for record in records]).delete()
+                rollup.apply_changes(removed=removed)
+            else:
+                fields = self.changed_fields()
+                for record in records:
+                    for name in fields:
+                        setattr(record, name, self.cleaned_data[name])
+                Record.objects.bulk_update(records, fields)
+                rollup.apply_changes(added=[rollup.record_entry(record) for record in records], removed=removed)
+        return records
 
 class CategoryForm(forms.ModelForm):
 
@@ -33,6 +138,69 @@ class PaymentForm(forms.ModelForm):
         model = Payment
         fields = ('name',)
 
+class RecurringRecordForm(forms.ModelForm):
+    """繰り返しのレコードの作成・編集
+
+    規則(頻度・間隔・開始日・終了日)を変えても作り終えた日(generated_until)は残し、新しい規則はその翌日以降にだけ使う。
+    作成済みの期間は作り直さないので、編集・削除したレコードが戻ったり、開始日を変えて重複したりしない。
+    """
+
+    class Meta:
+        model = RecurringRecord
+        fields = ('frequency', 'interval', 'start_date', 'end_date', 'amount', 'category', 'payment', 'note')
+        field_classes = {'category': LookupChoiceField, 'payment': LookupChoiceField}
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start_date, end_date = cleaned_data.get('start_date'), cleaned_data.get('end_date')
+        if start_date and end_date and start_date > end_date:
+            self.add_error('end_date', '終了日は開始日以降の日付を指定してください。')
+        return cleaned_data
+
+    def _get_validation_exclusions(self):
+        return super()._get_validation_exclusions() | {'category', 'payment'}
+
+class BudgetForm(forms.Form):
+    """月・カテゴリの予算の設定(その月・カテゴリの予算がすでにあれば金額を変える)"""
+    month = forms.DateField(
+        label='月', input_formats=['%Y-%m'],
+        widget=forms.DateInput(format='%Y-%m', attrs={'type': 'month'}))
+    category = LookupChoiceField(label='カテゴリ', queryset=Category.objects.all())
+    amount = forms.IntegerField(label='予算', min_value=0)
+
+    def save(self):
+        data = self.cleaned_data
+        budget = Budget.objects.filter(month=data['month'], category=data['category']).first()
+        if budget is None:
+            budget = Budget(month=data['month'], category=data['category'])
+        budget.amount = data['amount']
+        budget.save()
+        return budget
+
+class AggregateFilterForm(forms.Form):
+    """レコード集計の絞り込み(期間・カテゴリ・支払い方法)と集計の単位"""
+    date_from = forms.DateField(label='開始日', required=False)
+    date_to = forms.DateField(label='終了日', required=False)
+    categories = forms.TypedMultipleChoiceField(
+        label='カテゴリ', required=False, coerce=int,
+        choices=lambda: [(category.pk, category.name) for category in lookups.categories.all()],
+        widget=forms.CheckboxSelectMultiple)
+    payments = forms.TypedMultipleChoiceField(
+        label='支払い方法', required=False, coerce=int,
+        choices=lambda: [(payment.pk, payment.name) for payment in lookups.payments.all()],
+        widget=forms.CheckboxSelectMultiple)
+    granularity = forms.ChoiceField(
+        label='集計の単位', required=False,
+        choices=[('day', '日'), ('week', '週'), ('month', '月'), ('year', '年')])
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from, date_to = cleaned_data.get('date_from'), cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            self.add_error('date_to', '終了日は開始日以降の日付を指定してください。')
+        cleaned_data['granularity'] = cleaned_data.get('granularity') or 'month'
+        return cleaned_data
+
 class CSVUploadForm(forms.Form):
     file = forms.FileField(
         label='CSVファイル',
@@ -40,41 +208,14 @@ class CSVUploadForm(forms.Form):
         validators=[FileExtensionValidator(allowed_extensions=['csv'])]
     )
 
-    def clean_file(self):
-        file = self.cleaned_data['file']
-        # csv.readerに渡すため、TextIOWrapperでテキストモードなファイルに変換
-        csv_file = io.TextIOWrapper(file, encoding='utf-8')
-        reader = csv.reader(csv_file)
-        # 各行から作った保存前のモデルインスタンスを保管するリスト
-        self._instances_create = []
-        self._instances_update = []
+    def save(self):
+        """CSVを取り込んで結果(ImportResult)を返す。ファイル全体が読めないときはエラーを付けてNoneを返す"""
         try:
-            for row in reader:
-                if row[0] == "":
-                    post = Record(
-                        created_date = datetime.datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S %z'),
-                        expense_date = datetime.datetime.strptime(row[2], '%Y-%m-%d'),
-                        amount = row[3],
-                        category = Category.objects.get(name=row[4]),
-                        payment = Payment.objects.get(name=row[5]),
-                        note = row[6]
-                        )
-                    self._instances_create.append(post)
-                else:
-                    post = Record(
-                        pk=row[0],
-                        created_date = datetime.datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S %z'),
-                        expense_date = datetime.datetime.strptime(row[2], '%Y-%m-%d'),
-                        amount = row[3],
-                        category = Category.objects.get(name=row[4]),
-                        payment = Payment.objects.get(name=row[5]),
-                        note = row[6]
-                        )
-                    self._instances_update.append(post)
-        except UnicodeDecodeError:
-                raise forms.ValidationError('ファイルのエンコーディングや、正しいCSVファイルか確認ください。')
-        return file
+            return RecordImporter().run(self.cleaned_data['file'])
+        except CSVImportError as e:
+            self.add_error('file', str(e))
+            return None
 
-    def save(self):
-        Record.objects.bulk_create(self._instances_create, ignore_conflicts=True)
-        Record.objects.bulk_update(self._instances_update, fields=['created_date', 'expense_date', 'amount', 'category', 'payment', 'note'])
+    def enqueue(self):
+        """取り込みをバックグラウンドのジョブとして登録する"""
+        return ImportJob.objects.create(kind='expenses.record', file=self.cleaned_data['file'])
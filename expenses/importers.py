@@ -0,0 +1,48 @@
+import datetime
+from mysite.csv_import import CSVImporter, RowError
+from . import lookups, rollup
+from .models import Record
+
+
+# レコードのCSV取り込み
+# 列: pk(新規は空), 登録日時, 日付, 金額, カテゴリ名, 支払い方法名, 用途
+class RecordImporter(CSVImporter):
+    model = Record
+    update_fields = ['created_date', 'expense_date', 'amount', 'category', 'payment', 'note']
+
+    def load_lookups(self):
+        # 名前->pkの辞書はキャッシュした一覧から取る(同名はpkの小さい方)
+        self.categories = lookups.categories.pks_by_name()
+        self.payments = lookups.payments.pks_by_name()
+
+    def build(self, row):
+        category_id = self.categories.get(row[4])
+        if category_id is None:
+            raise RowError('カテゴリ「%s」が見つかりません。' % row[4])
+        payment_id = self.payments.get(row[5])
+        if payment_id is None:
+            raise RowError('支払い方法「%s」が見つかりません。' % row[5])
+        return Record(
+            pk=int(row[0]) if row[0] else None,
+            created_date=datetime.datetime.strptime(row[1], '%Y-%m-%d %H:%M:%S %z'),
+            # エクスポートでは日付のないレコードは空欄になる
+            expense_date=datetime.datetime.strptime(row[2], '%Y-%m-%d').date() if row[2] else None,
+            amount=int(row[3]),
+            category_id=category_id,
+            payment_id=payment_id,
+            note=row[6],
+        )
+
+    # 更新対象の、更新前の値(月次集計から差し引く分)
+    def existing(self, pks):
+        return {
+            pk: rollup.entry(*values)
+            for pk, *values in Record.objects.filter(pk__in=pks).values_list(
+                'pk', 'expense_date', 'category_id', 'payment_id', 'amount')
+        }
+
+    def after_write(self, created, updated, existing):
+        rollup.apply_changes(
+            added=[rollup.record_entry(record) for record in created + updated],
+            removed=[existing[record.pk] for record in updated],
+        )
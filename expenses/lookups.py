@@ -0,0 +1,64 @@
+import uuid
+from django.core.cache import cache
+
+
+class LookupTable:
+    """カテゴリ・支払い方法のような、行数が少なくほとんど変わらない表のプロセス内キャッシュ
+
+    一覧はプロセスごとにメモリに持ち、共有キャッシュにはバージョンだけを置く。
+    保存・削除されると invalidate() でバージョンが変わり、どのプロセスも次に使うときに読み直す。
+    """
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.version_key = 'expenses:lookup:%s' % model_name
+        self._version = None
+        self._objects = []
+        self._by_pk = {}
+        self._by_name = {}
+
+    @property
+    def model(self):
+        from django.apps import apps
+        return apps.get_model('expenses', self.model_name)
+
+    def _current_version(self):
+        version = cache.get(self.version_key)
+        if version is None:
+            cache.add(self.version_key, uuid.uuid4().hex, None)
+            version = cache.get(self.version_key)
+        return version
+
+    def _load(self):
+        version = self._current_version()
+        if version != self._version:
+            objects = list(self.model.objects.order_by('pk'))
+            self._by_pk = {obj.pk: obj for obj in objects}
+            # 同名があるときはpkの小さい方
+            self._by_name = {}
+            for obj in objects:
+                self._by_name.setdefault(obj.name, obj.pk)
+            self._objects = objects
+            self._version = version
+
+    # pk順の一覧(モデルインスタンスは共有なので変更しないこと)
+    def all(self):
+        self._load()
+        return self._objects
+
+    def get(self, pk):
+        self._load()
+        return self._by_pk.get(pk)
+
+    # 名前 -> pk の辞書
+    def pks_by_name(self):
+        self._load()
+        return self._by_name
+
+    def invalidate(self):
+        cache.set(self.version_key, uuid.uuid4().hex, None)
+        self._version = None
+
+
+categories = LookupTable('Category')
+payments = LookupTable('Payment')
@@ -0,0 +1,24 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from expenses import recurrence
+
+
+class Command(BaseCommand):
+    help = '繰り返しのレコード(RecurringRecord)から、指定した日までに発生日を迎えたレコードをまとめて作ります。'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--until',
+            help='この日(YYYY-MM-DD)までの発生日のレコードを作る(省略時は今日)',
+        )
+
+    def handle(self, *args, **options):
+        until = timezone.localdate()
+        if options['until']:
+            try:
+                until = datetime.datetime.strptime(options['until'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('--until は YYYY-MM-DD の形式で指定してください。')
+        records = recurrence.generate(until)
+        self.stdout.write(self.style.SUCCESS('Created %d records up to %s.' % (len(records), until.isoformat())))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+from expenses import archive, budgets, rollup
+from expenses.models import Record, MonthlyRollup
+
+
+class Command(BaseCommand):
+    help = ('月次集計テーブル(MonthlyRollup)と予算の使った額(Budget.spent)をレコードから作り直し、'
+            '元データと一致するか確認します。')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help='作り直さずに、集計テーブルと元レコードの差分だけを確認する',
+        )
+
+    def handle(self, *args, **options):
+        if not options['check']:
+            count = rollup.rebuild(Record, MonthlyRollup)
+            budget_count = budgets.rebuild()
+            archive.invalidate_all()
+            self.stdout.write('Rebuilt %d rollup rows and %d budgets.' % (count, budget_count))
+
+        mismatches = rollup.compare(Record, MonthlyRollup)
+        for (month, category_id, payment_id), (actual, expected) in sorted(mismatches.items()):
+            self.stderr.write('%s category=%s payment=%s: rollup=%s records=%s' % (
+                month.strftime('%Y-%m'), category_id, payment_id, actual, expected))
+        budget_mismatches = budgets.compare()
+        for pk, (actual, expected) in sorted(budget_mismatches.items()):
+            self.stderr.write('budget=%s: spent=%s rollup=%s' % (pk, actual, expected))
+        if mismatches:
+            raise CommandError('%d rollup rows do not match the records.' % len(mismatches))
+        if budget_mismatches:
+            raise CommandError('%d budgets do not match the rollup.' % len(budget_mismatches))
+        self.stdout.write(self.style.SUCCESS('Rollup and budgets match the records.'))
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.28 on 2026-10-18 18:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_rollup(apps, schema_editor):
+    from expenses import rollup
+    rollup.rebuild(apps.get_model('expenses', 'Record'), apps.get_model('expenses', 'MonthlyRollup'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0005_remove_record_author'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('total', models.IntegerField(default=0)),
+                ('count', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='expenses.Category')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='expenses.Payment')),
+            ],
+            options={
+                'unique_together': {('month', 'category', 'payment')},
+            },
+        ),
+        migrations.RunPython(build_rollup, migrations.RunPython.noop),
+    ]
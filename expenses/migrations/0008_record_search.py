@@ -0,0 +1,21 @@
+from django.db import migrations
+from expenses.search import record_index
+
+
+def install(apps, schema_editor):
+    record_index.install(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    record_index.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0007_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
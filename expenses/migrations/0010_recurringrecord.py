@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-18 19:28
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses', '0009_budget'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='occurrence',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='RecurringRecord',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frequency', models.CharField(choices=[('daily', '日'), ('weekly', '週'), ('monthly', '月'), ('yearly', '年')], default='monthly', max_length=10)),
+                ('interval', models.PositiveIntegerField(default=1, validators=[django.core.validators.MinValueValidator(1)])),
+                ('start_date', models.DateField()),
+                ('end_date', models.DateField(blank=True, null=True)),
+                ('amount', models.IntegerField()),
+                ('note', models.CharField(max_length=200)),
+                ('generated_until', models.DateField(blank=True, editable=False, null=True)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recurring_records', to='expenses.category')),
+                ('payment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recurring_records', to='expenses.payment')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='record',
+            name='recurrence',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='records', to='expenses.recurringrecord'),
+        ),
+        migrations.AddConstraint(
+            model_name='record',
+            constraint=models.UniqueConstraint(condition=models.Q(('recurrence__isnull', False)), fields=('recurrence', 'occurrence'), name='record_occurrence_unique'),
+        ),
+    ]
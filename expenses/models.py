@@ -1,7 +1,9 @@
 import datetime
 from django.conf import settings
-from django.db import models
+from django.core.validators import MinValueValidator
+from django.db import models, transaction
 from django.utils import timezone
+from . import rollup
 
 
 class Record(models.Model):
@@ -11,10 +13,80 @@ class Record(models.Model):
     category = models.ForeignKey('expenses.Category', on_delete=models.CASCADE, related_name='records')
     payment = models.ForeignKey('expenses.Payment', on_delete=models.CASCADE, related_name='records')
     note = models.CharField(max_length=200)
+    # 繰り返しのレコードから作ったときの、元の繰り返しと発生日(日付を編集しても変わらない)
+    # recurrence の検索には下の一意制約のインデックスを使う
+    recurrence = models.ForeignKey('expenses.RecurringRecord', on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='records', db_index=False)
+    occurrence = models.DateField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # レコード一覧の並び順(日付・登録日時の新しい順)
+            models.Index(fields=['-expense_date', '-created_date'], name='record_date_idx'),
+        ]
+        constraints = [
+            # 同じ繰り返しの同じ発生日のレコードは1件だけ(繰り返しのレコードの作成を何度実行しても重複しない)
+            models.UniqueConstraint(fields=['recurrence', 'occurrence'], condition=models.Q(recurrence__isnull=False),
+                                    name='record_occurrence_unique'),
+        ]
 
     def __str__(self):
         return self.expense_date.strftime('%Y-%m-%d') + ': ' + str(self.amount) + ': ' + self.note
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # 編集時に月次集計から差し引けるよう、読み込んだ時点の値を覚えておく
+        if not instance.get_deferred_fields():
+            instance._rollup_entry = rollup.record_entry(instance)
+        return instance
+
+    # DB上の現在の値から作った月次集計エントリ
+    def _stored_rollup_entry(self):
+        if hasattr(self, '_rollup_entry'):
+            return self._rollup_entry
+        if self.pk is None:
+            return None
+        stored = Record.objects.filter(pk=self.pk).values_list(
+            'expense_date', 'category_id', 'payment_id', 'amount').first()
+        return rollup.entry(*stored) if stored else None
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            previous = self._stored_rollup_entry()
+            super().save(*args, **kwargs)
+            current = rollup.record_entry(self)
+            rollup.apply_changes(added=[current], removed=[previous])
+        self._rollup_entry = current
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            previous = self._stored_rollup_entry()
+            result = super().delete(*args, **kwargs)
+            rollup.apply_changes(removed=[previous])
+        self._rollup_entry = None
+        return result
+
+# 毎月の家賃・サブスクリプションなどの繰り返しのレコード
+# generate_recurring コマンドで、発生日ごとの Record をまとめて作る
+class RecurringRecord(models.Model):
+    FREQUENCY_CHOICES = [('daily', '日'), ('weekly', '週'), ('monthly', '月'), ('yearly', '年')]
+
+    frequency = models.CharField(max_length=10, choices=FREQUENCY_CHOICES, default='monthly')
+    # frequency のいくつごとか(2なら隔月など)
+    interval = models.PositiveIntegerField(default=1, validators=[MinValueValidator(1)])
+    start_date = models.DateField()
+    end_date = models.DateField(blank=True, null=True)
+    amount = models.IntegerField()
+    category = models.ForeignKey('expenses.Category', on_delete=models.CASCADE, related_name='recurring_records')
+    payment = models.ForeignKey('expenses.Payment', on_delete=models.CASCADE, related_name='recurring_records')
+    note = models.CharField(max_length=200)
+    # レコードを作り終えた最後の日。次はこの翌日以降の発生日だけを作る
+    generated_until = models.DateField(blank=True, null=True, editable=False)
+
+    def __str__(self):
+        return self.get_frequency_display() + ': ' + str(self.amount) + ': ' + self.note
+
 class Category(models.Model):
     name = models.CharField(max_length=200)
 
@@ -26,3 +98,52 @@ class Payment(models.Model):
     
     def __str__(self):
         return self.name
+
+# 月・カテゴリ・支払い方法ごとの金額と件数(Recordの保存・削除・インポート時に更新する)
+class MonthlyRollup(models.Model):
+    month = models.DateField()
+    category = models.ForeignKey('expenses.Category', on_delete=models.CASCADE, related_name='rollups')
+    payment = models.ForeignKey('expenses.Payment', on_delete=models.CASCADE, related_name='rollups')
+    total = models.IntegerField(default=0)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('month', 'category', 'payment')
+
+    def __str__(self):
+        return self.month.strftime('%Y-%m') + ': ' + str(self.total)
+
+# 月・カテゴリごとの予算
+# spent(使った額)と overspent(予算を超えたか)は、Recordの保存・削除・インポート時に月次集計と同じ
+# トランザクションで更新する(表示のたびに合計しない)
+class Budget(models.Model):
+    month = models.DateField()
+    category = models.ForeignKey('expenses.Category', on_delete=models.CASCADE, related_name='budgets')
+    amount = models.IntegerField()
+    spent = models.IntegerField(default=0, editable=False)
+    overspent = models.BooleanField(default=False, editable=False)
+
+    class Meta:
+        unique_together = ('month', 'category')
+
+    def __str__(self):
+        return self.month.strftime('%Y-%m') + ': ' + str(self.category) + ': ' + str(self.amount)
+
+    @property
+    def remaining(self):
+        return self.amount - self.spent
+
+    # 予算を超えた額
+    @property
+    def over(self):
+        return self.spent - self.amount
+
+    def save(self, *args, **kwargs):
+        from . import budgets
+
+        self.month = self.month.replace(day=1)
+        with transaction.atomic():
+            # 使った額は保存のたびに月次集計から合計し直す(読み込んだ後に増減があっても上書きしない)
+            self.spent = budgets.spent(self.month, self.category_id)
+            self.overspent = self.spent > self.amount
+            super().save(*args, **kwargs)
@@ -0,0 +1,162 @@
+import base64
+import json
+from django.db import connection
+from django.db.models import Q
+from django.utils.dateparse import parse_date, parse_datetime
+
+
+class InvalidCursor(Exception):
+    """ページ位置のトークンが読み取れない"""
+
+
+class CursorPage:
+    """カーソル方式の1ページ分。前後のページへはトークン(next_cursor/previous_cursor)で移動する"""
+
+    def __init__(self, object_list, next_cursor, previous_cursor, count=None):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        # 全件数(数えない設定のときはNone、推定値のときは概数)
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+def encode_cursor(direction, key):
+    data = json.dumps([direction] + key, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    try:
+        direction, expense_date, created_date, pk = json.loads(
+            base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+        key = (
+            parse_date(expense_date) if expense_date is not None else None,
+            parse_datetime(created_date),
+            int(pk),
+        )
+    except (ValueError, TypeError):
+        raise InvalidCursor(token)
+    if direction not in ('next', 'prev') or key[1] is None:
+        raise InvalidCursor(token)
+    return direction, key
+
+
+# テーブル全体の件数の概数。取れないときはNone
+def estimated_count(model):
+    table = model._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+            row = cursor.fetchone()
+            return int(row[0]) if row and row[0] >= 0 else None
+        if connection.vendor == 'sqlite':
+            # ANALYZE済みなら統計情報、なければ最大のrowid(削除が少なければ件数に近い)
+            try:
+                cursor.execute('SELECT stat FROM sqlite_stat1 WHERE tbl = %s AND idx IS NULL', [table])
+                row = cursor.fetchone()
+            except Exception:
+                row = None
+            if row:
+                return int(row[0].split()[0])
+            cursor.execute('SELECT MAX(rowid) FROM %s' % connection.ops.quote_name(table))
+            return cursor.fetchone()[0] or 0
+    return None
+
+
+class CursorPaginator:
+    """(expense_date, created_date, pk) の新しい順で、前のページの最後の行より後ろを読むページ送り
+
+    OFFSETを使わないので、何ページ目でもインデックスを必要な行数だけ読めばよい。
+    count は 'exact'(COUNT(*)する)・'estimate'(絞り込みがなければ概数)・'none'(数えない)のいずれか。
+    """
+    ordering = ('-expense_date', '-created_date', '-pk')
+    reverse_ordering = ('expense_date', 'created_date', 'pk')
+
+    def __init__(self, queryset, per_page, count='none'):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.count_mode = count
+
+    # 行の並び順のキー。values() の辞書('expense_date'・'created_date'・'pk' を含む)でもよい
+    @staticmethod
+    def key(record):
+        if isinstance(record, dict):
+            expense_date, created_date, pk = record['expense_date'], record['created_date'], record['pk']
+        else:
+            expense_date, created_date, pk = record.expense_date, record.created_date, record.pk
+        return [
+            expense_date.isoformat() if expense_date else None,
+            created_date.isoformat(),
+            pk,
+        ]
+
+    # 並び順で key より後ろ(after=False なら前)にある行の条件を、並び順に沿った区間のリストで返す
+    # 日付なしの行を OR でつなぐとインデックス順に読めなくなるので、別の区間として続けて読む
+    @staticmethod
+    def beyond(key, after=True):
+        expense_date, created_date, pk = key
+        lt, lte = ('lt', 'lte') if after else ('gt', 'gte')
+        tail = Q(**{'created_date__' + lt: created_date}) | Q(created_date=created_date, **{'pk__' + lt: pk})
+        # 日付なしの行が新しい順のどちら端に並ぶかはDBによる(SQLiteは最後、PostgreSQLは最初)
+        nulls_beyond = after != connection.features.nulls_order_largest
+        if expense_date is None:
+            segments = [Q(expense_date__isnull=True) & tail]
+            return segments if nulls_beyond else segments + [Q(expense_date__isnull=False)]
+        # 先頭の「日付 <= カーソルの日付」でインデックスの途中から読み始められるようにする
+        segments = [Q(**{'expense_date__' + lte: expense_date}) & (Q(**{'expense_date__' + lt: expense_date}) | tail)]
+        return segments + [Q(expense_date__isnull=True)] if nulls_beyond else segments
+
+    # 区間を順に読み、limit件になったら止める
+    @staticmethod
+    def fetch(queryset, segments, ordering, limit):
+        rows = []
+        for segment in segments:
+            rows += queryset.filter(segment).order_by(*ordering)[:limit - len(rows)]
+            if len(rows) >= limit:
+                break
+        return rows
+
+    def count(self):
+        if self.count_mode == 'exact':
+            return self.queryset.count()
+        if self.count_mode == 'estimate' and not self.queryset.query.where:
+            return estimated_count(self.queryset.model)
+        return None
+
+    def page(self, token=None):
+        queryset = self.queryset.order_by()
+        if token:
+            direction, key = decode_cursor(token)
+        else:
+            direction, key = 'next', None
+
+        if direction == 'next':
+            segments = self.beyond(key, after=True) if key is not None else [Q()]
+            rows = self.fetch(queryset, segments, self.ordering, self.per_page + 1)
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_next, has_previous = has_more, key is not None
+        else:
+            rows = self.fetch(queryset, self.beyond(key, after=False), self.reverse_ordering, self.per_page + 1)
+            has_more = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            has_next, has_previous = True, has_more
+
+        next_cursor = encode_cursor('next', self.key(rows[-1])) if has_next and rows else None
+        previous_cursor = encode_cursor('prev', self.key(rows[0])) if has_previous and rows else None
+        return CursorPage(rows, next_cursor, previous_cursor, self.count())
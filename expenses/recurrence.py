@@ -0,0 +1,94 @@
+import calendar
+import datetime
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from . import rollup
+
+# 日・週ごとの繰り返しの1回分の日数
+DAYS = {'daily': 1, 'weekly': 7}
+# 月・年ごとの繰り返しの1回分の月数
+MONTHS = {'monthly': 1, 'yearly': 12}
+# generated_until の bulk_update の1回の行数(CASE WHEN が長くなりすぎないように)
+GENERATED_BATCH_SIZE = 500
+
+
+# start から months か月後の同じ日(その月にない日は月末)
+def add_months(start, months):
+    index = start.year * 12 + start.month - 1 + months
+    year, month = divmod(index, 12)
+    month += 1
+    return datetime.date(year, month, min(start.day, calendar.monthrange(year, month)[1]))
+
+
+# 繰り返しの、date_from から date_to まで(両端を含む)の発生日
+# 最初の発生日は start_date からの回数を計算で求めるので、長い期間でも途中を数え上げない
+def occurrences(template, date_from, date_to):
+    date_from = max(date_from, template.start_date)
+    if template.end_date is not None:
+        date_to = min(date_to, template.end_date)
+    if date_from > date_to:
+        return
+    if template.frequency in DAYS:
+        step = DAYS[template.frequency] * template.interval
+        n = -(-(date_from - template.start_date).days // step)
+        day = template.start_date + datetime.timedelta(days=n * step)
+        while day <= date_to:
+            yield day
+            day += datetime.timedelta(days=step)
+    else:
+        step = MONTHS[template.frequency] * template.interval
+        start = template.start_date
+        months = (date_from.year - start.year) * 12 + date_from.month - start.month
+        n = max(-(-months // step) - 1, 0)
+        while True:
+            day = add_months(start, n * step)
+            if day > date_to:
+                return
+            if day >= date_from:
+                yield day
+            n += 1
+
+
+# until までに発生日を迎えた繰り返しのレコードを作り、作ったレコードのリストを返す
+# 繰り返しごとに前回作り終えた日(generated_until)の翌日から作るので、何度実行してもよい。
+# すでにある (繰り返し, 発生日) のレコードは作らない(Record の一意制約の組み合わせ)
+# レコードは1回の bulk_create で作り、月次集計・予算にも同じトランザクションで反映する
+def generate(until):
+    from .models import Record, RecurringRecord
+
+    with transaction.atomic():
+        # 作り終えていない繰り返し(終了日まで作り終えたものは読まない)
+        templates = list(RecurringRecord.objects.filter(
+            Q(generated_until__isnull=True)
+            | Q(generated_until__lt=until) & (Q(end_date__isnull=True) | Q(generated_until__lt=F('end_date'))),
+            start_date__lte=until,
+        ))
+        if not templates:
+            return []
+        pending = []
+        for template in templates:
+            date_from = template.start_date
+            if template.generated_until is not None:
+                date_from = max(date_from, template.generated_until + datetime.timedelta(days=1))
+            for day in occurrences(template, date_from, until):
+                pending.append((template, day))
+            template.generated_until = until if template.end_date is None else min(until, template.end_date)
+        # 作り終えた日を手で戻した場合などのために、すでにある発生日を1回のクエリで読んで除く
+        existing = set()
+        if pending:
+            existing = set(Record.objects.filter(
+                recurrence__isnull=False, occurrence__gte=min(day for template, day in pending), occurrence__lte=until,
+            ).values_list('recurrence_id', 'occurrence'))
+        # 登録日時は実行した時刻で揃える
+        now = timezone.now()
+        records = [
+            Record(created_date=now, expense_date=day, occurrence=day, recurrence_id=template.pk, amount=template.amount,
+                   category_id=template.category_id, payment_id=template.payment_id, note=template.note)
+            for template, day in pending
+            if (template.pk, day) not in existing
+        ]
+        Record.objects.bulk_create(records)
+        rollup.apply_changes(added=[rollup.record_entry(record) for record in records])
+        RecurringRecord.objects.bulk_update(templates, ['generated_until'], batch_size=GENERATED_BATCH_SIZE)
+    return records
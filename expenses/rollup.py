@@ -0,0 +1,150 @@
+import datetime
+from collections import defaultdict
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from .aggregates import monthly_amounts
+
+
+# レコード1件が月次集計のどこにいくらを足すかを表すタプル
+# (月初日, カテゴリpk, 支払い方法pk, 金額)。日付がないレコードは集計対象外なのでNone
+def entry(expense_date, category_id, payment_id, amount):
+    if expense_date is None:
+        return None
+    month = datetime.date(expense_date.year, expense_date.month, 1)
+    return (month, category_id, payment_id, int(amount))
+
+
+def record_entry(record):
+    return entry(record.expense_date, record.category_id, record.payment_id, record.amount)
+
+
+# 追加・削除されたエントリから、キーごとの(金額, 件数)の増減をまとめる
+def collect(added=(), removed=()):
+    deltas = defaultdict(lambda: [0, 0])
+    for item in added:
+        if item is not None:
+            delta = deltas[item[:3]]
+            delta[0] += item[3]
+            delta[1] += 1
+    for item in removed:
+        if item is not None:
+            delta = deltas[item[:3]]
+            delta[0] -= item[3]
+            delta[1] -= 1
+    return {key: delta for key, delta in deltas.items() if delta != [0, 0]}
+
+
+# 増減を集計テーブルに反映する。呼び出し側のトランザクション内で実行すること
+# キーが少ないとき(1件の保存・削除)はキーごとにUPDATEし、多いとき(取り込み)はまとめて更新する
+# 同じ増減で月・カテゴリの予算の使った額も更新する
+# コミットされたら、合計の変わった月のアーカイブのキャッシュを消す
+def apply(deltas):
+    from . import archive, budgets
+
+    if len(deltas) <= BULK_THRESHOLD:
+        for key, delta in deltas.items():
+            _apply_one(key, delta)
+    else:
+        _apply_bulk(deltas)
+    budgets.apply(deltas)
+    if deltas:
+        months = {month for month, category_id, payment_id in deltas}
+        transaction.on_commit(lambda: archive.invalidate(months))
+
+
+# これより多いキーを一度に反映するときは bulk_update/bulk_create を使う
+BULK_THRESHOLD = 3
+
+
+def _apply_one(key, delta):
+    from .models import MonthlyRollup
+
+    (month, category_id, payment_id), (total, count) = key, delta
+    rollups = MonthlyRollup.objects.filter(month=month, category_id=category_id, payment_id=payment_id)
+    updated = rollups.update(total=F('total') + total, count=F('count') + count)
+    if not updated:
+        try:
+            with transaction.atomic():
+                MonthlyRollup.objects.create(
+                    month=month, category_id=category_id, payment_id=payment_id,
+                    total=total, count=count)
+        except IntegrityError:
+            # 他のリクエストが同じキーを先に作った場合は加算し直す
+            rollups.update(total=F('total') + total, count=F('count') + count)
+    if count < 0:
+        # レコードがなくなった月は集計から消す
+        rollups.filter(count__lte=0).delete()
+
+
+def _apply_bulk(deltas):
+    from .models import MonthlyRollup
+
+    # 対象の月・カテゴリ・支払い方法を含む行を1回で読み、キーに当てはまるものだけ使う
+    keys = list(deltas)
+    existing = {
+        (month, category_id, payment_id): pk
+        for pk, month, category_id, payment_id in MonthlyRollup.objects.filter(
+            month__in={key[0] for key in keys},
+            category_id__in={key[1] for key in keys},
+            payment_id__in={key[2] for key in keys},
+        ).values_list('pk', 'month', 'category_id', 'payment_id')
+        if (month, category_id, payment_id) in deltas
+    }
+    # 既存の行は F() で加算する(同時に更新されても増減が失われない)
+    updates = [
+        MonthlyRollup(pk=pk, total=F('total') + deltas[key][0], count=F('count') + deltas[key][1])
+        for key, pk in existing.items()
+    ]
+    if updates:
+        MonthlyRollup.objects.bulk_update(updates, fields=['total', 'count'])
+    missing = {key: delta for key, delta in deltas.items() if key not in existing}
+    if missing:
+        try:
+            with transaction.atomic():
+                MonthlyRollup.objects.bulk_create([
+                    MonthlyRollup(month=month, category_id=category_id, payment_id=payment_id,
+                                  total=total, count=count)
+                    for (month, category_id, payment_id), (total, count) in missing.items()])
+        except IntegrityError:
+            # 他のリクエストが先に作ったキーがあれば、1件ずつ反映し直す
+            for key, delta in missing.items():
+                _apply_one(key, delta)
+    if any(count < 0 for total, count in deltas.values()):
+        MonthlyRollup.objects.filter(pk__in=list(existing.values()), count__lte=0).delete()
+
+
+def apply_changes(added=(), removed=()):
+    apply(collect(added, removed))
+
+
+# 元レコードから集計し直した値(キー -> (金額, 件数))
+def aggregate_records(records):
+    return {
+        (row['month'], row['category'], row['payment']): (row['total'], row['count'])
+        for row in monthly_amounts(records)
+    }
+
+
+# 集計テーブルを元レコードから作り直す
+def rebuild(record_model, rollup_model):
+    expected = aggregate_records(record_model.objects.all())
+    with transaction.atomic():
+        rollup_model.objects.all().delete()
+        rollup_model.objects.bulk_create(
+            [rollup_model(month=month, category_id=category_id, payment_id=payment_id, total=total, count=count)
+             for (month, category_id, payment_id), (total, count) in expected.items()])
+    return len(expected)
+
+
+# 集計テーブルと元レコードの差分を返す(キー -> (集計テーブルの値, 元レコードの値))
+def compare(record_model, rollup_model):
+    expected = aggregate_records(record_model.objects.all())
+    actual = {
+        (row['month'], row['category'], row['payment']): (row['total'], row['count'])
+        for row in rollup_model.objects.values('month', 'category', 'payment', 'total', 'count')
+    }
+    return {
+        key: (actual.get(key), expected.get(key))
+        for key in set(expected) | set(actual)
+        if actual.get(key) != expected.get(key)
+    }
@@ -0,0 +1,4 @@
+from mysite.search import FullTextIndex
+
+# レコードの用途(note)の全文検索インデックス
+record_index = FullTextIndex('expenses_record', ['note'])
@@ -0,0 +1,36 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from . import archive, budgets, lookups
+from .models import Category, Payment
+
+
+# カテゴリ・支払い方法が変わったら、キャッシュした一覧を読み直させる
+# バージョンはコミットの後に変える(コミット前に別のプロセスが古い行を新しいバージョンで覚えないように)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_categories(sender, **kwargs):
+    transaction.on_commit(lookups.categories.invalidate)
+
+
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def invalidate_payments(sender, **kwargs):
+    transaction.on_commit(lookups.payments.invalidate)
+
+
+# カテゴリ・支払い方法を削除すると、そのレコードと月次集計もまとめて消えるので、アーカイブの合計を全部消す
+@receiver(post_delete, sender=Category)
+@receiver(post_delete, sender=Payment)
+def invalidate_archive(sender, **kwargs):
+    transaction.on_commit(archive.invalidate_all)
+
+
+# 支払い方法を削除すると、そのレコードと月次集計が(月次集計の増減を通さずに)まとめて消えるので、
+# 予算の使った額を月次集計から作り直す。カテゴリの予算はカテゴリと一緒に消えるので不要
+# 作り直しはすべての予算を読むので、コミットの後に1回だけ行う(同じトランザクションで何件消しても1回)
+@receiver(post_delete, sender=Payment)
+def rebuild_budgets(sender, using, **kwargs):
+    connection = transaction.get_connection(using)
+    if not any(func is budgets.rebuild for sids, func, robust in connection.run_on_commit):
+        transaction.on_commit(budgets.rebuild, using=using)
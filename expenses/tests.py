@@ -1,67 +1,965 @@
-from . import views
-from .models import Record, Category, Payment
-from django.db import models
-from django.db.models import Max, Sum
-
-from django.test import TestCase
-
-# リストの重複を消してソートする関数
-def sorted_unique_list(lst):
-    return sorted(list(set(lst)))
-
-# レコード集計用、フィルタ&合計関数
-def filter_sum(amounts, month, key=None, key_pk=None):
-    amount_filtered_month = filter(lambda x: x['expense_date'].strftime('%Y-%m') == month, amounts)
-    if key == None:
-        return sum(map(lambda x: x['total_price'], amount_filtered_month))
-    else:
-        amount_filtered = filter(lambda x: (x[key] == key_pk), amount_filtered_month)
-        return sum(map(lambda x: x['total_price'], amount_filtered))
-
-# 月+αでの金額集計用関数
-def amount_aggregate(months, amounts, key, contents):
-    return_dicts = []
-    for month in months:
-        dict_month = {'month': month, 'contents': []}
-        for content in contents:
-            dict_month['contents'].append({'con_pk': content.pk,
-             'con_name': content.name,
-             'amount': filter_sum(amounts, month, key, content.pk)})
-        return_dicts.append(dict_month)
-    return return_dicts
-
-# レコード集計画面
-def record_aggregate():
-    records = Record.objects.all()
-    categories = Category.objects.all()
-    payments = Payment.objects.all()
-    
-    # 「日、カテゴリ、支払い方法」で金額をまとめる
-    amounts = (
-        records
-        .values('expense_date', 'category', 'payment')
-        .annotate(total_price=Sum('amount'))
-    )
-    
-    # 集計用の月一覧
-    months = sorted_unique_list([amount['expense_date'].strftime('%Y-%m') for amount in amounts])
-    # 月で金額を集計
-    amounts_per_m = [{'month': month, 'amount': filter_sum(amounts, month)} for month in months]
-    # 月・カテゴリで金額を集計
-    amounts_per_m_c = amount_aggregate(months, amounts, 'category', categories)
-    # 月・支払い方法で金額を集計
-    amounts_per_m_p = amount_aggregate(months, amounts, 'payment', payments)
-
-    context = {
-        'amounts': amounts,
-        'categories': categories,
-        'payments': payments,
-        'amounts_per_m': amounts_per_m,
-        'amounts_per_m_c': amounts_per_m_c,
-        'amounts_per_m_p': amounts_per_m_p,
-    }
-    # return context
-    return amounts_per_m
-
-ret = record_aggregate()
-print(ret)
+import base64
+import datetime
+import io
+import json
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from benchmarks import data
+from imports.models import ImportJob
+from mysite.testing import CleanCacheTestCase, QueryBudgetTestCase, streaming_body
+from mysite.deletion import bulk_delete
+from . import archive, budgets, lookups, recurrence, rollup
+from .forms import RecordBulkForm
+from .importers import RecordImporter
+from .pagination import CursorPaginator, InvalidCursor, decode_cursor
+from .aggregates import GRANULARITIES, period_amounts
+from .models import Record, Category, Payment, MonthlyRollup, Budget, RecurringRecord
+
+
+class ViewQueryBudgetTests(QueryBudgetTestCase):
+    """家計簿の各画面のクエリ数が query_budget 以内か"""
+    urlconf = 'expenses.urls'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('tester', password='password')
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i) for i in range(3)]
+        cls.payments = [Payment.objects.create(name='支払い%d' % i) for i in range(3)]
+        for i in range(25):
+            Record.objects.create(
+                expense_date=datetime.date(2020, i % 12 + 1, 1), amount=100 * i,
+                category=cls.categories[i % 3], payment=cls.payments[i % 3], note='用途%d' % i)
+        cls.record = Record.objects.first()
+        for category in cls.categories:
+            Budget.objects.create(month=datetime.date(2020, 1, 1), category=category, amount=1000)
+            Budget.objects.create(month=datetime.date.today(), category=category, amount=1000)
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='tester', password='password')
+
+    def record_data(self):
+        return {
+            'expense_date': '2020-01-02', 'amount': '500',
+            'category': self.categories[0].pk, 'payment': self.payments[0].pk, 'note': 'テスト',
+        }
+
+    def test_record_list(self):
+        self.assertWithinBudget('/expenses/', status_code=200)
+        self.assertWithinBudget('/expenses/?page=2', status_code=200)
+        self.assertWithinBudget('/expenses/?query=用途1', status_code=200)
+
+    def test_record_edit(self):
+        pk = self.record.pk
+        self.assertWithinBudget('/expenses/record/new/', status_code=200)
+        self.assertWithinBudget('/expenses/record/new/', 'post', self.record_data(), status_code=302)
+        self.assertWithinBudget('/expenses/record/%d/edit/' % pk, status_code=200)
+        self.assertWithinBudget('/expenses/record/%d/edit/' % pk, 'post', self.record_data(), status_code=302)
+        self.assertWithinBudget('/expenses/record/%d/copy/' % pk, status_code=200)
+        self.assertWithinBudget('/expenses/record/%d/copy/' % pk, 'post', self.record_data(), status_code=302)
+        self.assertWithinBudget('/expenses/record/%d/remove/' % pk, 'post', status_code=302)
+
+    def test_record_batch_and_bulk(self):
+        self.assertWithinBudget('/expenses/record/batch/', status_code=200)
+        rows = 50
+        batch = {'form-TOTAL_FORMS': rows, 'form-INITIAL_FORMS': 0}
+        for i in range(rows):
+            batch.update({
+                'form-%d-expense_date' % i: '2020-02-%02d' % (i % 28 + 1), 'form-%d-amount' % i: 10 * i,
+                'form-%d-category' % i: self.categories[i % 3].pk, 'form-%d-payment' % i: self.payments[i % 3].pk,
+                'form-%d-note' % i: 'まとめて%d' % i,
+            })
+        self.assertWithinBudget('/expenses/record/batch/', 'post', batch, status_code=302)
+        self.assertEqual(Record.objects.filter(note__startswith='まとめて').count(), rows)
+        pks = list(Record.objects.values_list('pk', flat=True)[:30])
+        self.assertWithinBudget('/expenses/record/bulk/', 'post', {
+            'records': pks, 'action': 'edit', 'category': self.categories[1].pk}, status_code=302)
+        # 日付・カテゴリ・支払い方法をまとめて変える(トランザクション内で読み直してから更新する)
+        # カテゴリ・支払い方法の一覧をキャッシュしていない状態で
+        cache.clear()
+        self.assertWithinBudget('/expenses/record/bulk/', 'post', {
+            'records': pks[:2], 'action': 'edit', 'expense_date': '2020-06-15',
+            'category': self.categories[2].pk, 'payment': self.payments[2].pk}, status_code=302)
+        self.assertWithinBudget('/expenses/record/bulk/', 'post', {
+            'records': pks, 'action': 'edit', 'expense_date': '2021-01-01',
+            'category': self.categories[0].pk, 'payment': self.payments[0].pk}, status_code=302)
+        self.assertWithinBudget('/expenses/record/bulk/', 'post', {
+            'records': pks[:10], 'action': 'delete'}, status_code=302)
+        self.assertWithinBudget('/expenses/record/bulk/', 'post', {'records': pks, 'action': 'edit'},
+                                status_code=200)
+
+    def test_archives(self):
+        self.assertWithinBudget('/expenses/2020/', status_code=200)
+        self.assertWithinBudget('/expenses/2020/03/', status_code=200)
+        self.assertWithinBudget('/expenses/2020/03/?page=1', status_code=200)
+
+    def test_record_aggregate(self):
+        self.assertWithinBudget('/expenses/record/aggregate/', status_code=200)
+        self.assertWithinBudget('/expenses/record/aggregate/?date_from=2020-03-01&date_to=2020-06-30'
+                                '&categories=%d&granularity=year' % self.categories[0].pk, status_code=200)
+        self.assertWithinBudget('/expenses/record/aggregate/?date_from=2020-03-15&granularity=week'
+                                '&payments=%d' % self.payments[1].pk, status_code=200)
+
+    def test_category_and_payment(self):
+        for kind, obj in (('category', self.categories[0]), ('payment', self.payments[0])):
+            self.assertWithinBudget('/expenses/%s/list/' % kind, status_code=200)
+            self.assertWithinBudget('/expenses/%s/new/' % kind, status_code=200)
+            self.assertWithinBudget('/expenses/%s/new/' % kind, 'post', {'name': '新規'}, status_code=302)
+            self.assertWithinBudget('/expenses/%s/%d/edit/' % (kind, obj.pk), status_code=200)
+            self.assertWithinBudget('/expenses/%s/%d/edit/' % (kind, obj.pk), 'post', {'name': '変更'},
+                                    status_code=302)
+            self.assertWithinBudget('/expenses/%s/%d/remove/' % (kind, obj.pk), 'post', status_code=302)
+            self.assertWithinBudget('/expenses/%s/remove/' % kind, 'post', {'pks': [1, 2]}, status_code=302)
+
+    def test_recurring(self):
+        data = {
+            'frequency': 'monthly', 'interval': '1', 'start_date': '2020-01-31', 'amount': '1000',
+            'category': self.categories[0].pk, 'payment': self.payments[0].pk, 'note': '家賃',
+        }
+        self.assertWithinBudget('/expenses/recurring/new/', status_code=200)
+        self.assertWithinBudget('/expenses/recurring/new/', 'post', data, status_code=302)
+        self.assertWithinBudget('/expenses/recurring/list/', status_code=200)
+        pk = RecurringRecord.objects.get().pk
+        self.assertWithinBudget('/expenses/recurring/%d/edit/' % pk, status_code=200)
+        self.assertWithinBudget('/expenses/recurring/%d/edit/' % pk, 'post', data, status_code=302)
+        # 規則を変える編集を、カテゴリ・支払い方法の一覧をキャッシュしていない状態で
+        cache.clear()
+        self.assertWithinBudget('/expenses/recurring/%d/edit/' % pk, 'post', dict(data, start_date='2020-02-15'),
+                                status_code=302)
+        recurrence.generate(datetime.date(2020, 6, 30))
+        self.assertWithinBudget('/expenses/recurring/%d/remove/' % pk, 'post', status_code=302)
+
+    def test_budget(self):
+        self.assertWithinBudget('/expenses/budget/', status_code=200)
+        self.assertWithinBudget('/expenses/budget/?month=2020-01', status_code=200)
+        self.assertWithinBudget('/expenses/budget/', 'post', {
+            'month': '2020-02', 'category': self.categories[0].pk, 'amount': '500'}, status_code=302)
+        budget = Budget.objects.get(month=datetime.date(2020, 1, 1), category=self.categories[0])
+        self.assertWithinBudget('/expenses/budget/%d/remove/' % budget.pk, 'post', status_code=302)
+
+    def test_import_export(self):
+        self.assertWithinBudget('/expenses/import/', status_code=200)
+        csv = ',2020-01-01 00:00:00 +0900,2020-06-01,100,カテゴリ0,支払い0,用途\n'.encode()
+        self.assertWithinBudget('/expenses/import/', 'post', {'file': SimpleUploadedFile('records.csv', csv)},
+                                status_code=302)
+        self.assertWithinBudget('/expenses/export/', status_code=200)
+
+    @override_settings(CSV_IMPORT_IN_BACKGROUND=False)
+    def test_import_in_request(self):
+        csv = data.records_csv(1000, categories=3, payments=3).replace(b'category ', 'カテゴリ'.encode()).replace(
+            b'payment ', '支払い'.encode())
+        self.assertWithinBudget('/expenses/import/', 'post', {'file': SimpleUploadedFile('records.csv', csv)},
+                                status_code=302)
+        self.assertEqual(Record.objects.count(), 1025)
+
+    def test_api(self):
+        self.assertWithinBudget('/expenses/api/records/?limit=10&count=exact', status_code=200)
+        self.assertWithinBudget('/expenses/api/records/?fields=id,category_name,payment_name&q=用途1',
+                                status_code=200)
+        self.assertWithinBudget('/expenses/api/aggregates/', status_code=200)
+        self.assertWithinBudget('/expenses/api/aggregates/?date_from=2020-02-10&granularity=day', status_code=200)
+
+    def test_login_logout(self):
+        self.client.logout()
+        self.assertWithinBudget('/expenses/login/', status_code=200)
+        self.assertWithinBudget('/expenses/login/', 'post', {'username': 'tester', 'password': 'password'},
+                                status_code=302)
+        self.assertWithinBudget('/expenses/logout/', 'post', status_code=200)
+
+
+class RecordApiTests(CleanCacheTestCase):
+    """家計簿のJSON API"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i) for i in range(2)]
+        cls.payments = [Payment.objects.create(name='支払い%d' % i) for i in range(2)]
+        for i in range(30):
+            Record.objects.create(
+                expense_date=datetime.date(2020, i % 3 + 1, i % 28 + 1) if i % 10 else None, amount=i,
+                category=cls.categories[i % 2], payment=cls.payments[i % 2], note='用途%d' % i)
+
+    def get(self, url, status_code=200):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, status_code)
+        return response.json()
+
+    def test_pages_cover_all_records_in_list_order(self):
+        ids = []
+        url = '/expenses/api/records/?limit=7&fields=id'
+        while url:
+            page = self.get(url)
+            ids += [row['id'] for row in page['results']]
+            url = page['next']
+        expected = Record.objects.order_by('-expense_date', '-created_date', '-pk').values_list('pk', flat=True)
+        self.assertEqual(ids, list(expected))
+
+    def test_fields_and_filters(self):
+        page = self.get('/expenses/api/records/?fields=amount,category_name&date_from=2020-02-01'
+                        '&date_to=2020-02-29&category=%d&count=exact' % self.categories[1].pk)
+        expected = Record.objects.filter(
+            expense_date__month=2, category=self.categories[1]).order_by('-expense_date', '-created_date', '-pk')
+        self.assertEqual(page['count'], expected.count())
+        self.assertEqual(page['results'], [
+            {'amount': record.amount, 'category_name': 'カテゴリ1'} for record in expected])
+
+    def test_bad_request(self):
+        self.assertIn('error', self.get('/expenses/api/records/?fields=password', status_code=400))
+        self.get('/expenses/api/records/?limit=0', status_code=400)
+        self.get('/expenses/api/records/?date_from=2020-13-01', status_code=400)
+        self.get('/expenses/api/records/?cursor=invalid', status_code=400)
+
+    def test_aggregates(self):
+        data = self.get('/expenses/api/aggregates/?month_from=2020-02&payment=%d' % self.payments[0].pk)
+        self.assertEqual(data['payments'], [{'id': self.payments[0].pk, 'name': '支払い0'}])
+        self.assertEqual([row['period'] for row in data['periods']], ['2020-03', '2020-02'])
+        total = sum(Record.objects.filter(
+            expense_date__month=2, payment=self.payments[0]).values_list('amount', flat=True))
+        self.assertEqual(data['by_payment'][1], {'period': '2020-02', 'amounts': [total]})
+
+    def test_aggregates_by_granularity(self):
+        data = self.get('/expenses/api/aggregates/?date_from=2020-01-10&date_to=2020-02-20'
+                        '&category=%d&granularity=day' % self.categories[1].pk)
+        expected = {}
+        for record in Record.objects.filter(
+                expense_date__range=(datetime.date(2020, 1, 10), datetime.date(2020, 2, 20)),
+                category=self.categories[1]):
+            label = record.expense_date.strftime('%Y-%m-%d')
+            expected[label] = expected.get(label, 0) + record.amount
+        self.assertEqual({row['period']: row['amount'] for row in data['periods']}, expected)
+        data = self.get('/expenses/api/aggregates/?granularity=year')
+        self.assertEqual(data['periods'], [
+            {'period': '2020', 'amount': sum(Record.objects.filter(
+                expense_date__isnull=False).values_list('amount', flat=True))}])
+        self.get('/expenses/api/aggregates/?granularity=hour', status_code=400)
+
+
+class RollupTests(CleanCacheTestCase):
+    """Record の保存・削除で月次集計を更新する"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i) for i in range(2)]
+        cls.payments = [Payment.objects.create(name='支払い%d' % i) for i in range(2)]
+
+    def rollups(self):
+        return {
+            (month.strftime('%Y-%m'), category_id, payment_id): (total, count)
+            for month, category_id, payment_id, total, count in MonthlyRollup.objects.values_list(
+                'month', 'category_id', 'payment_id', 'total', 'count')
+        }
+
+    def create(self, expense_date, amount):
+        return Record.objects.create(expense_date=expense_date, amount=amount, category=self.categories[0],
+                                     payment=self.payments[0], note='用途')
+
+    def test_create(self):
+        self.create(datetime.date(2020, 1, 5), 100)
+        self.create(datetime.date(2020, 1, 20), 200)
+        # 日付のないレコードは集計しない
+        self.create(None, 300)
+        c, p = self.categories[0].pk, self.payments[0].pk
+        self.assertEqual(self.rollups(), {('2020-01', c, p): (300, 2)})
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+
+    def test_edit_moves_between_keys(self):
+        self.create(datetime.date(2020, 1, 5), 100)
+        record = self.create(datetime.date(2020, 1, 20), 200)
+        c0, c1 = self.categories[0].pk, self.categories[1].pk
+        p0, p1 = self.payments[0].pk, self.payments[1].pk
+        record.expense_date = datetime.date(2020, 2, 1)
+        record.save()
+        self.assertEqual(self.rollups(), {('2020-01', c0, p0): (100, 1), ('2020-02', c0, p0): (200, 1)})
+        record.category = self.categories[1]
+        record.amount = 250
+        record.save()
+        self.assertEqual(self.rollups(), {('2020-01', c0, p0): (100, 1), ('2020-02', c1, p0): (250, 1)})
+        # 読み込み直したレコードの編集でも、DB上の値から差し引く
+        record = Record.objects.get(pk=record.pk)
+        record.payment = self.payments[1]
+        record.save()
+        self.assertEqual(self.rollups(), {('2020-01', c0, p0): (100, 1), ('2020-02', c1, p1): (250, 1)})
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+
+    def test_delete(self):
+        first = self.create(datetime.date(2020, 1, 5), 100)
+        second = self.create(datetime.date(2020, 1, 20), 200)
+        c, p = self.categories[0].pk, self.payments[0].pk
+        first.delete()
+        self.assertEqual(self.rollups(), {('2020-01', c, p): (200, 1)})
+        # レコードがなくなった月は集計から消える
+        Record.objects.get(pk=second.pk).delete()
+        self.assertEqual(self.rollups(), {})
+
+    def test_admin_delete_selected(self):
+        records = [self.create(datetime.date(2020, 1, day), 100 * day) for day in range(1, 4)]
+        self.create(datetime.date(2020, 2, 1), 1000)
+        budget = Budget.objects.create(month=datetime.date(2020, 1, 1), category=self.categories[0], amount=500,
+                                       spent=600, overspent=True)
+        self.assertEqual(sum(row['total'] for row in archive.period_totals(2020, 1)), 600)
+        User.objects.create_superuser('admin', password='password')
+        self.client.login(username='admin', password='password')
+        # 管理画面の一覧の「選択したレコードの削除」(queryset.delete())
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/admin/expenses/record/', {
+                'action': 'delete_selected', '_selected_action': [record.pk for record in records[:2]], 'post': 'yes'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Record.objects.count(), 2)
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+        budget.refresh_from_db()
+        self.assertEqual((budget.spent, budget.overspent), (300, False))
+        self.assertEqual(sum(row['total'] for row in archive.period_totals(2020, 1)), 300)
+
+
+@override_settings(EXPENSES_RECORD_PAGINATION='cursor', EXPENSES_RECORD_COUNT='none')
+class CursorPaginationTests(CleanCacheTestCase):
+    """レコード一覧のカーソル方式のページ送り"""
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user('tester', password='password')
+        category = Category.objects.create(name='カテゴリ')
+        payment = Payment.objects.create(name='支払い')
+        created_date = timezone.now()
+        # 同じ日付・同じ登録日時の行や、日付のない行も並び順どおりに送れるか
+        for i in range(23):
+            Record.objects.create(
+                expense_date=datetime.date(2020, 1, i % 4 + 1) if i % 5 else None, amount=i,
+                created_date=created_date - datetime.timedelta(minutes=i % 3),
+                category=category, payment=payment, note='用途%d' % i)
+        cls.expected = list(Record.objects.order_by(*CursorPaginator.ordering).values_list('pk', flat=True))
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='tester', password='password')
+
+    def page(self, cursor=None):
+        response = self.client.get('/expenses/', {'cursor': cursor} if cursor else {})
+        self.assertEqual(response.status_code, 200)
+        return response.context['page_obj']
+
+    def test_forward_and_back(self):
+        pages = [self.page()]
+        self.assertFalse(pages[0].has_previous())
+        while pages[-1].has_next():
+            pages.append(self.page(pages[-1].next_cursor))
+        self.assertEqual([len(page) for page in pages], [10, 10, 3])
+        self.assertEqual([record.pk for page in pages for record in page], self.expected)
+        # 日付のない行は、SQLiteでは新しい順の最後に並ぶ
+        self.assertIsNone(pages[-1].object_list[-1].expense_date)
+        # 最後のページから前へ戻ると、同じページが同じ順に出る
+        back = [pages[-1]]
+        while back[-1].has_previous():
+            back.append(self.page(back[-1].previous_cursor))
+        self.assertEqual([[record.pk for record in page] for page in reversed(back)],
+                         [[record.pk for record in page] for page in pages])
+
+    def test_null_dates_across_page_boundary(self):
+        queryset = Record.objects.order_by()
+        paginator = CursorPaginator(queryset, 3)
+        page = paginator.page()
+        pks = [record.pk for record in page]
+        while page.has_next():
+            page = paginator.page(page.next_cursor)
+            pks += [record.pk for record in page]
+        self.assertEqual(pks, self.expected)
+
+    def test_tampered_cursor(self):
+        for cursor in ('abc', 'W10', encode_json_cursor(['next', '2020-01-01', 'x', 1]),
+                       encode_json_cursor(['sideways', '2020-01-01', '2020-01-01T00:00:00+00:00', 1])):
+            with self.assertRaises(InvalidCursor):
+                decode_cursor(cursor)
+            self.assertEqual(self.client.get('/expenses/', {'cursor': cursor}).status_code, 404)
+
+    def test_count_modes(self):
+        self.assertIsNone(self.page().count)
+        with self.settings(EXPENSES_RECORD_COUNT='exact'):
+            self.assertEqual(self.page().count, 23)
+            self.assertEqual(self.client.get('/expenses/', {'query': '用途1'}).context['page_obj'].count,
+                             Record.objects.filter(note__contains='用途1').count())
+        with self.settings(EXPENSES_RECORD_COUNT='estimate'):
+            # 統計情報がなければ最大のrowid(削除していなければ件数と同じ)
+            self.assertEqual(self.page().count, Record.objects.order_by('-pk').first().pk)
+            # 絞り込んだときは概数を出さない
+            self.assertIsNone(self.client.get('/expenses/', {'query': '用途1'}).context['page_obj'].count)
+
+
+# カーソルのトークンと同じ形式で、任意のJSONを符号化する
+def encode_json_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+
+class RecordImportTests(CleanCacheTestCase):
+    """レコードのCSV取り込み"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='カテゴリ')
+        cls.payment = Payment.objects.create(name='支払い')
+        cls.record = Record.objects.create(expense_date=datetime.date(2020, 1, 5), amount=100,
+                                           category=cls.category, payment=cls.payment, note='用途')
+
+    def run_import(self, lines, batch_size=None):
+        csv = ''.join(line + '\n' for line in lines).encode()
+        return RecordImporter(batch_size=batch_size).run(io.BytesIO(csv))
+
+    def test_duplicate_pks_in_a_batch_are_rejected(self):
+        pk = self.record.pk
+        result = self.run_import([
+            '%d,2020-01-01 00:00:00 +0900,2020-01-05,300,カテゴリ,支払い,1回目' % pk,
+            '%d,2020-01-01 00:00:00 +0900,2020-01-05,500,カテゴリ,支払い,2回目' % pk,
+        ])
+        self.assertEqual(result.updated, 1)
+        self.assertEqual(result.errors, [(2, 'ID %d が同じバッチ内の前の行と重複しています。' % pk)])
+        self.record.refresh_from_db()
+        self.assertEqual((self.record.amount, self.record.note), (300, '1回目'))
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+
+    def test_export_round_trip(self):
+        Record.objects.create(expense_date=None, amount=200, category=self.category, payment=self.payment,
+                              note='日付なし')
+        exported = streaming_body(self.client.get('/expenses/export/'))
+        expected = sorted(Record.objects.values_list('expense_date', 'amount', 'note'), key=str)
+        # そのまま取り込むと同じ値で更新される
+        result = RecordImporter().run(io.BytesIO(exported))
+        self.assertEqual((result.created, result.updated, result.errors), (0, 2, []))
+        # IDを空にして取り込むと、日付のないレコードも新しく作られる
+        lines = [b',' + line.split(b',', 1)[1] for line in exported.splitlines()]
+        result = RecordImporter().run(io.BytesIO(b'\n'.join(lines) + b'\n'))
+        self.assertEqual((result.created, result.errors), (2, []))
+        self.assertEqual(sorted(Record.objects.values_list('expense_date', 'amount', 'note'), key=str),
+                         sorted(expected * 2, key=str))
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+
+    def test_job_pages_require_login(self):
+        job = ImportJob.objects.create(kind='expenses.record', file='imports/records.csv')
+        for url in ('/imports/%d/' % job.pk, '/imports/%d/progress/' % job.pk):
+            self.assertRedirects(self.client.get(url), '/expenses/login/?next=' + url, fetch_redirect_response=False)
+
+    def test_duplicate_pks_in_separate_batches(self):
+        pk = self.record.pk
+        result = self.run_import([
+            '%d,2020-01-01 00:00:00 +0900,2020-01-05,300,カテゴリ,支払い,1回目' % pk,
+            '%d,2020-01-01 00:00:00 +0900,2020-02-05,500,カテゴリ,支払い,2回目' % pk,
+        ], batch_size=1)
+        self.assertEqual((result.updated, result.errors), (2, []))
+        self.record.refresh_from_db()
+        self.assertEqual(self.record.amount, 500)
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+
+
+class RecordBulkTests(CleanCacheTestCase):
+    """レコードのまとめて入力・編集・削除"""
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user('tester', password='password')
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i) for i in range(2)]
+        cls.payments = [Payment.objects.create(name='支払い%d' % i) for i in range(2)]
+        for i in range(20):
+            Record.objects.create(
+                expense_date=datetime.date(2020, i % 4 + 1, 1), amount=100 + i,
+                category=cls.categories[i % 2], payment=cls.payments[i % 2], note='用途%d' % i)
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='tester', password='password')
+
+    def assertRollupConsistent(self):
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+
+    def test_batch_skips_blank_rows_and_validates_all(self):
+        batch = {
+            'form-TOTAL_FORMS': 3, 'form-INITIAL_FORMS': 0,
+            'form-0-expense_date': '2020-05-01', 'form-0-amount': '300', 'form-0-category': self.categories[0].pk,
+            'form-0-payment': self.payments[0].pk, 'form-0-note': '一括',
+            'form-1-expense_date': '2020-05-02', 'form-1-amount': 'abc', 'form-1-category': self.categories[0].pk,
+            'form-1-payment': self.payments[0].pk, 'form-1-note': '一括',
+        }
+        response = self.client.post('/expenses/record/batch/', batch)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Record.objects.filter(note='一括').exists())
+        batch['form-1-amount'] = '400'
+        self.assertRedirects(self.client.post('/expenses/record/batch/', batch), '/expenses/')
+        self.assertEqual(sorted(Record.objects.filter(note='一括').values_list('amount', flat=True)), [300, 400])
+        self.assertRollupConsistent()
+
+    def test_bulk_edit_changes_only_given_fields(self):
+        records = list(Record.objects.filter(category=self.categories[0]))
+        self.client.post('/expenses/record/bulk/', {
+            'records': [record.pk for record in records], 'action': 'edit',
+            'expense_date': '2021-01-15', 'payment': self.payments[1].pk})
+        for record in records:
+            record.refresh_from_db()
+            self.assertEqual(record.expense_date, datetime.date(2021, 1, 15))
+            self.assertEqual(record.payment, self.payments[1])
+            self.assertEqual(record.category, self.categories[0])
+        self.assertRollupConsistent()
+
+    def test_bulk_delete(self):
+        pks = list(Record.objects.values_list('pk', flat=True)[:5])
+        self.client.post('/expenses/record/bulk/', {'records': pks, 'action': 'delete'})
+        self.assertFalse(Record.objects.filter(pk__in=pks).exists())
+        self.assertEqual(Record.objects.count(), 15)
+        self.assertRollupConsistent()
+
+    def test_bulk_uses_rows_read_in_transaction(self):
+        # 検証のあとで別のリクエストが変えた金額・日付・削除も、月次集計に正しく反映する
+        records = list(Record.objects.filter(category=self.categories[0]))
+        form = RecordBulkForm({
+            'records': [record.pk for record in records], 'action': 'edit', 'payment': self.payments[1].pk})
+        self.assertTrue(form.is_valid())
+        records[0].amount = 5000
+        records[0].expense_date = datetime.date(2020, 12, 1)
+        records[0].save()
+        records[1].delete()
+        self.assertEqual(len(form.save()), len(records) - 1)
+        self.assertRollupConsistent()
+
+    def test_bulk_requires_post(self):
+        self.assertEqual(self.client.get('/expenses/record/bulk/').status_code, 405)
+
+
+class RemoveTests(CleanCacheTestCase):
+    """削除はPOSTのみで、カテゴリ・支払い方法の削除はレコードを読み込まずに消す"""
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user('tester', password='password')
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i) for i in range(3)]
+        cls.payment = Payment.objects.create(name='支払い')
+        Record.objects.bulk_create([
+            Record(expense_date=datetime.date(2020, i % 12 + 1, 1), amount=i,
+                   category=cls.categories[i % 3], payment=cls.payment, note='用途')
+            for i in range(3000)])
+        rollup.rebuild(Record, MonthlyRollup)
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='tester', password='password')
+
+    def test_get_does_not_remove(self):
+        record = Record.objects.first()
+        for url in ('/expenses/record/%d/remove/' % record.pk, '/expenses/category/%d/remove/' % self.categories[0].pk,
+                    '/expenses/payment/%d/remove/' % self.payment.pk, '/expenses/category/remove/'):
+            self.assertEqual(self.client.get(url).status_code, 405)
+        self.assertEqual(Record.objects.count(), 3000)
+
+    def test_category_remove_does_not_load_records(self):
+        # レコード・月次集計・予算は件数によらず DELETE 文1つずつ
+        with self.captureOnCommitCallbacks(execute=True), self.assertNumQueries(12):
+            response = self.client.post('/expenses/category/remove/', {
+                'pks': [self.categories[0].pk, self.categories[1].pk]})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Record.objects.count(), 1000)
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+        self.assertEqual([category.pk for category in lookups.categories.all()], [self.categories[2].pk])
+
+    def test_lookup_version_changes_after_commit(self):
+        self.assertEqual(len(lookups.categories.all()), 3)
+        version = cache.get(lookups.categories.version_key)
+        with self.captureOnCommitCallbacks() as callbacks:
+            Category.objects.create(name='カテゴリ3')
+            self.assertEqual(cache.get(lookups.categories.version_key), version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(cache.get(lookups.categories.version_key), version)
+        self.assertEqual(len(lookups.categories.all()), 4)
+
+    def test_remove_missing_category(self):
+        self.assertEqual(self.client.post('/expenses/category/999/remove/').status_code, 404)
+
+    def test_bulk_delete_in_chunks(self):
+        self.assertEqual(bulk_delete(Category.objects.all(), chunk_size=2), 3)
+        self.assertFalse(Record.objects.exists())
+        self.assertFalse(MonthlyRollup.objects.exists())
+
+
+class BudgetTests(CleanCacheTestCase):
+    """予算の使った額・超過を、レコードの保存・削除・インポートのたびに更新する"""
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user('tester', password='password')
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i) for i in range(2)]
+        cls.payments = [Payment.objects.create(name='支払い%d' % i) for i in range(2)]
+        cls.month = datetime.date(2020, 3, 1)
+        Record.objects.create(expense_date=datetime.date(2020, 3, 5), amount=300,
+                              category=cls.categories[0], payment=cls.payments[0], note='用途')
+        # 予算を作った時点で、すでにあるレコードの分が使った額に入る
+        cls.budget = Budget.objects.create(month=datetime.date(2020, 3, 20), category=cls.categories[0], amount=1000)
+
+    def setUp(self):
+        super().setUp()
+        self.client.login(username='tester', password='password')
+
+    def assertBudget(self, spent, overspent):
+        self.budget.refresh_from_db()
+        self.assertEqual((self.budget.spent, self.budget.overspent), (spent, overspent))
+        self.assertEqual(budgets.compare(), {})
+
+    def create(self, amount, expense_date=datetime.date(2020, 3, 10), category=None, payment=None):
+        return Record.objects.create(expense_date=expense_date, amount=amount, category=category or self.categories[0],
+                                     payment=payment or self.payments[0], note='用途')
+
+    def test_created_budget_includes_existing_records(self):
+        self.assertEqual(self.budget.month, self.month)
+        self.assertBudget(300, False)
+
+    def test_record_save_and_delete(self):
+        record = self.create(500, payment=self.payments[1])
+        self.assertBudget(800, False)
+        record.amount = 800
+        record.save()
+        self.assertBudget(1100, True)
+        # 別の月・別のカテゴリに移すと、この予算からは差し引く
+        record.category = self.categories[1]
+        record.save()
+        self.assertBudget(300, False)
+        record.category = self.categories[0]
+        record.save()
+        record.delete()
+        self.assertBudget(300, False)
+        # 予算のない月・カテゴリのレコードは何も更新しない
+        self.create(100, category=self.categories[1])
+        self.assertEqual(Budget.objects.count(), 1)
+
+    def test_changing_the_amount_recomputes_overspent(self):
+        self.budget.amount = 200
+        self.budget.save()
+        self.assertBudget(300, True)
+        # 読み込んだあとに増えた分も上書きしない
+        stale = Budget.objects.get(pk=self.budget.pk)
+        self.create(100)
+        stale.amount = 350
+        stale.save()
+        self.assertBudget(400, True)
+
+    def test_bulk_changes(self):
+        # キーが rollup.BULK_THRESHOLD より多い変更はまとめて更新する
+        other = Budget.objects.create(month=datetime.date(2020, 4, 1), category=self.categories[1], amount=100)
+        batch = {'form-TOTAL_FORMS': 6, 'form-INITIAL_FORMS': 0}
+        for i in range(6):
+            batch.update({
+                'form-%d-expense_date' % i: '2020-%02d-01' % (i % 3 + 3), 'form-%d-amount' % i: 100,
+                'form-%d-category' % i: self.categories[i % 2].pk, 'form-%d-payment' % i: self.payments[0].pk,
+                'form-%d-note' % i: 'まとめて',
+            })
+        self.assertRedirects(self.client.post('/expenses/record/batch/', batch), '/expenses/')
+        self.assertBudget(400, False)
+        other.refresh_from_db()
+        self.assertEqual((other.spent, other.overspent), (100, False))
+        pks = list(Record.objects.filter(note='まとめて').values_list('pk', flat=True))
+        self.client.post('/expenses/record/bulk/', {
+            'records': pks, 'action': 'edit', 'expense_date': '2020-03-15', 'category': self.categories[0].pk})
+        self.assertBudget(900, False)
+        self.client.post('/expenses/record/bulk/', {'records': pks, 'action': 'delete'})
+        self.assertBudget(300, False)
+
+    def test_import(self):
+        csv = ''.join(',2020-01-01 00:00:00 +0900,2020-03-%02d,400,カテゴリ0,支払い%d,インポート\n' % (day, day % 2)
+                      for day in range(1, 5)).encode()
+        with self.settings(CSV_IMPORT_IN_BACKGROUND=False):
+            self.client.post('/expenses/import/', {'file': SimpleUploadedFile('records.csv', csv)})
+        self.assertBudget(1900, True)
+
+    def test_payment_delete_rebuilds_spent(self):
+        self.create(900, payment=self.payments[1])
+        self.assertBudget(1200, True)
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_delete(Payment.objects.filter(pk=self.payments[1].pk))
+        self.assertBudget(300, False)
+
+    def test_deleting_payments_rebuilds_once(self):
+        self.create(900, payment=self.payments[1])
+        with self.captureOnCommitCallbacks() as callbacks:
+            bulk_delete(Payment.objects.all())
+        self.assertEqual(sum(callback is budgets.rebuild for callback in callbacks), 1)
+        for callback in callbacks:
+            callback()
+        self.assertBudget(0, False)
+
+    def test_remaining_is_one_query(self):
+        self.create(900)
+        with self.assertNumQueries(1):
+            month_budgets = budgets.for_month(self.month)
+            self.assertEqual([(budget.category.name, budget.remaining, budget.overspent) for budget in month_budgets],
+                             [('カテゴリ0', -200, True)])
+
+    def test_views_show_overspend(self):
+        record = self.create(900)
+        response = self.client.get('/expenses/record/%d/edit/' % record.pk)
+        self.assertEqual(response.context['budget_month'], self.month)
+        self.assertContains(response, 'カテゴリ0の予算を200円超えています')
+        response = self.client.post('/expenses/budget/', {
+            'month': '2020-03', 'category': self.categories[0].pk, 'amount': '1500'})
+        self.assertRedirects(response, '/expenses/budget/?month=2020-03')
+        self.assertBudget(1200, False)
+        self.assertEqual(Budget.objects.count(), 1)
+        self.assertNotContains(self.client.get('/expenses/budget/?month=2020-03'), '超えています')
+
+    def test_rebuild_command(self):
+        Budget.objects.filter(pk=self.budget.pk).update(spent=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_rollup', '--check', stdout=io.StringIO(), stderr=io.StringIO())
+        call_command('rebuild_rollup', stdout=io.StringIO())
+        self.assertBudget(300, False)
+
+
+class RecurringTests(CleanCacheTestCase):
+    """繰り返しのレコードの発生日と、レコードのまとめての作成"""
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user('tester', password='password')
+        cls.category = Category.objects.create(name='カテゴリ')
+        cls.payment = Payment.objects.create(name='支払い')
+
+    def recurring(self, frequency, start_date, interval=1, end_date=None, amount=1000):
+        return RecurringRecord.objects.create(
+            frequency=frequency, interval=interval, start_date=start_date, end_date=end_date, amount=amount,
+            category=self.category, payment=self.payment, note='繰り返し')
+
+    def dates(self, template, date_from, date_to):
+        return [day.isoformat() for day in recurrence.occurrences(template, date_from, date_to)]
+
+    def test_occurrences(self):
+        monthly = self.recurring('monthly', datetime.date(2020, 1, 31))
+        # その月にない日は月末、翌月は元の日に戻る
+        self.assertEqual(self.dates(monthly, datetime.date(2020, 1, 1), datetime.date(2020, 4, 30)),
+                         ['2020-01-31', '2020-02-29', '2020-03-31', '2020-04-30'])
+        self.assertEqual(self.dates(monthly, datetime.date(2020, 3, 1), datetime.date(2020, 3, 30)), [])
+        weekly = self.recurring('weekly', datetime.date(2020, 1, 1), interval=2, end_date=datetime.date(2020, 2, 12))
+        self.assertEqual(self.dates(weekly, datetime.date(2020, 1, 2), datetime.date(2020, 12, 31)),
+                         ['2020-01-15', '2020-01-29', '2020-02-12'])
+        yearly = self.recurring('yearly', datetime.date(2020, 2, 29))
+        self.assertEqual(self.dates(yearly, datetime.date(2019, 1, 1), datetime.date(2024, 3, 1)),
+                         ['2020-02-29', '2021-02-28', '2022-02-28', '2023-02-28', '2024-02-29'])
+        daily = self.recurring('daily', datetime.date(2020, 1, 1), interval=3)
+        self.assertEqual(self.dates(daily, datetime.date(2030, 1, 1), datetime.date(2030, 1, 7)),
+                         ['2030-01-02', '2030-01-05'])
+
+    def test_generate_is_idempotent(self):
+        self.recurring('monthly', datetime.date(2020, 1, 10))
+        self.recurring('weekly', datetime.date(2020, 1, 1), end_date=datetime.date(2020, 1, 31))
+        Budget.objects.create(month=datetime.date(2020, 1, 1), category=self.category, amount=5000)
+        # 繰り返しの件数・期間によらず、レコードは1回の bulk_create で作る
+        with CaptureQueriesContext(connection) as queries:
+            records = recurrence.generate(datetime.date(2020, 3, 31))
+        self.assertEqual(len(records), 8)
+        self.assertEqual(sum('INSERT INTO "expenses_record"' in query['sql'] for query in queries.captured_queries), 1)
+        self.assertEqual(recurrence.generate(datetime.date(2020, 3, 31)), [])
+        self.assertEqual(len(recurrence.generate(datetime.date(2020, 4, 10))), 1)
+        self.assertEqual(Record.objects.count(), 9)
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+        self.assertEqual(Budget.objects.get().spent, 6000)
+        self.assertEqual(budgets.compare(), {})
+
+    def test_edited_records_are_not_generated_again(self):
+        template = self.recurring('monthly', datetime.date(2020, 1, 10))
+        recurrence.generate(datetime.date(2020, 2, 28))
+        record = Record.objects.get(occurrence=datetime.date(2020, 1, 10))
+        record.expense_date = datetime.date(2020, 1, 12)
+        record.save()
+        # 規則を変えても作り終えた日は残り、その翌日以降だけを作る
+        self.client.login(username='tester', password='password')
+        self.client.post('/expenses/recurring/%d/edit/' % template.pk, {
+            'frequency': 'monthly', 'interval': '1', 'start_date': '2020-01-10', 'end_date': '2020-12-31',
+            'amount': '1000', 'category': self.category.pk, 'payment': self.payment.pk, 'note': '繰り返し'})
+        template.refresh_from_db()
+        self.assertEqual(template.generated_until, datetime.date(2020, 2, 28))
+        self.assertEqual(len(recurrence.generate(datetime.date(2020, 3, 31))), 1)
+        self.assertEqual(sorted(Record.objects.values_list('expense_date', flat=True)), [
+            datetime.date(2020, 1, 12), datetime.date(2020, 2, 10), datetime.date(2020, 3, 10)])
+
+    def test_rule_change_applies_after_generated_records(self):
+        template = self.recurring('monthly', datetime.date(2020, 1, 10))
+        recurrence.generate(datetime.date(2020, 6, 30))
+        Record.objects.get(occurrence=datetime.date(2020, 3, 10)).delete()
+        # 開始日を変えても、作成済みの6か月分は作り直さず、削除した3月分も戻らない
+        self.client.login(username='tester', password='password')
+        self.client.post('/expenses/recurring/%d/edit/' % template.pk, {
+            'frequency': 'monthly', 'interval': '1', 'start_date': '2020-01-15',
+            'amount': '1000', 'category': self.category.pk, 'payment': self.payment.pk, 'note': '繰り返し'})
+        self.assertEqual([record.occurrence for record in recurrence.generate(datetime.date(2020, 8, 31))],
+                         [datetime.date(2020, 7, 15), datetime.date(2020, 8, 15)])
+        self.assertEqual(sorted(Record.objects.values_list('expense_date', flat=True)), [
+            datetime.date(2020, 1, 10), datetime.date(2020, 2, 10), datetime.date(2020, 4, 10),
+            datetime.date(2020, 5, 10), datetime.date(2020, 6, 10), datetime.date(2020, 7, 15),
+            datetime.date(2020, 8, 15)])
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+
+    def test_deleting_a_template_keeps_records(self):
+        template = self.recurring('monthly', datetime.date(2020, 1, 10))
+        recurrence.generate(datetime.date(2020, 2, 28))
+        template.delete()
+        self.assertEqual(list(Record.objects.values_list('recurrence', flat=True)), [None, None])
+
+    def test_command(self):
+        self.recurring('monthly', datetime.date(2020, 1, 10), end_date=datetime.date(2020, 6, 30))
+        out = io.StringIO()
+        call_command('generate_recurring', '--until', '2021-01-01', stdout=out)
+        self.assertIn('Created 6 records up to 2021-01-01.', out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command('generate_recurring', '--until', '2021/01/01')
+
+
+class AggregateTests(CleanCacheTestCase):
+    """期間・カテゴリ・支払い方法で絞り込んだ集計"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.categories = [Category.objects.create(name='カテゴリ%d' % i) for i in range(3)]
+        cls.payments = [Payment.objects.create(name='支払い%d' % i) for i in range(2)]
+        for i in range(60):
+            Record.objects.create(
+                expense_date=datetime.date(2019 + i % 2, i % 12 + 1, i % 28 + 1), amount=10 * i,
+                category=cls.categories[i % 3], payment=cls.payments[i % 2])
+
+    def expected(self, granularity, date_from, date_to, categories, payments):
+        trunc = {
+            'day': lambda date: date,
+            'week': lambda date: date - datetime.timedelta(days=date.weekday()),
+            'month': lambda date: date.replace(day=1),
+            'year': lambda date: date.replace(month=1, day=1),
+        }[granularity]
+        totals = {}
+        for record in Record.objects.all():
+            if not date_from <= record.expense_date <= date_to:
+                continue
+            if record.category_id not in categories or record.payment_id not in payments:
+                continue
+            key = (trunc(record.expense_date), record.category_id, record.payment_id)
+            totals[key] = totals.get(key, 0) + record.amount
+        return totals
+
+    def test_matches_python_totals(self):
+        categories = {self.categories[0].pk, self.categories[2].pk}
+        payments = {self.payments[1].pk}
+        for granularity in GRANULARITIES:
+            for date_from, date_to in (
+                    (datetime.date(2019, 3, 1), datetime.date(2020, 8, 31)),
+                    (datetime.date(2019, 3, 5), datetime.date(2020, 8, 20))):
+                rows = period_amounts(date_from, date_to, categories, payments, granularity)
+                totals = {(row['period'], row['category'], row['payment']): row['total'] for row in rows}
+                self.assertEqual(
+                    totals, self.expected(granularity, date_from, date_to, categories, payments),
+                    (granularity, date_from, date_to))
+
+    def test_uses_rollup_for_whole_months(self):
+        rows = period_amounts(datetime.date(2019, 3, 1), datetime.date(2020, 8, 31), granularity='year')
+        self.assertIn('expenses_monthlyrollup', str(rows.query))
+        rows = period_amounts(datetime.date(2019, 3, 2), granularity='month')
+        self.assertIn('expenses_record', str(rows.query))
+        self.assertIn('GROUP BY', str(rows.query))
+
+
+class AsyncViewTests(CleanCacheTestCase):
+    """ASGI(非同期のクライアント)で呼んだエクスポート・集計画面"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='カテゴリ')
+        payment = Payment.objects.create(name='支払い')
+        for i in range(30):
+            Record.objects.create(expense_date=datetime.date(2020, i % 12 + 1, 1), amount=i,
+                                  category=category, payment=payment, note='用途%d' % i)
+
+    async def test_export_streams_all_rows(self):
+        response = await self.async_client.get('/expenses/export/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_async)
+        content = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        lines = content.splitlines()
+        self.assertEqual(len(lines), 30)
+        self.assertTrue(lines[0].endswith(',0,カテゴリ,支払い,用途0'))
+
+    def test_export_over_wsgi_is_not_buffered(self):
+        # WSGI(同期のクライアント)には同期のイテレータで返す
+        response = self.client.get('/expenses/export/')
+        self.assertFalse(response.is_async)
+        self.assertEqual(len(b''.join(response.streaming_content).decode().splitlines()), 30)
+
+    async def test_aggregate(self):
+        response = await self.async_client.get('/expenses/record/aggregate/', {'granularity': 'year'})
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '2020')
+        self.assertEqual(response.context['amounts_per_m'][0]['amount'], sum(range(30)))
+
+
+class ArchiveTests(CleanCacheTestCase):
+    """年・月のアーカイブと、期間ごとの合計のキャッシュ"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='カテゴリ')
+        cls.payment = Payment.objects.create(name='支払い')
+        for month, day, amount in ((1, 5, 100), (3, 1, 200), (3, 31, 300), (3, 31, 400)):
+            Record.objects.create(expense_date=datetime.date(2020, month, day), amount=amount,
+                                  category=cls.category, payment=cls.payment, note='用途')
+        Record.objects.create(expense_date=datetime.date(2022, 7, 1), amount=1000,
+                              category=cls.category, payment=cls.payment, note='用途')
+
+    def test_month(self):
+        response = self.client.get('/expenses/2020/03/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([record.amount for record in response.context['records']], [400, 300, 200])
+        self.assertEqual(response.context['total'], 900)
+        self.assertEqual(response.context['date_list'], [datetime.date(2020, 3, 1), datetime.date(2020, 3, 31)])
+        self.assertEqual(response.context['previous_month'], datetime.date(2020, 1, 1))
+        self.assertEqual(response.context['next_month'], datetime.date(2022, 7, 1))
+        self.assertTrue(response.context['closed'])
+
+    def test_year(self):
+        response = self.client.get('/expenses/2020/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['total'], 1000)
+        self.assertEqual([amount['amount'] for amount in response.context['amounts_per_m']], [900, 100])
+        self.assertEqual(response.context['years'], [2020, 2022])
+        self.assertIsNone(response.context['previous_year'])
+        self.assertEqual(response.context['next_year'], datetime.date(2022, 1, 1))
+        self.assertContains(response, '/expenses/2020/03/')
+        self.assertEqual(self.client.get('/expenses/2021/').context['total'], 0)
+        self.assertEqual(self.client.get('/expenses/2020/13/').status_code, 404)
+
+    def test_records_are_read_by_date_range(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/expenses/2020/03/')
+        record_queries = [query['sql'] for query in queries.captured_queries if 'FROM "expenses_record"' in query['sql']]
+        self.assertTrue(record_queries)
+        for sql in record_queries:
+            self.assertIn('"expense_date" >= ', sql)
+            self.assertNotIn('django_date_extract', sql)
+
+    def test_totals_are_cached_until_the_month_changes(self):
+        self.client.get('/expenses/2020/03/')
+        # 2回目は件数と1ページ分のレコードだけ読む
+        with self.assertNumQueries(2):
+            self.client.get('/expenses/2020/03/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Record.objects.create(expense_date=datetime.date(2020, 3, 2), amount=50,
+                                  category=self.category, payment=self.payment, note='追加')
+        self.assertEqual(self.client.get('/expenses/2020/03/').context['total'], 950)
+        self.assertEqual(self.client.get('/expenses/2020/').context['total'], 1050)
+
+    def test_deleting_a_category_clears_all_periods(self):
+        self.client.get('/expenses/2020/')
+        with self.captureOnCommitCallbacks(execute=True):
+            bulk_delete(Category.objects.filter(pk=self.category.pk))
+        response = self.client.get('/expenses/2020/')
+        self.assertEqual(response.context['total'], 0)
+        self.assertEqual(response.context['years'], [])
+
+    def test_closed_periods(self):
+        today = datetime.date.today()
+        self.assertTrue(archive.is_closed(2020, 3))
+        self.assertTrue(archive.is_closed(today.year - 1))
+        self.assertFalse(archive.is_closed(today.year))
+        self.assertFalse(archive.is_closed(today.year, today.month))
@@ -1,4 +1,4 @@
-from django.urls import path
+from django.urls import include, path
 from . import views
 
 app_name = 'expenses'
@@ -6,19 +6,32 @@ urlpatterns = [
     path('', views.RecordList.as_view(), name='record_list'),
     path('record/new/', views.record_new, name='record_new'),
     path('record/<int:pk>/edit/', views.record_edit, name='record_edit'),
-    path('record/<pk>/remove/', views.record_remove, name='record_remove'),
+    path('record/<int:pk>/remove/', views.record_remove, name='record_remove'),
     path('record/<pk>/copy/', views.record_copy, name='record_copy'),
+    path('record/batch/', views.record_batch, name='record_batch'),
+    path('record/bulk/', views.record_bulk, name='record_bulk'),
     path('record/aggregate/', views.record_aggregate, name='record_aggregate'),
+    path('<int:year>/', views.RecordYearArchive.as_view(), name='record_archive_year'),
+    path('<int:year>/<int:month>/', views.RecordMonthArchive.as_view(), name='record_archive_month'),
     path('category/list/', views.category_list, name='category_list'),
     path('category/new/', views.category_new, name='category_new'),
     path('category/<int:pk>/edit/', views.category_edit, name='category_edit'),
-    path('category/<pk>/remove/', views.category_remove, name='category_remove'),
+    path('category/<int:pk>/remove/', views.category_remove, name='category_remove'),
+    path('category/remove/', views.category_bulk_remove, name='category_bulk_remove'),
     path('payment/list/', views.payment_list, name='payment_list'),
     path('payment/new/', views.payment_new, name='payment_new'),
     path('payment/<int:pk>/edit/', views.payment_edit, name='payment_edit'),
-    path('payment/<pk>/remove/', views.payment_remove, name='payment_remove'),
+    path('payment/<int:pk>/remove/', views.payment_remove, name='payment_remove'),
+    path('payment/remove/', views.payment_bulk_remove, name='payment_bulk_remove'),
+    path('recurring/list/', views.recurring_list, name='recurring_list'),
+    path('recurring/new/', views.recurring_new, name='recurring_new'),
+    path('recurring/<int:pk>/edit/', views.recurring_edit, name='recurring_edit'),
+    path('recurring/<int:pk>/remove/', views.recurring_remove, name='recurring_remove'),
+    path('budget/', views.budget_list, name='budget_list'),
+    path('budget/<int:pk>/remove/', views.budget_remove, name='budget_remove'),
     path('import/', views.RecordImport.as_view(), name='import'),
     path('export/', views.record_export, name='export'),
+    path('api/', include('expenses.api.urls')),
     path('', views.RecordList.as_view(), name='top'),
     path('login/', views.Login.as_view(), name='login'),
     path('logout/', views.Logout.as_view(), name='logout'),
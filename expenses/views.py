@@ -1,54 +1,198 @@
-import csv
 import datetime
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.views import LoginView, LogoutView
 from django.db import models
-from django.db.models import Max, Sum, Q
-from django.http import HttpResponse
+from django.db.models import Max
+from django.http import Http404
 from django.shortcuts import render, get_object_or_404, redirect
-from django.urls import reverse_lazy
+from django.urls import reverse, reverse_lazy
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.views import generic
-from django.views.generic import ListView
-from .models import Record, Category, Payment
-from .forms import LoginForm, RecordForm, CategoryForm, PaymentForm, CSVUploadForm
+from django.views.decorators.http import require_POST
+from django.views.generic import ListView, MonthArchiveView, YearArchiveView
+from django.views.generic.dates import MonthMixin
+from mysite import asynchronous
+from mysite.deletion import bulk_delete
+from mysite.performance import query_budget
+from mysite.streaming import queryset_csv_response
+from . import archive, budgets, lookups
+from .aggregates import GRANULARITIES, build_pivots, period_amounts
+from .models import Record, Category, Payment, Budget, RecurringRecord
+from .pagination import CursorPaginator, InvalidCursor
+from .search import record_index
+from .forms import (
+    LoginForm, RecordForm, RecordBatchFormSet, RecordBulkForm, CategoryForm, PaymentForm, RecurringRecordForm,
+    BudgetForm, CSVUploadForm, AggregateFilterForm,
+)
 
 class Login(LoginView):
     """ログインページ"""
     form_class = LoginForm
     template_name = 'expenses/login.html'
+    query_budget = 9
 
 class Logout(LogoutView):
     """ログアウトページ"""
     template_name = "expenses/record_list.html"
+    query_budget = 4
+
+# 今月(月初日)
+def current_month():
+    return timezone.localdate().replace(day=1)
+
+# 予算の使った額・残りの表示(templates/expenses/budget_status.html)に渡す値
+def budget_context(month):
+    return {'budget_month': month, 'budgets': budgets.for_month(month)}
 
 # レコード一覧
+# settings.EXPENSES_RECORD_PAGINATION が 'cursor' なら、OFFSETではなくカーソル(前ページの最後の行)でページを送る
 class RecordList(ListView):
     template_name = "expenses/record_list.html"
     context_object_name = 'records'
     paginate_by = 10
+    # まとめて編集欄のカテゴリ・支払い方法の一覧(キャッシュが空のとき)と今月の予算を含む
+    query_budget = 7
+    # 現在のページの前後に表示するページ番号の数
+    page_window = 5
+
     def get_queryset(self):
         q_word = self.request.GET.get('query')
+        # 一覧に表示するカテゴリ・支払い方法は同じクエリで取得する
+        object_list = Record.objects.select_related('category', 'payment')
         if q_word:
-            object_list = Record.objects.filter(Q(note__icontains=q_word))
-        else:
-            object_list = Record.objects.all()
+            # 用途の全文検索インデックスで絞り込む
+            object_list = record_index.search(object_list, q_word)
         return object_list.order_by('-expense_date', '-created_date')
 
+    @property
+    def cursor_mode(self):
+        return settings.EXPENSES_RECORD_PAGINATION == 'cursor'
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.cursor_mode:
+            return super().paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(queryset, page_size, count=settings.EXPENSES_RECORD_COUNT)
+        try:
+            page = paginator.page(self.request.GET.get('cursor'))
+        except InvalidCursor:
+            raise Http404('ページの指定が正しくありません。')
+        return (paginator, page, page.object_list, page.has_other_pages())
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['cursor_mode'] = self.cursor_mode
+        context['bulk_form'] = RecordBulkForm()
+        context.update(budget_context(current_month()))
+        page = context['page_obj']
+        if page is not None and not self.cursor_mode:
+            # ページ番号のリンクは現在のページの前後だけ作る(全ページ分をループしない)
+            first = max(page.number - self.page_window, 1)
+            last = min(page.number + self.page_window, page.paginator.num_pages)
+            context['page_window'] = range(first, last + 1)
+        return context
+
+class RecordArchiveMixin:
+    """年・月のアーカイブの共通部分
+
+    レコードは expense_date の範囲(期間の最初の日以上、次の期間の最初の日未満)で絞り込むので、
+    日付のインデックス(record_date_idx)の範囲検索で読める。期間の合計は archive がキャッシュしたものを使う。
+    """
+    date_field = 'expense_date'
+    month_format = '%m'
+    allow_empty = True
+    allow_future = True
+
+    def get_queryset(self):
+        return Record.objects.select_related('category', 'payment').order_by('-expense_date', '-created_date')
+
+    # (年, 月)。年のアーカイブ(URLに月のないビュー)では月は None
+    def get_period(self):
+        month = int(self.get_month()) if isinstance(self, MonthMixin) else None
+        return int(self.get_year()), month
+
+    @cached_property
+    def totals(self):
+        return archive.period_totals(*self.get_period())
+
+    def get_date_list(self, queryset, date_type=None, ordering='ASC'):
+        # 期間内のレコードのある日(年なら月)は合計から作る(DISTINCT のクエリを発行しない)
+        return sorted({row['period'] for row in self.totals}, reverse=ordering == 'DESC')
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        year, month = self.get_period()
+        granularity = 'month' if month is None else 'day'
+        categories = lookups.categories.all()
+        payments = lookups.payments.all()
+        context.update({
+            'categories': categories,
+            'payments': payments,
+            'years': sorted({date.year for date in archive.months()}),
+            'closed': archive.is_closed(year, month),
+            'total': sum(row['total'] for row in self.totals),
+            'period_label': GRANULARITIES[granularity][2],
+        })
+        context.update(build_pivots(self.totals, categories, payments, granularity))
+        return context
+
+# 年のアーカイブ(/expenses/2026/)。月ごとの合計と、レコードのある前後の年へのリンク
+class RecordYearArchive(RecordArchiveMixin, YearArchiveView):
+    # 月次集計・レコードのある月の一覧・カテゴリ・支払い方法(キャッシュが空のとき)を含む
+    query_budget = 6
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # 月ごとの合計の行から、その月のアーカイブへリンクする
+        urls = {
+            month.strftime(GRANULARITIES['month'][1]): reverse(
+                'expenses:record_archive_month', kwargs={'year': month.year, 'month': '%02d' % month.month})
+            for month in self.date_list
+        }
+        for amount in context['amounts_per_m']:
+            amount['url'] = urls[amount['period']]
+        return context
+
+    def get_next_year(self, date):
+        years = sorted({month.year for month in archive.months()})
+        return next((datetime.date(year, 1, 1) for year in years if year > date.year), None)
+
+    def get_previous_year(self, date):
+        years = sorted({month.year for month in archive.months()}, reverse=True)
+        return next((datetime.date(year, 1, 1) for year in years if year < date.year), None)
+
+# 月のアーカイブ(/expenses/2026/03/)。日ごとの合計と、その月のレコードの一覧
+class RecordMonthArchive(RecordArchiveMixin, MonthArchiveView):
+    context_object_name = 'records'
+    paginate_by = 50
+    # 日ごとの合計・レコードのある月の一覧・カテゴリ・支払い方法(キャッシュが空のとき)と、件数・1ページ分のレコード
+    query_budget = 8
+
+    def get_next_month(self, date):
+        return next((month for month in archive.months() if month > date), None)
+
+    def get_previous_month(self, date):
+        return next((month for month in reversed(archive.months()) if month < date), None)
+
 # カテゴリ一覧
+@query_budget(3)
 @login_required
 def category_list(request):
     categories = Category.objects.all()
     return render(request, 'expenses/category_list.html', {'categories': categories})
 
 # 支払い方法一覧
+@query_budget(3)
 @login_required
 def payment_list(request):
     payments = Payment.objects.all()
     return render(request, 'expenses/payment_list.html', {'payments': payments})
 
 # レコード追加
+@query_budget(10)
 @login_required
 def record_new(request):
     if request.method == "POST":
@@ -63,9 +207,10 @@ def record_new(request):
             'expense_date': timezone.datetime.today(),
         }
         form = RecordForm(None, initial=default_value)
-    return render(request, 'expenses/record_edit.html', {'form': form})
+    return render(request, 'expenses/record_edit.html', {'form': form, **budget_context(current_month())})
 
 # レコード編集
+@query_budget(12)
 @login_required
 def record_edit(request, pk):
     record = get_object_or_404(Record, pk=pk)
@@ -78,9 +223,12 @@ def record_edit(request, pk):
             return redirect('expenses:record_list')
     else:
         form = RecordForm(instance=record)
-    return render(request, 'expenses/record_edit.html', {'form': form})
+    # 編集するレコードの月の予算を表示する
+    month = record.expense_date.replace(day=1) if record.expense_date else current_month()
+    return render(request, 'expenses/record_edit.html', {'form': form, **budget_context(month)})
 
 # レコードコピー
+@query_budget(10)
 @login_required
 def record_copy(request, pk):
     if request.method == "POST":
@@ -95,14 +243,44 @@ def record_copy(request, pk):
         copied_data = {
             'expense_date': timezone.datetime.today(),
             'amount': copied_record.amount,
-            'category': copied_record.category,
-            'payment': copied_record.payment,
+            'category': copied_record.category_id,
+            'payment': copied_record.payment_id,
             'note': copied_record.note,
         }
         form = RecordForm(None, initial=copied_data)
-    return render(request, 'expenses/record_edit.html', {'form': form})
+    return render(request, 'expenses/record_edit.html', {'form': form, **budget_context(current_month())})
+
+# レコードまとめて入力
+# 入力のある行をまとめて検証し、1回の bulk_create で保存する(行数によらずクエリ数は一定)
+# 月次集計・予算の更新は、キーが rollup.BULK_THRESHOLD 件以下ならキーごとに行うので、その分を見込んでおく
+@query_budget(19)
+@login_required
+def record_batch(request):
+    if request.method == "POST":
+        formset = RecordBatchFormSet(request.POST)
+        if formset.is_valid():
+            formset.save()
+            return redirect('expenses:record_list')
+    else:
+        # 日付だけ入った行は空行として扱われ、保存されない
+        today = timezone.localdate()
+        formset = RecordBatchFormSet(initial=[{'expense_date': today}] * RecordBatchFormSet.extra)
+    return render(request, 'expenses/record_batch.html', {'formset': formset})
+
+# 一覧で選んだレコードのまとめて編集・削除
+# 検証でのpkの確認に加えて、保存の前にトランザクション内でレコードを読み直す分を見込んでおく
+@query_budget(19)
+@login_required
+@require_POST
+def record_bulk(request):
+    form = RecordBulkForm(request.POST)
+    if form.is_valid():
+        form.save()
+        return redirect('expenses:record_list')
+    return render(request, 'expenses/record_bulk.html', {'form': form})
 
 # カテゴリ追加
+@query_budget(4)
 @login_required
 def category_new(request):
     if request.method == "POST":
@@ -116,6 +294,7 @@ def category_new(request):
     return render(request, 'expenses/category_edit.html', {'form': form})
 
 # カテゴリ編集
+@query_budget(4)
 @login_required
 def category_edit(request, pk):
     post = get_object_or_404(Category, pk=pk)
@@ -130,6 +309,7 @@ def category_edit(request, pk):
     return render(request, 'expenses/category_edit.html', {'form': form})
 
 # 支払い方法追加
+@query_budget(4)
 @login_required
 def payment_new(request):
     if request.method == "POST":
@@ -143,6 +323,7 @@ def payment_new(request):
     return render(request, 'expenses/payment_edit.html', {'form': form})
 
 # 支払い方法編集
+@query_budget(4)
 @login_required
 def payment_edit(request, pk):
     post = get_object_or_404(Payment, pk=pk)
@@ -156,108 +337,206 @@ def payment_edit(request, pk):
         form = PaymentForm(instance=post)
     return render(request, 'expenses/payment_edit.html', {'form': form})
 
-# レコード削除
+# POSTで送られた、一覧で選んだ行のpk
+def selected_pks(request):
+    return [int(pk) for pk in request.POST.getlist('pks') if pk.isdigit()]
+
+# レコード削除(POSTのみ)
+@query_budget(9)
+@login_required
+@require_POST
 def record_remove(request, pk):
     record = get_object_or_404(Record, pk=pk)
     record.delete()
     return redirect('expenses:record_list')
 
-# カテゴリ削除
+# カテゴリ削除(POSTのみ)
+# カテゴリのレコード・月次集計は読み込まず、DELETE文でまとめて消す(繰り返しのレコードは読み込んで消す)
+@query_budget(12)
+@login_required
+@require_POST
 def category_remove(request, pk):
-    category = get_object_or_404(Category, pk=pk)
-    category.delete()
+    if not bulk_delete(Category.objects.filter(pk=pk)):
+        raise Http404('カテゴリが見つかりません。')
     return redirect('expenses:category_list')
 
-# 支払い方法削除
+# 選んだカテゴリをまとめて削除(POSTのみ)
+@query_budget(12)
+@login_required
+@require_POST
+def category_bulk_remove(request):
+    bulk_delete(Category.objects.filter(pk__in=selected_pks(request)))
+    return redirect('expenses:category_list')
+
+# 支払い方法削除(POSTのみ)
+@query_budget(12)
+@login_required
+@require_POST
 def payment_remove(request, pk):
-    payment = get_object_or_404(Payment, pk=pk)
-    payment.delete()
+    if not bulk_delete(Payment.objects.filter(pk=pk)):
+        raise Http404('支払い方法が見つかりません。')
     return redirect('expenses:payment_list')
 
-# リストの重複を消してソートする関数
-def sorted_unique_list(lst):
-    return sorted(list(set(lst)), reverse=True)
+# 選んだ支払い方法をまとめて削除(POSTのみ)
+@query_budget(12)
+@login_required
+@require_POST
+def payment_bulk_remove(request):
+    bulk_delete(Payment.objects.filter(pk__in=selected_pks(request)))
+    return redirect('expenses:payment_list')
+
+# 繰り返しのレコード一覧
+# レコードは generate_recurring コマンドで作る
+@query_budget(3)
+@login_required
+def recurring_list(request):
+    recurring_records = RecurringRecord.objects.select_related('category', 'payment').order_by('start_date', 'pk')
+    return render(request, 'expenses/recurring_list.html', {'recurring_records': recurring_records})
+
+# 繰り返しのレコード追加
+@query_budget(4)
+@login_required
+def recurring_new(request):
+    if request.method == "POST":
+        form = RecurringRecordForm(request.POST)
+        if form.is_valid():
+            form.save()
+            return redirect('expenses:recurring_list')
+    else:
+        form = RecurringRecordForm(initial={'start_date': timezone.localdate()})
+    return render(request, 'expenses/recurring_edit.html', {'form': form})
+
+# 繰り返しのレコード編集
+# セッション・ユーザー・繰り返し・カテゴリと支払い方法(キャッシュが空のとき)・更新
+@query_budget(6)
+@login_required
+def recurring_edit(request, pk):
+    recurring_record = get_object_or_404(RecurringRecord, pk=pk)
+    if request.method == "POST":
+        form = RecurringRecordForm(request.POST, instance=recurring_record)
+        if form.is_valid():
+            form.save()
+            return redirect('expenses:recurring_list')
+    else:
+        form = RecurringRecordForm(instance=recurring_record)
+    return render(request, 'expenses/recurring_edit.html', {'form': form})
+
+# 繰り返しのレコード削除(POSTのみ)
+# 作成済みのレコードは残す(繰り返しとのつながりだけ外す)
+@query_budget(6)
+@login_required
+@require_POST
+def recurring_remove(request, pk):
+    recurring_record = get_object_or_404(RecurringRecord, pk=pk)
+    recurring_record.delete()
+    return redirect('expenses:recurring_list')
 
-# レコード集計用、フィルタ&合計関数
-def filter_sum(amounts, month, key=None, key_pk=None):
-    amount_filtered_month = filter(lambda x: x['expense_date'].strftime('%Y-%m') == month, amounts)
-    if key == None:
-        return sum(map(lambda x: x['total_price'], amount_filtered_month))
+# 予算の一覧と設定
+# ?month=YYYY-MM で月を選ぶ(省略時・正しくない指定は今月)
+@query_budget(7)
+@login_required
+def budget_list(request):
+    try:
+        month = datetime.datetime.strptime(request.GET.get('month', ''), '%Y-%m').date()
+    except ValueError:
+        month = current_month()
+    if request.method == "POST":
+        form = BudgetForm(request.POST)
+        if form.is_valid():
+            budget = form.save()
+            return redirect(reverse('expenses:budget_list') + '?month=' + budget.month.strftime('%Y-%m'))
     else:
-        amount_filtered = filter(lambda x: (x[key] == key_pk), amount_filtered_month)
-        return sum(map(lambda x: x['total_price'], amount_filtered))
-
-# 月+αでの金額集計用関数
-def amount_aggregate(months, amounts, key, contents):
-    return_dicts = []
-    for month in months:
-        dict_month = {'month': month, 'contents': []}
-        for content in contents:
-            dict_month['contents'].append({'con_pk': content.pk,
-             'con_name': content.name,
-             'amount': filter_sum(amounts, month, key, content.pk)})
-        return_dicts.append(dict_month)
-    return return_dicts
+        form = BudgetForm(initial={'month': month})
+    return render(request, 'expenses/budget_list.html', {'form': form, **budget_context(month)})
+
+# 予算削除(POSTのみ)
+@query_budget(4)
+@login_required
+@require_POST
+def budget_remove(request, pk):
+    budget = get_object_or_404(Budget, pk=pk)
+    budget.delete()
+    return redirect(reverse('expenses:budget_list') + '?month=' + budget.month.strftime('%Y-%m'))
+
+# 集計画面の絞り込みフォームと、表に並べるカテゴリ・支払い方法
+# 正しくない指定は無視して、全期間を月ごとに集計する
+def aggregate_filters(data):
+    form = AggregateFilterForm(data)
+    if form.is_valid():
+        filters = form.cleaned_data
+    else:
+        filters = {'granularity': 'month'}
+    categories = lookups.categories.all()
+    payments = lookups.payments.all()
+    if filters.get('categories'):
+        categories = [category for category in categories if category.pk in filters['categories']]
+    if filters.get('payments'):
+        payments = [payment for payment in payments if payment.pk in filters['payments']]
+    return form, filters, categories, payments
 
 # レコード集計画面
-def record_aggregate(request):
-    records = Record.objects.all()
-    categories = Category.objects.all()
-    payments = Payment.objects.all()
-    
-    # 「日、カテゴリ、支払い方法」で金額をまとめる
-    amounts = (
-        records
-        .values('expense_date', 'category', 'payment')
-        .annotate(total_price=Sum('amount'))
-    )
-    
-    # 集計用の月一覧
-    months = sorted_unique_list([amount['expense_date'].strftime('%Y-%m') for amount in amounts])
-    # 月で金額を集計
-    amounts_per_m = [{'month': month, 'amount': filter_sum(amounts, month)} for month in months]
-    # 月・カテゴリで金額を集計
-    amounts_per_m_c = amount_aggregate(months, amounts, 'category', categories)
-    # 月・支払い方法で金額を集計
-    amounts_per_m_p = amount_aggregate(months, amounts, 'payment', payments)
+# ?date_from=&date_to=&categories=&payments=&granularity= で期間・列・集計の単位を指定できる
+# 非同期のビュー。集計のクエリの間もスレッドを占有しない
+@query_budget(5)
+async def record_aggregate(request):
+    # フォームの選択肢・カテゴリの一覧はキャッシュ(空ならDB)から読むのでスレッドで作る
+    form, filters, categories, payments = await sync_to_async(aggregate_filters)(request.GET)
 
+    # 絞り込みと「期間、カテゴリ、支払い方法」ごとの合計はDBで行い、1回の走査で各集計表を作る
+    amounts = [row async for row in period_amounts(**filters)]
     context = {
-        'amounts': amounts,
+        'form': form,
         'categories': categories,
         'payments': payments,
-        'amounts_per_m': amounts_per_m,
-        'amounts_per_m_c': amounts_per_m_c,
-        'amounts_per_m_p': amounts_per_m_p,
+        'period_label': GRANULARITIES[filters['granularity']][2],
     }
-    return render(request, 'expenses/record_aggregate.html', context)
+    context.update(build_pivots(amounts, categories, payments, filters['granularity']))
+    return await asynchronous.render(request, 'expenses/record_aggregate.html', context)
 
 # カテゴリCSVインポート
 class RecordImport(generic.FormView):
     template_name = 'expenses/record_import.html'
     success_url = reverse_lazy('expenses:record_list')
     form_class = CSVUploadForm
+    # リクエスト内で取り込むとき(CSV_IMPORT_IN_BACKGROUND = False)の、1バッチ(1000行)分
+    query_budget = 25
 
     def form_valid(self, form):
-        form.save()
+        if settings.CSV_IMPORT_IN_BACKGROUND:
+            # 取り込みはバックグラウンドで行い、すぐにジョブの進捗画面へ移る
+            job = form.enqueue()
+            return redirect('imports:job_detail', pk=job.pk)
+        result = form.save()
+        if result is None:
+            return self.form_invalid(form)
+        if result.errors:
+            # 取り込めなかった行があれば、その一覧を表示する
+            return self.render_to_response(self.get_context_data(form=form, result=result))
         return redirect('expenses:record_list')
 
-# カテゴリCSVエクスポート
-def record_export(request):
-    response = HttpResponse(content_type='text/csv')
-    response['Content-Disposition'] = 'attachment; filename="records.csv"'
-    # HttpResponseオブジェクトはファイルっぽいオブジェクトなので、csv.writerにそのまま渡せる
-    writer = csv.writer(response)
-    records = Record.objects.all()
-    for record in records:
-        writer.writerow(
-            [record.pk,
-             record.created_date.strftime('%Y-%m-%d %H:%M:%S %z'),
-             record.expense_date.strftime('%Y-%m-%d'),
-             record.amount,
-             record.category,
-             record.payment,
-             record.note
-             ]
-        )
-    return response
+# エクスポートするCSVの1行
+def export_row(record):
+    pk, created_date, expense_date, amount, category, payment, note = record
+    return [
+        pk,
+        created_date.strftime('%Y-%m-%d %H:%M:%S %z'),
+        expense_date.strftime('%Y-%m-%d') if expense_date else '',
+        amount,
+        category,
+        payment,
+        note,
+    ]
 
+# カテゴリCSVエクスポート
+# 非同期のビュー。ASGIでは EXPORT_CHUNK_SIZE 行ずつ async ORM で読みながら返すので、
+# 遅いダウンロードがいくつあっても、スレッドを使うのは行を読む間だけになる
+@query_budget(18)
+async def record_export(request):
+    records = (
+        Record.objects
+        .order_by('pk')
+        # named=True でないと aiterator() が最初のクエリをイベントループ上で実行してしまう(Django 5.2)
+        .values_list('pk', 'created_date', 'expense_date', 'amount', 'category__name', 'payment__name', 'note',
+                     named=True)
+    )
+    return queryset_csv_response(request, records, export_row, 'records.csv')
@@ -0,0 +1,38 @@
+import time
+from django.core.management.base import BaseCommand
+from imports.models import ImportJob
+
+
+class Command(BaseCommand):
+    help = '待機中のCSV取り込みジョブを順番に実行します。--once を付けなければ新しいジョブを待ち続けます。'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='待機中のジョブを処理したら終了する')
+        parser.add_argument('--interval', type=float, default=2.0, help='ジョブがないときに待つ秒数')
+
+    def handle(self, *args, **options):
+        while True:
+            ran = self.run_pending()
+            if options['once']:
+                break
+            if not ran:
+                time.sleep(options['interval'])
+
+    # 待機中のジョブを古い順に1件ずつ取って実行する。実行した件数を返す
+    def run_pending(self):
+        ran = 0
+        while True:
+            job = ImportJob.objects.filter(status=ImportJob.PENDING).order_by('created_date', 'pk').first()
+            if job is None:
+                return ran
+            if not job.claim():
+                continue
+            self.stdout.write('Running %s' % job)
+            try:
+                job.run()
+            except Exception as e:
+                self.stderr.write('%s failed: %r' % (job, e))
+            else:
+                self.stdout.write('%s: %d rows (%d failed) in %.1fs' % (
+                    job, job.rows_processed, job.rows_failed, job.elapsed))
+            ran += 1
@@ -0,0 +1,117 @@
+from django.db import models
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from mysite.csv_import import CSVImportError
+
+# 取り込みの種類と、使う取り込み処理クラス・画面のベーステンプレート
+IMPORTERS = {
+    'expenses.record': ('expenses.importers.RecordImporter', 'expenses/base.html'),
+    'blog.post': ('blog.importers.PostImporter', 'blog/base.html'),
+}
+
+# ジョブに保存しておくエラー行の最大数(件数は rows_failed に全部数える)
+MAX_STORED_ERRORS = 1000
+
+
+class ImportJob(models.Model):
+    """バックグラウンドで実行するCSV取り込み(manage.py run_import_jobs が処理する)"""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (PENDING, '待機中'),
+        (RUNNING, '実行中'),
+        (DONE, '完了'),
+        (FAILED, '失敗'),
+    )
+
+    kind = models.CharField(max_length=50, choices=[(kind, kind) for kind in IMPORTERS])
+    file = models.FileField(upload_to='imports/')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING, db_index=True)
+    rows_processed = models.IntegerField(default=0)
+    rows_failed = models.IntegerField(default=0)
+    rows_created = models.IntegerField(default=0)
+    rows_updated = models.IntegerField(default=0)
+    # 取り込めなかった行。1行に「行番号<TAB>メッセージ」
+    errors = models.TextField(blank=True)
+    message = models.TextField(blank=True)
+    created_date = models.DateTimeField(default=timezone.now)
+    started_date = models.DateTimeField(blank=True, null=True)
+    finished_date = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return '%s #%s (%s)' % (self.kind, self.pk, self.status)
+
+    @property
+    def base_template(self):
+        return IMPORTERS[self.kind][1]
+
+    @property
+    def elapsed(self):
+        if self.started_date is None:
+            return 0
+        return ((self.finished_date or timezone.now()) - self.started_date).total_seconds()
+
+    # 1秒あたりの処理行数
+    @property
+    def throughput(self):
+        elapsed = self.elapsed
+        return self.rows_processed / elapsed if elapsed else 0
+
+    def error_list(self):
+        return [tuple(line.split('\t', 1)) for line in self.errors.splitlines()]
+
+    # 待機中なら実行中にする。他のワーカーが先に取った場合はFalse
+    def claim(self):
+        claimed = ImportJob.objects.filter(pk=self.pk, status=self.PENDING).update(
+            status=self.RUNNING, started_date=timezone.now())
+        if claimed:
+            self.refresh_from_db()
+        return bool(claimed)
+
+    def run(self):
+        importer = import_string(IMPORTERS[self.kind][0])(atomic=False)
+        try:
+            with self.file.open('rb') as file:
+                result = importer.run(file, progress=self.update_progress)
+        except CSVImportError as e:
+            self.finish(self.FAILED, str(e))
+        except Exception as e:
+            self.finish(self.FAILED, repr(e))
+            raise
+        else:
+            self.finish(self.DONE)
+        return self
+
+    # 途中経過を保存する(取り込みはバッチごとにコミットされるので、他のリクエストから見える)
+    def update_progress(self, result):
+        self.rows_processed = result.processed
+        self.rows_failed = len(result.errors)
+        self.rows_created = result.created
+        self.rows_updated = result.updated
+        self.errors = ''.join(
+            '%s\t%s\n' % (line, message) for line, message in result.errors[:MAX_STORED_ERRORS])
+        self.save(update_fields=['rows_processed', 'rows_failed', 'rows_created', 'rows_updated', 'errors'])
+
+    # 終わった(失敗した)ジョブのアップロードされたファイルは、取り込み直さないので消しておく
+    def finish(self, status, message=''):
+        self.file.delete(save=False)
+        self.status = status
+        self.message = message
+        self.finished_date = timezone.now()
+        self.save(update_fields=['file', 'status', 'message', 'finished_date'])
+
+    def as_dict(self):
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'status': self.status,
+            'rows_processed': self.rows_processed,
+            'rows_failed': self.rows_failed,
+            'rows_created': self.rows_created,
+            'rows_updated': self.rows_updated,
+            'elapsed': round(self.elapsed, 3),
+            'throughput': round(self.throughput, 1),
+            'message': self.message,
+        }
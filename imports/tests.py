@@ -0,0 +1,99 @@
+import datetime
+import io
+import os
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from expenses import rollup
+from expenses.models import Record, Category, Payment, MonthlyRollup
+from mysite.testing import CleanCacheTestCase
+from .models import ImportJob
+
+
+class ImportJobTests(CleanCacheTestCase):
+    """バックグラウンドのCSV取り込みジョブの取得・実行・進捗"""
+
+    @classmethod
+    def setUpTestData(cls):
+        User.objects.create_user('tester', password='password')
+        category = Category.objects.create(name='カテゴリ')
+        payment = Payment.objects.create(name='支払い')
+        cls.record = Record.objects.create(expense_date=datetime.date(2020, 1, 5), amount=100,
+                                           category=category, payment=payment, note='用途')
+
+    def job(self, content, kind='expenses.record'):
+        job = ImportJob(kind=kind)
+        job.file.save('records.csv', ContentFile(content), save=False)
+        job.save()
+        return job
+
+    def test_claim_only_once(self):
+        job = self.job(b'')
+        self.assertTrue(job.claim())
+        self.assertEqual(job.status, ImportJob.RUNNING)
+        self.assertIsNotNone(job.started_date)
+        self.assertFalse(ImportJob.objects.get(pk=job.pk).claim())
+
+    def test_run(self):
+        job = self.job((
+            ',2020-01-01 00:00:00 +0900,2020-02-01,300,カテゴリ,支払い,新規\n'
+            '%d,2020-01-01 00:00:00 +0900,2020-01-05,500,カテゴリ,支払い,更新\n'
+            ',2020-01-01 00:00:00 +0900,2020-02-01,300,なし,支払い,エラー\n' % self.record.pk).encode())
+        path = job.file.path
+        job.claim()
+        job.run()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.DONE)
+        self.assertEqual((job.rows_processed, job.rows_created, job.rows_updated, job.rows_failed), (3, 1, 1, 1))
+        self.assertEqual(job.error_list(), [('3', 'カテゴリ「なし」が見つかりません。')])
+        self.assertEqual(rollup.compare(Record, MonthlyRollup), {})
+        # 取り込み終わったファイルは消える
+        self.assertFalse(os.path.exists(path))
+        self.assertFalse(job.file)
+
+    def test_failed_run_deletes_file(self):
+        job = self.job(b'\xff\xfe\x00')
+        path = job.file.path
+        job.claim()
+        job.run()
+        job.refresh_from_db()
+        self.assertEqual(job.status, ImportJob.FAILED)
+        self.assertIn('エンコーディング', job.message)
+        self.assertFalse(os.path.exists(path))
+
+    def test_progress(self):
+        job = self.job(b'')
+        self.client.login(username='tester', password='password')
+        self.assertEqual(self.client.get('/imports/%d/progress/' % job.pk).json()['status'], ImportJob.PENDING)
+        job.claim()
+        job.run()
+        response = self.client.get('/imports/%d/progress/' % job.pk)
+        self.assertEqual(response.json(), ImportJob.objects.get(pk=job.pk).as_dict())
+        self.assertEqual(response.json()['status'], ImportJob.DONE)
+        self.assertEqual(self.client.get('/imports/%d/' % job.pk).status_code, 200)
+        self.assertEqual(self.client.get('/imports/999/progress/').status_code, 404)
+
+
+class RunImportJobsTests(CleanCacheTestCase):
+    """run_import_jobs コマンド(ワーカー)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Category.objects.create(name='カテゴリ')
+        Payment.objects.create(name='支払い')
+
+    def test_runs_pending_jobs_in_order(self):
+        for amount in (100, 200):
+            job = ImportJob(kind='expenses.record')
+            job.file.save('records.csv', ContentFile(
+                (',2020-01-01 00:00:00 +0900,2020-01-05,%d,カテゴリ,支払い,用途\n' % amount).encode()), save=False)
+            job.save()
+        out = io.StringIO()
+        call_command('run_import_jobs', '--once', stdout=out, stderr=io.StringIO())
+        self.assertEqual(set(ImportJob.objects.values_list('status', flat=True)), {ImportJob.DONE})
+        self.assertEqual(list(Record.objects.order_by('pk').values_list('amount', flat=True)), [100, 200])
+        self.assertEqual(out.getvalue().count('Running'), 2)
+        # 待機中のジョブがなければ何もしない
+        out = io.StringIO()
+        call_command('run_import_jobs', '--once', stdout=out)
+        self.assertEqual(out.getvalue(), '')
@@ -0,0 +1,8 @@
+from django.urls import path
+from . import views
+
+app_name = 'imports'
+urlpatterns = [
+    path('<int:pk>/', views.job_detail, name='job_detail'),
+    path('<int:pk>/progress/', views.job_progress, name='job_progress'),
+]
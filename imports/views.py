@@ -0,0 +1,16 @@
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse
+from django.shortcuts import render, get_object_or_404
+from .models import ImportJob
+
+# 取り込みジョブの状況画面
+@login_required
+def job_detail(request, pk):
+    job = get_object_or_404(ImportJob, pk=pk)
+    return render(request, 'imports/job_detail.html', {'job': job})
+
+# 取り込みジョブの進捗(JSON)
+@login_required
+def job_progress(request, pk):
+    job = get_object_or_404(ImportJob, pk=pk)
+    return JsonResponse(job.as_dict())
@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class MysiteConfig(AppConfig):
+    name = 'mysite'
+
+    def ready(self):
+        # データベースに接続したときの設定(SQLiteのPRAGMA)と、クエリの計測を登録する
+        from . import db, performance  # noqa: F401
@@ -0,0 +1,20 @@
+"""
+ASGI config for mysite project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mysite.settings')
+# ASGIではDBを読むスレッドがリクエストごとに変わり、使い回す接続が閉じられずに残るので、
+# DATABASE_CONN_MAX_AGE の指定にかかわらずリクエストごとに接続し直す(設定を読み込む前に上書きする)
+CONN_MAX_AGE = 0
+os.environ['DATABASE_CONN_MAX_AGE'] = str(CONN_MAX_AGE)
+
+application = get_asgi_application()
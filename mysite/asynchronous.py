@@ -0,0 +1,25 @@
+from asgiref.sync import sync_to_async
+from django import shortcuts
+from django.core.paginator import Paginator
+
+
+# 非同期のビューからテンプレートを描画する
+# 描画中の遅延読み込み(関連先・request.user など)はクエリになるので、リクエストのスレッドで行う
+async def render(request, template_name, context=None):
+    return await sync_to_async(shortcuts.render)(request, template_name, context)
+
+
+# ログインしているか
+# request.user の読み込み(セッション・ユーザーのクエリ)はスレッドで行い、読み込んだユーザーは
+# request.user に残す(request.auser() と違い、テンプレートの描画でもう一度読み込まない)
+async def is_authenticated(request):
+    return await sync_to_async(lambda: request.user.is_authenticated)()
+
+
+# Paginator.get_page の非同期版。件数と、表示するページの行は async ORM で読む
+async def get_page(queryset, per_page, number):
+    paginator = Paginator(queryset, per_page)
+    paginator.count = await queryset.acount()
+    page = paginator.get_page(number)
+    page.object_list = [obj async for obj in page.object_list]
+    return page
@@ -0,0 +1,119 @@
+import csv
+import io
+from contextlib import nullcontext
+from django.conf import settings
+from django.db import transaction
+
+
+class CSVImportError(Exception):
+    """ファイル全体を取り込めないときのエラー
+
+    atomic=True なら取り込みはすべて取り消される。atomic=False ではエラーまでにコミットしたバッチは残る。
+    """
+
+
+class RowError(Exception):
+    """1行分を取り込めないときのエラー(その行だけ飛ばして続ける)"""
+
+
+class ImportResult:
+    """取り込み結果。errors は (行番号, メッセージ) のリスト"""
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.errors = []
+
+    @property
+    def processed(self):
+        return self.created + self.updated + len(self.errors)
+
+
+class CSVImporter:
+    """CSVを1行ずつ読みながら、batch_size件ごとにbulk_create/bulk_updateで書き込む取り込み処理
+
+    サブクラスでは model・update_fields を指定し、load_lookups() で名前->pkの辞書を用意して、
+    build() で1行からモデルインスタンスを作る。1列目が空の行は新規作成、pkが入っている行は更新になる。
+    """
+    model = None
+    update_fields = []
+
+    def __init__(self, batch_size=None, atomic=True):
+        self.batch_size = batch_size or getattr(settings, 'CSV_IMPORT_BATCH_SIZE', 1000)
+        # Falseにするとバッチごとにコミットする(バックグラウンド処理で途中経過を見せるため)
+        self.atomic = atomic
+
+    def load_lookups(self):
+        pass
+
+    def build(self, row):
+        raise NotImplementedError
+
+    # 更新対象のpkのうちDBに存在するもの。値は after_write() に渡される
+    def existing(self, pks):
+        return dict.fromkeys(self.model.objects.filter(pk__in=pks).values_list('pk', flat=True))
+
+    # バッチを書き込んだ後の処理(集計テーブルの更新など)
+    def after_write(self, created, updated, existing):
+        pass
+
+    # progress を渡すと、バッチを書き込むたびに途中の ImportResult を渡して呼び出す
+    def run(self, file, progress=None):
+        result = ImportResult()
+        # csv.readerに渡すため、TextIOWrapperでテキストモードなファイルに変換(全体は読み込まない)
+        reader = csv.reader(io.TextIOWrapper(file, encoding='utf-8', newline=''))
+        try:
+            with transaction.atomic() if self.atomic else nullcontext():
+                self.load_lookups()
+                creates, updates = [], []
+                for line, row in enumerate(reader, 1):
+                    try:
+                        instance = self.build(row)
+                    except RowError as e:
+                        result.errors.append((line, str(e)))
+                        continue
+                    except IndexError:
+                        result.errors.append((line, '列が足りません。'))
+                        continue
+                    except ValueError as e:
+                        result.errors.append((line, '値の形式が正しくありません。(%s)' % e))
+                        continue
+                    if instance.pk is None:
+                        creates.append(instance)
+                    else:
+                        updates.append((line, instance))
+                    if len(creates) + len(updates) >= self.batch_size:
+                        self.write(creates, updates, result)
+                        creates, updates = [], []
+                        if progress:
+                            progress(result)
+                self.write(creates, updates, result)
+        except (UnicodeDecodeError, csv.Error):
+            raise CSVImportError('ファイルのエンコーディングや、正しいCSVファイルか確認ください。')
+        if progress:
+            progress(result)
+        return result
+
+    def write(self, creates, updates, result):
+        existing = self.existing([instance.pk for line, instance in updates]) if updates else {}
+        updated = []
+        seen = set()
+        for line, instance in updates:
+            if instance.pk not in existing:
+                result.errors.append((line, 'ID %s のデータが見つかりません。' % instance.pk))
+            elif instance.pk in seen:
+                # 同じpkを1回の bulk_update で2度書くと、集計には両方の値が入るのに最後の行しか残らない
+                result.errors.append((line, 'ID %s が同じバッチ内の前の行と重複しています。' % instance.pk))
+            else:
+                seen.add(instance.pk)
+                updated.append(instance)
+        # 1回のSQLに入れる件数はDBの上限に合わせてDjangoが決める
+        # バッチ単位でコミットするときも、書き込みと集計の更新は同じトランザクションで行う
+        with transaction.atomic():
+            if creates:
+                self.model.objects.bulk_create(creates)
+            if updated:
+                self.model.objects.bulk_update(updated, fields=self.update_fields)
+            self.after_write(creates, updated, existing)
+        result.created += len(creates)
+        result.updated += len(updated)
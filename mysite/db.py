@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+# SQLiteに接続したら settings.SQLITE_PRAGMAS を設定する
+# journal_mode はデータベースファイルに記録され、変えるには排他ロックが要るので、違うときだけ設定する
+# (同時に接続したワーカーが揃って設定し直そうとして database is locked にならないように)
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in getattr(settings, 'SQLITE_PRAGMAS', {}).items():
+            if name == 'journal_mode':
+                cursor.execute('PRAGMA journal_mode')
+                if cursor.fetchone()[0].lower() == str(value).lower():
+                    continue
+            cursor.execute('PRAGMA %s = %s' % (name, value))
@@ -0,0 +1,30 @@
+from django.db import router, transaction
+from django.db.models.deletion import Collector
+
+# signals のためにモデルを読み込んで削除するとき、1回に読み込む件数
+DELETE_CHUNK_SIZE = 1000
+
+
+# queryset の行を、CASCADE でつながる行も含めて削除し、queryset のモデルの削除件数を返す
+# 自身にも CASCADE 先にも signals がつながっていなければ、行を読み込まずに DELETE 文だけで消す。
+# つながっていれば DELETE_CHUNK_SIZE 件ずつ Django の削除処理に任せる(signals は送られ、
+# 読み込むのは1チャンク分だけ)。signals のない CASCADE 先はどちらの場合も DELETE 文1つで消える
+def bulk_delete(queryset, chunk_size=DELETE_CHUNK_SIZE):
+    model = queryset.model
+    using = router.db_for_write(model)
+    with transaction.atomic(using=using):
+        if Collector(using=using).can_fast_delete(queryset):
+            return raw_delete(queryset)
+        pks = queryset.order_by('pk').values_list('pk', flat=True)
+        deleted = 0
+        while True:
+            chunk = list(pks[:chunk_size])
+            if not chunk:
+                return deleted
+            deleted += model._base_manager.filter(pk__in=chunk).delete()[1].get(model._meta.label, 0)
+
+
+# queryset の行を signals を送らずに DELETE 文1つで消し、削除件数を返す
+# CASCADE 先のないモデル用。signals で行っている処理(キャッシュの更新など)は呼び出し側で行うこと
+def raw_delete(queryset):
+    return queryset._raw_delete(router.db_for_write(queryset.model))
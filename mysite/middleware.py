@@ -0,0 +1,60 @@
+import logging
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from .performance import QueryBudgetExceeded, RequestMetrics, collect, get_query_budget, stats
+
+logger = logging.getLogger('mysite.performance')
+
+
+class PerformanceMiddleware:
+    """ビューごとにクエリ数・SQLの時間・テンプレートの描画時間・全体の時間を計測する
+
+    結果は Server-Timing ヘッダーで返し、ビュー名ごとに stats に貯める(/stats/ で見られる)。
+    クエリ数がビューの query_budget を超えたときは警告をログに出す。
+    PERFORMANCE_STRICT_BUDGETS なら QueryBudgetExceeded を送出する(テストが失敗するように)。
+    StreamingHttpResponse は本文を返しながらクエリを発行するので、その分は計測に含まれない。
+    ASGI では非同期のまま動く(非同期のビューの前後でスレッドに切り替えない)。
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        start = time.perf_counter()
+        with collect(metrics):
+            response = self.get_response(request)
+        return self.process(request, response, metrics, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        start = time.perf_counter()
+        with collect(metrics):
+            response = await self.get_response(request)
+        return self.process(request, response, metrics, time.perf_counter() - start)
+
+    def process(self, request, response, metrics, wall_time):
+        match = request.resolver_match
+        if match is None:
+            return response
+        stats.add(match.view_name, wall_time, metrics)
+        if getattr(settings, 'PERFORMANCE_SERVER_TIMING', True):
+            response['Server-Timing'] = ', '.join([
+                'db;dur=%.1f;desc="%d queries"' % (metrics.sql_time * 1000, metrics.queries),
+                'tpl;dur=%.1f' % (metrics.template_time * 1000),
+                'total;dur=%.1f' % (wall_time * 1000),
+            ])
+        budget = get_query_budget(match.func)
+        if budget is not None and metrics.queries > budget:
+            args = (match.view_name, metrics.queries, budget, request.get_full_path())
+            if getattr(settings, 'PERFORMANCE_STRICT_BUDGETS', False):
+                raise QueryBudgetExceeded('%s issued %d queries (budget %d): %s' % args)
+            logger.warning('%s issued %d queries (budget %d): %s', *args)
+        return response
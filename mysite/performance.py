@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+from django.template.backends.django import DjangoTemplates, Template
+
+# 実行中のリクエストの計測値
+# スレッドではなくコンテキストごとに持つので、非同期のビューが sync_to_async で別のスレッドから
+# 発行したクエリや描画したテンプレートも、そのリクエストの計測値に入る
+_current = ContextVar('mysite.performance.metrics', default=None)
+
+
+class RequestMetrics:
+    """1リクエスト分の計測値(クエリ数・SQLの時間・テンプレートの描画時間、時間はすべて秒)"""
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+
+    # connection.execute_wrapper() に渡して、SQLの実行を数えて時間を測る
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.queries += 1
+
+
+@contextmanager
+def collect(metrics):
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+# すべての接続に登録しておく execute_wrapper。計測中のリクエストがあれば、その計測値に加える
+def measure_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    return metrics(execute, sql, params, many, context)
+
+
+# 接続(スレッドごとに作られる)ができたら measure_query を登録する(接続し直しても1つだけ)
+@receiver(connection_created)
+def install_query_wrapper(sender, connection, **kwargs):
+    if measure_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(measure_query)
+
+
+class TimedTemplate(Template):
+
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """テンプレートの描画時間を計測中のリクエストに加算するテンプレートエンジン"""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
+
+
+class ViewStats:
+    """ビューごとの直近の計測値(プロセス内)。パーセンタイルを計算して返す"""
+
+    def __init__(self, window=None):
+        self.window = window or getattr(settings, 'PERFORMANCE_STATS_WINDOW', 1000)
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def add(self, view_name, wall_time, metrics):
+        sample = (wall_time, metrics.sql_time, metrics.template_time, metrics.queries)
+        with self._lock:
+            samples = self._samples.get(view_name)
+            if samples is None:
+                samples = self._samples[view_name] = deque(maxlen=self.window)
+            samples.append(sample)
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+    @staticmethod
+    def percentiles(values):
+        values = sorted(values)
+        return {
+            'p%d' % p: values[min(len(values) - 1, int(len(values) * p / 100))]
+            for p in (50, 95, 99)
+        }
+
+    # ビュー名 -> 計測項目 -> p50/p95/p99(時間はミリ秒)
+    def summary(self):
+        with self._lock:
+            samples = {name: list(values) for name, values in self._samples.items()}
+        result = {}
+        for name, values in sorted(samples.items()):
+            wall, sql, template, queries = zip(*values)
+            result[name] = {
+                'count': len(values),
+                'wall_ms': self.percentiles([value * 1000 for value in wall]),
+                'sql_ms': self.percentiles([value * 1000 for value in sql]),
+                'template_ms': self.percentiles([value * 1000 for value in template]),
+                'queries': self.percentiles(queries),
+            }
+        return result
+
+
+stats = ViewStats()
+
+
+class QueryBudgetExceeded(Exception):
+    """ビューのクエリ数が query_budget を超えた(PERFORMANCE_STRICT_BUDGETS のとき)"""
+
+
+# ビューが1リクエストで発行してよいクエリ数の上限を宣言する(テストで超えていないか確かめる)
+# クラスベースのビューはクラス属性 query_budget で宣言する
+def query_budget(count):
+    def decorator(view):
+        view.query_budget = count
+        return view
+    return decorator
+
+
+def get_query_budget(view):
+    budget = getattr(view, 'query_budget', None)
+    if budget is None and hasattr(view, 'view_class'):
+        budget = getattr(view.view_class, 'query_budget', None)
+    return budget
@@ -0,0 +1,152 @@
+import sqlite3
+from functools import reduce
+from operator import and_, or_
+from django.db import connections
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+# SQLite 3.34以降はtrigramトークナイザで部分一致(日本語のように単語の区切りがない文も)を索引できる
+# それより古いSQLiteでは単語単位(unicode61)で索引し、前方一致で検索する
+SQLITE_TRIGRAM = sqlite3.sqlite_version_info >= (3, 34, 0)
+# SQLite 3.35以降は WITH ... AS MATERIALIZED で、サブクエリを行ごとではなく1回だけ実行させられる
+SQLITE_MATERIALIZED = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+class FullTextIndex:
+    """テーブルの文字列カラムに対する全文検索インデックス
+
+    SQLiteではFTS5の外部コンテンツテーブルを作り、トリガーで元テーブルのINSERT/UPDATE/DELETEを反映する
+    (bulk_create・bulk_update・一括削除も含めてDB側で同期される)。
+    PostgreSQLではpg_trgmのGINインデックスを作り、icontains(ILIKE)をインデックスで引けるようにする。
+    """
+
+    # weights はカラムごとの関連度の重み(タイトルを本文より重く、など)
+    def __init__(self, table, columns, pk='id', weights=None):
+        self.table = table
+        self.columns = list(columns)
+        self.pk = pk
+        self.weights = weights
+        self.fts_table = table + '_fts'
+
+    def _triggers(self):
+        fts, columns = self.fts_table, ', '.join(self.columns)
+        new_values = ', '.join('new.%s' % column for column in self.columns)
+        old_values = ', '.join('old.%s' % column for column in self.columns)
+        insert = 'INSERT INTO %s(rowid, %s) VALUES (new.%s, %s);' % (fts, columns, self.pk, new_values)
+        delete = "INSERT INTO %s(%s, rowid, %s) VALUES ('delete', old.%s, %s);" % (
+            fts, fts, columns, self.pk, old_values)
+        return {
+            fts + '_ai': 'AFTER INSERT ON %s BEGIN %s END' % (self.table, insert),
+            fts + '_ad': 'AFTER DELETE ON %s BEGIN %s END' % (self.table, delete),
+            fts + '_au': 'AFTER UPDATE OF %s ON %s BEGIN %s %s END' % (columns, self.table, delete, insert),
+        }
+
+    def _sqlite_statements(self):
+        tokenize = "tokenize='trigram'" if SQLITE_TRIGRAM else "prefix='2 3'"
+        statements = [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='%s', content_rowid='%s', %s)" % (
+                self.fts_table, ', '.join(self.columns), self.table, self.pk, tokenize),
+        ]
+        statements += [
+            'CREATE TRIGGER IF NOT EXISTS %s %s' % (name, body) for name, body in self._triggers().items()
+        ]
+        return statements
+
+    def _postgresql_statements(self):
+        statements = ['CREATE EXTENSION IF NOT EXISTS pg_trgm']
+        statements += [
+            'CREATE INDEX IF NOT EXISTS %s_%s_trgm ON %s USING gin (%s gin_trgm_ops)' % (
+                self.table, column, self.table, column)
+            for column in self.columns
+        ]
+        return statements
+
+    # インデックスを作り、既存の行から作り直す(マイグレーションから呼ぶ)
+    def install(self, connection):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                for statement in self._sqlite_statements():
+                    cursor.execute(statement)
+                if self.weights:
+                    cursor.execute("INSERT INTO %s(%s, rank) VALUES ('rank', %%s)" % (self.fts_table, self.fts_table),
+                                   ['bm25(%s)' % ', '.join(str(float(weight)) for weight in self.weights)])
+                cursor.execute("INSERT INTO %s(%s) VALUES ('rebuild')" % (self.fts_table, self.fts_table))
+            elif connection.vendor == 'postgresql':
+                for statement in self._postgresql_statements():
+                    cursor.execute(statement)
+
+    def uninstall(self, connection):
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                for name in self._triggers():
+                    cursor.execute('DROP TRIGGER IF EXISTS %s' % name)
+                cursor.execute('DROP TABLE IF EXISTS %s' % self.fts_table)
+            elif connection.vendor == 'postgresql':
+                for column in self.columns:
+                    cursor.execute('DROP INDEX IF EXISTS %s_%s_trgm' % (self.table, column))
+
+    # SQLiteではテーブルを作り直すマイグレーション(カラム追加など)でトリガーが消えるので、
+    # migrate の後に足りないものがあれば作り直して索引を再構築する
+    def ensure(self, connection):
+        if connection.vendor != 'sqlite':
+            return
+        expected = {self.fts_table} | set(self._triggers())
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT name FROM sqlite_master WHERE name IN (%s)" % ', '.join(['%s'] * len(expected)),
+                list(expected))
+            existing = {row[0] for row in cursor.fetchall()}
+        # 全文検索テーブル自体がなければ未インストール(マイグレーション前)なので何もしない
+        if self.fts_table in existing and existing != expected:
+            self.install(connection)
+
+    def _match_expression(self, terms):
+        if SQLITE_TRIGRAM:
+            return ' '.join('"%s"' % term.replace('"', '""') for term in terms)
+        return ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+
+    # queryset を検索語(空白区切りはAND)で絞り込む。ranked=True なら関連度の高い順に並べる
+    # DBの種類は queryset の読み込み先(queryset.db)で判断する
+    def search(self, queryset, query, ranked=False):
+        terms = query.split()
+        if not terms:
+            return queryset
+        vendor = connections[queryset.db].vendor
+        if vendor == 'sqlite':
+            # trigramは3文字未満の語を索引できないので、その語だけは通常の部分一致で絞り込む
+            indexed = [term for term in terms if len(term) >= 3 or not SQLITE_TRIGRAM]
+            short = [term for term in terms if term not in indexed]
+            queryset = self._contains(queryset, short)
+            if not indexed:
+                return queryset
+            match = self._match_expression(indexed)
+            # 一致した行のrowidを全文検索テーブルから1回で引き、pk IN (サブクエリ) で絞り込む
+            queryset = queryset.filter(pk__in=RawSQL(
+                'SELECT rowid FROM %s WHERE %s MATCH %%s' % (self.fts_table, self.fts_table), [match]))
+            if ranked:
+                # FTS5の rank 列(bm25)は小さいほど関連度が高い
+                # 一致した行の (rowid, rank) は行ごとではなく1回だけ求めて、そこから各行のrankを引く
+                # (MATERIALIZED がないと行ごとに MATCH をやり直すので、一致が多いと遅い)
+                matched = 'SELECT rowid, rank FROM %s WHERE %s MATCH %%s' % (self.fts_table, self.fts_table)
+                materialized = 'MATERIALIZED ' if SQLITE_MATERIALIZED else ''
+                queryset = queryset.annotate(search_rank=RawSQL(
+                    'WITH matched AS %s(%s) SELECT matched.rank FROM matched WHERE matched.rowid = %s.%s' % (
+                        materialized, matched, self.table, self.pk),
+                    [match])).order_by('search_rank')
+            return queryset
+        queryset = self._contains(queryset, terms)
+        if ranked and vendor == 'postgresql':
+            from django.contrib.postgres.search import TrigramSimilarity
+            from django.db.models.functions import Greatest
+
+            similarities = [TrigramSimilarity(column, query) for column in self.columns]
+            rank = Greatest(*similarities) if len(similarities) > 1 else similarities[0]
+            queryset = queryset.annotate(search_rank=rank).order_by('-search_rank')
+        return queryset
+
+    def _contains(self, queryset, terms):
+        if not terms:
+            return queryset
+        return queryset.filter(reduce(and_, [
+            reduce(or_, [Q(**{column + '__icontains': term}) for column in self.columns]) for term in terms
+        ]))
@@ -30,6 +30,7 @@ ALLOWED_HOSTS = ['127.0.0.1', '.pythonanywhere.com']
 # Application definition
 
 INSTALLED_APPS = [
+    'mysite.apps.MysiteConfig',
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -38,9 +39,12 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'blog.apps.BlogConfig',
     'expenses.apps.ExpensesConfig',
+    'imports.apps.ImportsConfig',
+    'benchmarks.apps.BenchmarksConfig',
 ]
 
 MIDDLEWARE = [
+    'mysite.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,7 +58,8 @@ ROOT_URLCONF = 'mysite.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # 描画時間を計測するため、DjangoTemplates を継承したエンジンを使う
+        'BACKEND': 'mysite.performance.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -69,16 +74,61 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'mysite.wsgi.application'
+# 非同期のビュー(ブログの投稿一覧・詳細、家計簿のCSVエクスポート・集計)は ASGI で動かすと
+# スレッドを占有せずに同時に多くのリクエストを扱える(uvicorn mysite.asgi:application など)
+# ASGIではDBを読むスレッドがリクエストごとに変わり、接続を使い回せないので mysite/asgi.py が DATABASE_CONN_MAX_AGE=0 にする
+ASGI_APPLICATION = 'mysite.asgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# データベースは環境変数で切り替える
+#   DATABASE_ENGINE: 'sqlite'(既定)か 'postgresql'(psycopg2 が必要)
+#   DATABASE_NAME・DATABASE_USER・DATABASE_PASSWORD・DATABASE_HOST・DATABASE_PORT: 接続先
+#   DATABASE_CONN_MAX_AGE: 接続を使い回す秒数(0ならリクエストごとに接続し直す、'none' なら無期限)
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+if DATABASE_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DATABASE_NAME', 'mysite'),
+            'USER': os.environ.get('DATABASE_USER', ''),
+            'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+            'HOST': os.environ.get('DATABASE_HOST', ''),
+            'PORT': os.environ.get('DATABASE_PORT', ''),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DATABASE_NAME', os.path.join(BASE_DIR, 'db.sqlite3')),
+            'OPTIONS': {
+                # トランザクションを BEGIN IMMEDIATE で始める(最初に書き込みのロックを取る)
+                # 既定の BEGIN(DEFERRED)では、先に読み込んでから書き込もうとしたとき、ほかの接続が
+                # 書き込み中だと busy_timeout を待たずに database is locked になる
+                'transaction_mode': 'IMMEDIATE',
+            },
+        }
     }
+_conn_max_age = os.environ.get('DATABASE_CONN_MAX_AGE', '60')
+DATABASES['default'].update({
+    'CONN_MAX_AGE': None if _conn_max_age.lower() == 'none' else int(_conn_max_age),
+    # 使い回す接続は、リクエストの最初に使えるか確かめてから使う(切れていれば接続し直す)
+    'CONN_HEALTH_CHECKS': True,
+})
+
+# 明示していない主キーの型(これまでどおり AutoField)
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+
+# SQLiteの接続ごとに実行するPRAGMA(mysite.db が接続時に設定する)
+# WALにすると書き込み中も読み込みを待たせず、busy_timeout の間はロックが解けるのを待つ
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 1024 * 1024,
+    'busy_timeout': 5000,
 }
 
 
@@ -110,8 +160,6 @@ TIME_ZONE = 'Asia/Tokyo'
 
 USE_I18N = True
 
-USE_L10N = True
-
 USE_TZ = True
 
 
@@ -125,3 +173,60 @@ STATICFILES_DIRS = [
 
 LOGIN_URL = 'expenses:login'
 LOGIN_REDIRECT_URL = 'expenses:top'
+
+# アップロードされたファイル(CSV取り込みジョブ)の保存先
+MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# CSV取り込みを manage.py run_import_jobs で処理するか(Falseならリクエスト内で取り込む)
+CSV_IMPORT_IN_BACKGROUND = True
+
+# ブログのトップページに1ページあたり表示する投稿数
+BLOG_POSTS_PER_PAGE = 10
+
+# ブログの承認待ちコメント一覧に1ページあたり表示するコメント数
+BLOG_COMMENTS_PER_PAGE = 50
+
+# ブログのカテゴリ一覧の投稿数をキャッシュするか、キャッシュの保持秒数
+BLOG_CACHE_CATEGORY_COUNTS = True
+BLOG_CACHE_TIMEOUT = 60 * 60
+
+# ログインしていない閲覧者向けに、投稿一覧・詳細のページをキャッシュするか
+BLOG_CACHE_PAGES = True
+
+# キャッシュはファイルに保存する(CSV取り込みジョブなど別プロセスでの変更でも消せるように)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache'),
+    }
+}
+
+# テスト・ベンチマークではプロセス内のキャッシュを使う(上の共有キャッシュを読み書き・消去しない)
+TEST_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'mysite-test',
+    }
+}
+TEST_RUNNER = 'mysite.testing.TestRunner'
+
+# 家計簿のレコード一覧のページ送り。'offset'(ページ番号)か 'cursor'(前後へのトークン)
+# cursor のときの件数表示は 'exact'(COUNT)・'estimate'(概数)・'none'(表示しない)
+EXPENSES_RECORD_PAGINATION = 'offset'
+EXPENSES_RECORD_COUNT = 'none'
+
+# 家計簿の年・月のアーカイブの合計をキャッシュする秒数(レコードが変わればその月の分は消す)
+# 終わった月・年の合計はめったに変わらないので長く持つ
+EXPENSES_ARCHIVE_TIMEOUT = 60 * 10
+EXPENSES_ARCHIVE_CLOSED_TIMEOUT = 60 * 60 * 24 * 30
+
+# 家計簿のJSON API(/expenses/api/records/)の1ページの件数(既定値と ?limit= の上限)
+EXPENSES_API_DEFAULT_LIMIT = 1000
+EXPENSES_API_MAX_LIMIT = 10000
+
+# ビューごとの計測値をいくつ保持するか(/stats/ のパーセンタイルの計算に使う)
+PERFORMANCE_STATS_WINDOW = 1000
+# 計測値を Server-Timing ヘッダーで返すか
+PERFORMANCE_SERVER_TIMING = DEBUG
+# クエリ数がビューの query_budget を超えたとき、警告のログではなく例外にするか(テストランナーが有効にする)
+PERFORMANCE_STRICT_BUDGETS = False
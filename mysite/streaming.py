@@ -0,0 +1,39 @@
+import csv
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+# エクスポートでDBから一度に読み込む行数
+EXPORT_CHUNK_SIZE = getattr(settings, 'EXPORT_CHUNK_SIZE', 2000)
+
+
+class Echo:
+    """書き込まれた値をそのまま返すだけのファイルっぽいオブジェクト"""
+
+    def write(self, value):
+        return value
+
+
+# 行のイテレータを、1行ずつCSVにして返すレスポンスを作る
+# レスポンス全体をメモリに溜めないので、行数が増えてもメモリ使用量は変わらない
+# rows は非同期イテレータでもよい(ASGIのときだけ。WSGIでは送る前に全部メモリに読み込まれてしまう)
+def csv_streaming_response(rows, filename):
+    writer = csv.writer(Echo())
+    if hasattr(rows, '__aiter__'):
+        content = (writer.writerow(row) async for row in rows)
+    else:
+        content = (writer.writerow(row) for row in rows)
+    response = StreamingHttpResponse(content, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s"' % filename
+    return response
+
+
+# queryset を EXPORT_CHUNK_SIZE 行ずつ読み、format_row で1行ずつCSVにして返すレスポンスを作る
+# ASGIのリクエストには非同期のイテレータで返す(DBから読む間だけスレッドを使い、送る間はスレッドを占有しない)
+# WSGIのリクエストには同期のイテレータで返す
+def queryset_csv_response(request, queryset, format_row, filename):
+    if isinstance(request, ASGIRequest):
+        rows = (format_row(row) async for row in queryset.aiterator(chunk_size=EXPORT_CHUNK_SIZE))
+    else:
+        rows = (format_row(row) for row in queryset.iterator(chunk_size=EXPORT_CHUNK_SIZE))
+    return csv_streaming_response(rows, filename)
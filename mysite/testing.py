@@ -0,0 +1,113 @@
+import shutil
+import tempfile
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import URLPattern, URLResolver, get_resolver, resolve
+from .performance import get_query_budget
+
+
+# テスト・ベンチマークの間、キャッシュを settings.TEST_CACHES に差し替える
+# 実サイトと共有のキャッシュ(ファイル)に、テスト用のデータベースから作ったページや合計を書き込んだり、
+# cache.clear() で実サイトのキャッシュを消したりしないように
+def isolated_cache():
+    return override_settings(CACHES=settings.TEST_CACHES)
+
+
+class TestRunner(DiscoverRunner):
+    """テスト用の設定で動かすテストランナー
+
+    キャッシュは共有のものではなく TEST_CACHES にし、アップロードされたファイル(MEDIA_ROOT)は
+    終わったら消す一時ディレクトリに保存する。クエリ数が query_budget を超えたリクエストは
+    (ログの警告で終わらせずに)QueryBudgetExceeded でテストを失敗させる。
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._media_root = tempfile.mkdtemp(prefix='mysite-test-media-')
+        self._overrides = [
+            isolated_cache(),
+            override_settings(MEDIA_ROOT=self._media_root),
+            override_settings(PERFORMANCE_STRICT_BUDGETS=True),
+        ]
+        for override in self._overrides:
+            override.enable()
+
+    def teardown_test_environment(self, **kwargs):
+        for override in reversed(self._overrides):
+            override.disable()
+        shutil.rmtree(self._media_root, ignore_errors=True)
+        super().teardown_test_environment(**kwargs)
+
+
+# ストリーミングのレスポンスの本文を読み切って返す(非同期のイテレータなら、このスレッドでイベントループを回して読む)
+def streaming_body(response):
+    if response.is_async:
+        async def read():
+            return b''.join([chunk async for chunk in response.streaming_content])
+        return async_to_sync(read)()
+    return b''.join(response.streaming_content)
+
+
+# urlconf 内のビューのうち、query_budget を宣言していないもののURL名
+def views_without_budget(urlconf):
+    missing = []
+
+    def walk(patterns, namespace):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                walk(pattern.url_patterns, namespace)
+            elif isinstance(pattern, URLPattern) and get_query_budget(pattern.callback) is None:
+                missing.append(namespace + str(pattern.name or pattern.pattern))
+
+    resolver = get_resolver(urlconf)
+    walk(resolver.url_patterns, getattr(resolver.urlconf_module, 'app_name', '') + ':')
+    return missing
+
+
+class CleanCacheTestCase(TestCase):
+    """テストごとにテスト用のキャッシュを空にして始める TestCase
+
+    ページ・一覧・合計のキャッシュや、カテゴリ・支払い方法の一覧のバージョン(コミットの後に変わるので、
+    テストのトランザクション内では変わらない)が前のテストから残らないように。
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+
+class QueryBudgetTestCase(CleanCacheTestCase):
+    """ビューのクエリ数が query_budget を超えていないか確かめるテストの基底クラス
+
+    urlconf を指定すると、その中のすべてのビューが query_budget を宣言しているかも確かめる。
+    クエリ数はデータの件数に比例して増えないか(N+1になっていないか)を見たいので、
+    setUpTestData で一覧に複数件並ぶだけのデータを作っておく。
+    """
+    urlconf = None
+
+    def test_all_views_declare_budget(self):
+        if self.urlconf is None:
+            return
+        self.assertEqual(views_without_budget(self.urlconf), [])
+
+    def assertWithinBudget(self, url, method='get', data=None, status_code=None, **extra):
+        """url へのリクエストが、ビューの query_budget 以内のクエリ数で済むことを確かめてレスポンスを返す"""
+        budget = get_query_budget(resolve(url.split('?')[0]).func)
+        self.assertIsNotNone(budget, '%s のビューに query_budget がありません。' % url)
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(url, data or {}, **extra)
+            if getattr(response, 'streaming', False):
+                streaming_body(response)
+        if status_code is not None:
+            self.assertEqual(response.status_code, status_code)
+        self.assertLessEqual(
+            len(queries), budget,
+            '%s %s で %d 件のクエリが発行されました(上限 %d):\n%s' % (
+                method.upper(), url, len(queries), budget,
+                '\n'.join(query['sql'] for query in queries.captured_queries)))
+        return response
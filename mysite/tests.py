@@ -0,0 +1,177 @@
+import datetime
+import os
+import re
+import subprocess
+import sys
+from unittest import mock
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from blog.models import Post, Category as PostCategory
+from blog.search import post_index
+from expenses.models import Record, Category, Payment
+from expenses.search import record_index
+from expenses.views import RecordList
+from .performance import QueryBudgetExceeded, stats
+from .search import SQLITE_TRIGRAM
+from .testing import CleanCacheTestCase
+
+
+class TestCacheTests(TestCase):
+    """テストでは実サイトと共有のキャッシュ・アップロード先を使わない"""
+
+    def test_cache_is_isolated(self):
+        self.assertIsInstance(caches['default'], LocMemCache)
+        self.assertEqual(settings.CACHES, settings.TEST_CACHES)
+
+    def test_media_root_is_temporary(self):
+        # アップロードされたファイルを実サイトの media/ に書き込まない
+        self.assertNotEqual(os.path.commonpath([settings.MEDIA_ROOT, settings.BASE_DIR]), settings.BASE_DIR)
+
+
+class SQLiteConnectionTests(TransactionTestCase):
+    """SQLiteの接続時の設定と、トランザクションの始め方"""
+
+    def setUp(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('SQLite only')
+
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA %s' % name)
+            return cursor.fetchone()[0]
+
+    def test_pragmas_are_set_on_connect(self):
+        connection.close()
+        self.assertEqual(self.pragma('busy_timeout'), settings.SQLITE_PRAGMAS['busy_timeout'])
+        self.assertEqual(self.pragma('synchronous'), 1)  # NORMAL
+
+    def test_transactions_begin_immediate(self):
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                self.pragma('user_version')
+        self.assertEqual(queries.captured_queries[0]['sql'], 'BEGIN IMMEDIATE')
+
+
+class ASGIConnectionTests(TestCase):
+    """ASGIでは接続を使い回さない"""
+
+    def test_asgi_closes_connections_per_request(self):
+        env = dict(os.environ, DATABASE_CONN_MAX_AGE='60')
+        output = subprocess.run(
+            [sys.executable, '-c', 'import mysite.asgi; from django.conf import settings; '
+                                   'print(settings.DATABASES["default"]["CONN_MAX_AGE"])'],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=True,
+        ).stdout
+        self.assertEqual(output.strip(), '0')
+
+
+class FullTextIndexTests(TestCase):
+    """全文検索インデックス(SQLiteのFTS5)の同期と検索"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='カテゴリ')
+        cls.payment = Payment.objects.create(name='支払い')
+
+    def setUp(self):
+        if connection.vendor != 'sqlite' or not SQLITE_TRIGRAM:
+            self.skipTest('SQLite 3.34+ only')
+
+    def create(self, note):
+        return Record.objects.create(expense_date=datetime.date(2020, 1, 1), amount=100, note=note,
+                                     category=self.category, payment=self.payment)
+
+    def search(self, query):
+        return sorted(record_index.search(Record.objects.all(), query).values_list('note', flat=True))
+
+    def indexed(self, term):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT rowid FROM expenses_record_fts WHERE expenses_record_fts MATCH %s', ['"%s"' % term])
+            return sorted(row[0] for row in cursor.fetchall())
+
+    def test_triggers_follow_writes(self):
+        record = self.create('東京都の家賃')
+        self.assertEqual(self.indexed('東京都'), [record.pk])
+        record.note = '大阪府の家賃'
+        record.save()
+        self.assertEqual(self.indexed('東京都'), [])
+        self.assertEqual(self.indexed('大阪府'), [record.pk])
+        # bulk_update・一括削除もトリガーで反映される
+        record.note = '京都府の家賃'
+        Record.objects.bulk_update([record], ['note'])
+        self.assertEqual(self.indexed('京都府'), [record.pk])
+        Record.objects.filter(pk=record.pk).delete()
+        self.assertEqual(self.indexed('京都府'), [])
+
+    def test_trigram_matches_inside_words(self):
+        self.create('東京都の家賃')
+        self.create('京都旅行')
+        self.assertEqual(self.search('京都の'), ['東京都の家賃'])
+        self.assertEqual(self.search('京都'), ['京都旅行', '東京都の家賃'])
+        # 空白区切りの語はすべて含むものだけ
+        self.assertEqual(self.search('東京都 家賃'), ['東京都の家賃'])
+        self.assertEqual(self.search('東京都 旅行'), [])
+
+    def test_short_terms_use_contains(self):
+        self.create('東京都の家賃')
+        self.create('電気代')
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search('家賃'), ['東京都の家賃'])
+        self.assertNotIn('MATCH', queries.captured_queries[-1]['sql'])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.search('家賃 東京都'), ['東京都の家賃'])
+        self.assertIn('MATCH', queries.captured_queries[-1]['sql'])
+
+    def test_ranked_by_weighted_columns(self):
+        user = User.objects.create_user('tester', password='password')
+        category = PostCategory.objects.create(name='カテゴリ')
+        in_text = Post.objects.create(author=user, category=category, title='日記', text='全文検索について書いた')
+        in_title = Post.objects.create(author=user, category=category, title='全文検索', text='本文')
+        Post.objects.create(author=user, category=category, title='ほかの話', text='本文')
+        posts = post_index.search(Post.objects.order_by('pk'), '全文検索', ranked=True)
+        # タイトルの重みが大きいので、タイトルに含む投稿が先
+        self.assertEqual(list(posts), [in_title, in_text])
+        self.assertEqual(posts.count(), 2)
+
+
+@override_settings(PERFORMANCE_SERVER_TIMING=True)
+class PerformanceMiddlewareTests(CleanCacheTestCase):
+    """同期・非同期のビューのクエリ数の計測"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='カテゴリ')
+        payment = Payment.objects.create(name='支払い')
+        Record.objects.create(expense_date=datetime.date(2020, 1, 1), amount=100, category=category, payment=payment)
+
+    def setUp(self):
+        super().setUp()
+        stats.clear()
+
+    def server_timing_queries(self, response):
+        return int(re.search(r'desc="(\d+) queries"', response['Server-Timing']).group(1))
+
+    def test_sync_view(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/expenses/')
+        self.assertEqual(self.server_timing_queries(response), len(queries))
+
+    async def test_async_view(self):
+        response = await self.async_client.get('/expenses/record/aggregate/')
+        self.assertGreater(self.server_timing_queries(response), 0)
+        self.assertIn('expenses:record_aggregate', stats.summary())
+
+    def test_over_budget_fails_under_test_runner(self):
+        self.assertTrue(settings.PERFORMANCE_STRICT_BUDGETS)
+        with mock.patch.object(RecordList, 'query_budget', 1):
+            with self.assertRaises(QueryBudgetExceeded):
+                self.client.get('/expenses/')
+            # 本番の設定では警告をログに出すだけ
+            with override_settings(PERFORMANCE_STRICT_BUDGETS=False), \
+                    self.assertLogs('mysite.performance', 'WARNING'):
+                self.assertEqual(self.client.get('/expenses/').status_code, 200)
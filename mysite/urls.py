@@ -17,12 +17,15 @@ from django.contrib import admin
 from django.urls import path, include
 
 from django.contrib.auth import views
+from . import views as mysite_views
 
 urlpatterns = [
+    path('stats/', mysite_views.performance_stats, name='performance_stats'),
     path('accounts/login/', views.LoginView.as_view(), name='login'),
     path('accounts/logout/', views.LogoutView.as_view(next_page='/'), name='logout'),
     path('expenses/', include('expenses.urls')),
     path('blog/', include('blog.urls')),
+    path('imports/', include('imports.urls')),
     path('admin/', admin.site.urls),
     path('', admin.site.urls),
 ]
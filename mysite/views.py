@@ -0,0 +1,9 @@
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import JsonResponse
+from .performance import stats
+
+
+# ビューごとの直近のクエリ数・処理時間のパーセンタイル(このプロセスで処理した分)
+@staff_member_required
+def performance_stats(request):
+    return JsonResponse(stats.summary())